@@ -0,0 +1,25 @@
+import asyncio
+import os
+import socket
+
+# Worker OCR autonome : draine la collection ocr_jobs sans servir l'API.
+# Lancer l'API avec OCR_JOB_WORKERS=0 pour déléguer tout le traitement OCR à ce processus.
+from server import run_ocr_job_worker, ocr_cpu_executor, ocr_io_executor, client
+
+async def run_workers():
+    worker_count = int(os.environ.get('OCR_WORKER_CONCURRENCY', '2'))
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    print(f"🚀 Démarrage de {worker_count} workers OCR ({prefix})")
+    await asyncio.gather(*(run_ocr_job_worker(f"{prefix}-{i}") for i in range(worker_count)))
+
+if __name__ == "__main__":
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_workers())
+    except KeyboardInterrupt:
+        print("🛑 Arrêt des workers OCR")
+    finally:
+        ocr_cpu_executor.shutdown()
+        ocr_io_executor.shutdown()
+        client.close()
+        loop.close()
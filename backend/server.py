@@ -1,8 +1,11 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, Query, Response
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import ReplaceOne, ReturnDocument, UpdateMany, UpdateOne
+from gridfs.errors import NoFile
+import hashlib
 import os
 import logging
 from pathlib import Path
@@ -23,6 +26,7 @@ import PyPDF2
 import pdfplumber
 import base64
 import re
+import unicodedata
 
 # Google Cloud Vision imports
 from google.cloud import vision
@@ -31,6 +35,9 @@ from pdf2image import convert_from_bytes
 # Emergent Integrations pour Gemini
 from emergentintegrations.llm.chat import LlmChat, UserMessage, FileContentWithMimeType, ImageContent
 import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Parsers optimisés
 from parsers_optimized import parse_product_line_smart, optimize_parser_results, detect_product_category, detect_supplier_category
@@ -134,25 +141,88 @@ UNITES_STANDARDISEES = {
     # Unités spécifiques pour les vins
     "bouteille": {"type": "vin", "base": 6, "label": "Bouteille (75cL)"},
     "verre": {"type": "vin", "base": 1, "label": "Verre (1/6 bouteille)"},
+    
+    # Conditionnement (contenu propre à chaque produit : Produit.taille_colis)
+    "colis": {"type": "colis", "base": 1, "label": "Colis / carton"},
+}
+
+# Variantes rencontrées en saisie, OCR et imports → code standard (la casse est ignorée)
+UNIT_ALIASES = {
+    "kilo": "kg", "kilos": "kg", "kgs": "kg", "k": "kg", "t": "tonne", "tonnes": "tonne",
+    "gr": "g", "grs": "g", "gramme": "g", "grammes": "g",
+    "l": "L", "lt": "L", "litre": "L", "litres": "L", "ml": "mL", "cl": "cL", "dl": "dL",
+    "piece": "pièce", "pieces": "pièce", "pièces": "pièce", "pc": "pièce", "pcs": "pièce",
+    "unite": "unité", "unites": "unité", "unités": "unité", "u": "unité",
+    "portions": "portion", "barquettes": "barquette", "sachets": "sachet", "boite": "boîte", "boîtes": "boîte",
+    "bouteilles": "bouteille", "btl": "bouteille", "verres": "verre",
+    "carton": "colis", "cartons": "colis", "caisse": "colis", "caisses": "colis",
 }
+_UNIT_LOOKUP = {**{code.lower(): code for code in UNITES_STANDARDISEES}, **UNIT_ALIASES}
+
+# Matrice de conversion précalculée : UNIT_CONVERSION_MATRIX[i, j] = facteur de UNIT_CODES[i] vers
+# UNIT_CODES[j], NaN entre dimensions différentes (poids, volume, unités, vin, colis)
+UNIT_CODES = list(UNITES_STANDARDISEES)
+UNIT_INDEX = {code: i for i, code in enumerate(UNIT_CODES)}
+_unit_bases = np.array([UNITES_STANDARDISEES[code]["base"] for code in UNIT_CODES], dtype=float)
+_unit_types = np.array([UNITES_STANDARDISEES[code]["type"] for code in UNIT_CODES])
+UNIT_CONVERSION_MATRIX = np.where(
+    _unit_types[:, np.newaxis] == _unit_types[np.newaxis, :], _unit_bases[:, np.newaxis] / _unit_bases[np.newaxis, :], np.nan
+)
+
+def normalize_unit(unite: Optional[str]) -> Optional[str]:
+    """Code standard d'une unité ("Kg", "kgs" → "kg"), None si hors référentiel"""
+    if not unite:
+        return None
+    return _UNIT_LOOKUP.get(unite.strip().lower())
+
+def canonical_unit(unite: Optional[str]) -> Optional[str]:
+    """Unité à enregistrer : code standard si reconnue, sinon libellé d'origine (botte, paquet...)"""
+    return normalize_unit(unite) or unite
+
+def unit_factor(unite_source: Optional[str], unite_cible: Optional[str]) -> Optional[float]:
+    """Facteur de conversion entre deux unités (1 si l'une manque, None si inconnues ou incompatibles)"""
+    if not unite_source or not unite_cible or unite_source == unite_cible:
+        return 1.0
+    source, cible = normalize_unit(unite_source), normalize_unit(unite_cible)
+    if source is None or cible is None:
+        return None
+    factor = UNIT_CONVERSION_MATRIX[UNIT_INDEX[source], UNIT_INDEX[cible]]
+    return None if np.isnan(factor) else float(factor)
 
 def convertir_unite(quantite: float, unite_source: str, unite_cible: str) -> float:
     """Convertit une quantité d'une unité à une autre"""
-    if unite_source not in UNITES_STANDARDISEES or unite_cible not in UNITES_STANDARDISEES:
+    source, cible = normalize_unit(unite_source), normalize_unit(unite_cible)
+    if source is None or cible is None:
         raise ValueError(f"Unité non reconnue: {unite_source} ou {unite_cible}")
     
-    source = UNITES_STANDARDISEES[unite_source]
-    cible = UNITES_STANDARDISEES[unite_cible]
+    factor = UNIT_CONVERSION_MATRIX[UNIT_INDEX[source], UNIT_INDEX[cible]]
+    if np.isnan(factor):
+        raise ValueError(f"Impossible de convertir {unite_source} ({UNITES_STANDARDISEES[source]['type']}) en {unite_cible} ({UNITES_STANDARDISEES[cible]['type']})")
     
-    # Vérifier que les unités sont du même type
-    if source["type"] != cible["type"]:
-        raise ValueError(f"Impossible de convertir {unite_source} ({source['type']}) en {unite_cible} ({cible['type']})")
-    
-    # Convertir en unité de base puis en unité cible
-    quantite_base = quantite * source["base"]
-    resultat = quantite_base / cible["base"]
+    return quantite * float(factor)
+
+def product_unit_factor(unite: Optional[str], produit: dict) -> Optional[float]:
+    """Facteur d'une unité vers l'unité de stock du produit.
     
-    return resultat
+    Au-delà des conversions de même dimension, utilise le poids d'une pièce (poids_piece, en g)
+    pour passer pièce ↔ poids et la taille de colis (taille_colis, dans l'unité du produit).
+    """
+    unite_produit = produit.get("unite")
+    factor = unit_factor(unite, unite_produit)
+    if factor is not None:
+        return factor
+    source, cible = normalize_unit(unite), normalize_unit(unite_produit)
+    if source is None or cible is None:
+        return None
+    source_type, cible_type = UNITES_STANDARDISEES[source]["type"], UNITES_STANDARDISEES[cible]["type"]
+    if source_type == "colis":
+        return produit.get("taille_colis") or None
+    poids_piece = produit.get("poids_piece")
+    if poids_piece and source_type == "unite" and cible_type == "poids":
+        return poids_piece * float(UNIT_CONVERSION_MATRIX[UNIT_INDEX["g"], UNIT_INDEX[cible]])
+    if poids_piece and source_type == "poids" and cible_type == "unite":
+        return float(UNIT_CONVERSION_MATRIX[UNIT_INDEX[source], UNIT_INDEX["g"]]) / poids_piece
+    return None
 
 # Models pour la gestion des stocks
 class DeliveryRules(BaseModel):
@@ -175,6 +245,7 @@ class Fournisseur(BaseModel):
     logo: Optional[str] = None  # URL ou emoji pour le logo
     categorie: Optional[str] = "frais"  # Catégorie par défaut
     delivery_rules: Optional[DeliveryRules] = None  # Règles de livraison
+    delivery_calendar: Optional[dict] = None  # Règles compilées (compile_delivery_calendar) à l'enregistrement
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class FournisseurCreate(BaseModel):
@@ -209,8 +280,9 @@ class Order(BaseModel):
     order_date: datetime = Field(default_factory=datetime.utcnow)
     estimated_delivery_date: Optional[datetime] = None
     actual_delivery_date: Optional[datetime] = None
-    status: str = "pending"  # pending, confirmed, in_transit, delivered, cancelled
+    status: str = "pending"  # draft, pending, confirmed, in_transit, delivered, cancelled
     notes: Optional[str] = None
+    source: Optional[str] = None  # "proposition_auto" pour les brouillons générés
     created_by: Optional[str] = None  # User ID
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
@@ -221,6 +293,8 @@ class OrderCreate(BaseModel):
     items: List[OrderItem]
     notes: Optional[str] = None
 
+PREPARATION_UNIT_FIELDS = ("unite_produit_brut", "unite_preparee", "unite_portion")
+
 # ✅ Préparations - Étape intermédiaire entre produit brut et production
 class Preparation(BaseModel):
     """Préparation d'un produit brut"""
@@ -412,6 +486,8 @@ class Produit(BaseModel):
     reference_price: Optional[float] = 10.0  # ✅ New - Manager-set benchmark price for cost control
     main_supplier_id: Optional[str] = None  # ✅ New - Primary supplier
     secondary_supplier_ids: List[str] = []  # ✅ New - Alternative suppliers
+    poids_piece: Optional[float] = None  # Poids d'une pièce en g (conversion pièce ↔ poids)
+    taille_colis: Optional[float] = None  # Contenu d'un colis, dans l'unité du produit
     fournisseur_id: Optional[str] = None  # Legacy field for backward compatibility
     fournisseur_nom: Optional[str] = None  # Legacy field
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -424,6 +500,8 @@ class ProduitCreate(BaseModel):
     reference_price: Optional[float] = None  # ✅ Optional for backward compatibility
     main_supplier_id: Optional[str] = None
     secondary_supplier_ids: List[str] = []
+    poids_piece: Optional[float] = None
+    taille_colis: Optional[float] = None
     # Legacy fields for backward compatibility
     prix_achat: Optional[float] = None
     fournisseur_id: Optional[str] = None
@@ -593,6 +671,7 @@ class MouvementStock(BaseModel):
     reference: Optional[str] = None
     fournisseur_id: Optional[str] = None
     commentaire: Optional[str] = None
+    lots: Optional[List[dict]] = None  # Lots consommés (FEFO) pour les sorties
 
 class MouvementCreate(BaseModel):
     produit_id: str
@@ -627,6 +706,8 @@ class RecetteIngredient(BaseModel):
             data["ingredient_type"] = "produit"
             if "produit_nom" in data and not data.get("ingredient_nom"):
                 data["ingredient_nom"] = data["produit_nom"]
+        if data.get("unite"):
+            data["unite"] = canonical_unit(data["unite"])
         super().__init__(**data)
 
 # Modèle pour les données de vente avec services
@@ -709,13 +790,16 @@ class DocumentOCR(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     type_document: str  # "z_report", "facture_fournisseur"
     nom_fichier: str
-    image_base64: Optional[str] = None
+    image_base64: Optional[str] = None  # Legacy : fichier inline (remplacé par blob_sha256)
+    blob_sha256: Optional[str] = None  # Référence vers le fichier source dans le blob store
+    content_type: Optional[str] = None
     texte_extrait: Optional[str] = None
     donnees_parsees: Optional[dict] = None
     statut: str = "en_attente"  # "en_attente", "traite", "erreur"
     date_upload: datetime = Field(default_factory=datetime.utcnow)
     date_traitement: Optional[datetime] = None
     file_type: str = "image"  # "image" ou "pdf" - nouveau champ V3
+    parser_version: Optional[str] = None
 
 class DocumentUploadResponse(BaseModel):
     document_id: str
@@ -752,6 +836,7 @@ class ZReportValidationResult(BaseModel):
     total_deductions: int
     warnings: List[str] = []
     errors: List[str] = []
+    product_totals: List[dict] = []  # Déductions agrégées par produit (plan appliqué en bulk)
 
 # Backward compatibility - Legacy ZReportData model
 class ZReportData(BaseModel):
@@ -825,6 +910,280 @@ def round_stock_quantity(quantity: float) -> float:
     """Arrondir une quantité de stock à 0.01 près (2 décimales)"""
     return round(quantity, 2)
 
+# ===== Stock ledger =====
+# Seul chemin d'écriture de stocks.quantite_actuelle. Le delta signé est appliqué côté Mongo en une
+# seule mise à jour atomique (pipeline : ajout, arrondi 0.01, plancher à 0) : plus de lecture puis $set,
+# donc plus de mise à jour perdue entre deux mouvements concurrents. Le mouvement associé est journalisé
+# dans la foulée.
+def _stock_level_expression(delta: float) -> dict:
+    return {"$max": [0, {"$round": [{"$add": [{"$ifNull": ["$quantite_actuelle", 0]}, delta]}, 2]}]}
+
+async def _record_stock_movement(mouvement: Optional["MouvementStock"], stock: Optional[dict], record_if_missing: bool):
+    if mouvement is None or (stock is None and not record_if_missing):
+        return
+    if not mouvement.produit_nom and stock:
+        mouvement.produit_nom = stock.get("produit_nom")
+    await db.mouvements_stock.insert_one(mouvement.dict())
+
+# Tours de lecture / décrément : un lot vidé par une sortie concurrente est remplacé par les lots suivants
+FEFO_MAX_ROUNDS = 3
+
+async def allocate_fefo_many(quantities: dict) -> dict:
+    """Consommer les lots de plusieurs produits, DLC la plus proche d'abord (lecture groupée, décréments en parallèle).
+
+    quantities : produit_id → quantité sortie. Retourne produit_id → lots consommés (seulement ceux
+    effectivement décrémentés : un lot vidé entre-temps est écarté et le manque réalloué après relecture).
+    """
+    remaining_by_product = {pid: round_stock_quantity(q) for pid, q in quantities.items() if round_stock_quantity(q) > 0}
+    consumed_by_product = {pid: [] for pid in remaining_by_product}
+    
+    for _ in range(FEFO_MAX_ROUNDS):
+        pending = {pid: q for pid, q in remaining_by_product.items() if q > 0}
+        if not pending:
+            break
+        batches = await db.product_batches.find(
+            {"product_id": {"$in": list(pending)}, "is_consumed": False, "quantity": {"$gt": 0}},
+            {"_id": 0, "id": 1, "product_id": 1, "batch_number": 1, "quantity": 1, "expiry_date": 1}
+        ).sort([("product_id", 1), ("expiry_date", 1), ("received_date", 1)]).to_list(None)
+        batches_by_product = {}
+        for batch in batches:
+            batches_by_product.setdefault(batch["product_id"], []).append(batch)
+        
+        planned = []  # (produit_id, lot, quantité prise)
+        for produit_id, remaining in pending.items():
+            # Mongo classe les lots sans DLC en premier : ils passent après les lots datés (tri stable)
+            product_batches = sorted(batches_by_product.get(produit_id, []), key=lambda batch: batch.get("expiry_date") is None)
+            for batch in product_batches:
+                if remaining <= 0:
+                    break
+                take = round_stock_quantity(min(batch["quantity"], remaining))
+                if take <= 0:
+                    continue
+                remaining = round_stock_quantity(remaining - take)
+                planned.append((produit_id, batch, take))
+        if not planned:
+            break
+        
+        # Décrément conditionnel par lot : un lot vidé entre-temps par une autre sortie n'est pas rendu négatif,
+        # et son résultat (matched_count) dit s'il peut figurer dans la traçabilité du mouvement
+        results = await asyncio.gather(*[
+            db.product_batches.update_one(
+                {"id": batch["id"], "quantity": {"$gte": take}},
+                [
+                    {"$set": {"quantity": {"$round": [{"$subtract": ["$quantity", take]}, 2]}}},
+                    {"$set": {"is_consumed": {"$lte": ["$quantity", 0]}}}
+                ]
+            )
+            for _, batch, take in planned
+        ])
+        for (produit_id, batch, take), result in zip(planned, results):
+            if not result.matched_count:
+                continue
+            remaining_by_product[produit_id] = round_stock_quantity(remaining_by_product[produit_id] - take)
+            consumed_by_product[produit_id].append({
+                "batch_id": batch["id"],
+                "batch_number": batch.get("batch_number"),
+                "quantity": take,
+                "expiry_date": batch.get("expiry_date")
+            })
+        if all(result.matched_count for result in results):
+            break
+    
+    return consumed_by_product
+
+async def allocate_fefo(produit_id: str, quantite: float) -> List[dict]:
+    """Consommer une quantité sur les lots d'un produit (FEFO)"""
+    return (await allocate_fefo_many({produit_id: quantite})).get(produit_id, [])
+
+def _take_lots(pool: List[dict], quantite: float) -> List[dict]:
+    """Répartir les lots consommés d'un produit entre ses lignes de sortie, dans l'ordre"""
+    taken = []
+    quantite = round_stock_quantity(quantite)
+    while pool and quantite > 0:
+        lot = pool[0]
+        take = min(lot["quantity"], quantite)
+        taken.append({**lot, "quantity": take})
+        lot["quantity"] = round_stock_quantity(lot["quantity"] - take)
+        quantite = round_stock_quantity(quantite - take)
+        if lot["quantity"] <= 0:
+            pool.pop(0)
+    return taken
+
+async def apply_stock_delta(produit_id: str, delta: float, mouvement: Optional["MouvementStock"] = None,
+                            require_available: bool = False, record_if_missing: bool = False,
+                            consume_batches: bool = True, refresh_alerts: bool = True) -> Optional[dict]:
+    """Appliquer un delta signé au stock d'un produit et journaliser le mouvement.
+
+    Les sorties consomment les lots en FEFO (sauf consume_batches=False, lot déjà désigné).
+    Les alertes stock du produit sont recalculées (refresh_alerts=False pour les boucles qui
+    appellent refresh_stock_alerts une seule fois à la fin).
+    Retourne {stock_before, stock_after, lots}, ou None si le produit n'a pas de ligne de stock
+    (ou, avec require_available, si le stock ne couvre pas la sortie).
+    """
+    delta = round_stock_quantity(delta)
+    query = {"produit_id": produit_id}
+    if require_available and delta < 0:
+        query["quantite_actuelle"] = {"$gte": -delta}
+    
+    before = await db.stocks.find_one_and_update(
+        query,
+        [{"$set": {"quantite_actuelle": _stock_level_expression(delta), "derniere_maj": datetime.utcnow()}}],
+        projection={"_id": 0, "quantite_actuelle": 1, "produit_nom": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    lots = await allocate_fefo(produit_id, -delta) if before is not None and delta < 0 and consume_batches else []
+    if mouvement is not None and lots:
+        mouvement.lots = lots
+    await _record_stock_movement(mouvement, before, record_if_missing)
+    if before is None:
+        return None
+    if refresh_alerts:
+        await refresh_stock_alerts([produit_id])
+    
+    stock_before = round_stock_quantity(before.get("quantite_actuelle") or 0)
+    return {
+        "stock_before": stock_before,
+        "stock_after": round_stock_quantity(max(0, stock_before + delta)),
+        "lots": lots
+    }
+
+async def apply_stock_deltas(lines: List[dict]) -> dict:
+    """Appliquer en bloc des deltas de stock (ex: rapport Z) : agrégés par produit en mémoire,
+    un bulk_write sur stocks, un sur les lots (FEFO) et un insert_many des mouvements.
+
+    lines : [{"produit_id", "delta", "mouvement": MouvementStock | None}, ...]
+    Retourne produit_id → {stock_before, stock_after, lots} pour les produits ayant une ligne de stock.
+    """
+    totals = {}
+    for line in lines:
+        totals[line["produit_id"]] = round_stock_quantity(totals.get(line["produit_id"], 0) + line["delta"])
+    if not totals:
+        return {}
+    
+    # Niveaux avant mise à jour (informatifs) ; la mise à jour elle-même reste atomique par produit
+    stocks = {
+        stock["produit_id"]: stock
+        for stock in await db.stocks.find(
+            {"produit_id": {"$in": list(totals)}}, {"_id": 0, "produit_id": 1, "quantite_actuelle": 1, "produit_nom": 1}
+        ).to_list(None)
+    }
+    totals = {pid: delta for pid, delta in totals.items() if pid in stocks}
+    if not totals:
+        return {}
+    
+    now = datetime.utcnow()
+    await db.stocks.bulk_write([
+        UpdateOne({"produit_id": pid}, [{"$set": {"quantite_actuelle": _stock_level_expression(delta), "derniere_maj": now}}])
+        for pid, delta in totals.items()
+    ], ordered=False)
+    lots_by_product = await allocate_fefo_many({pid: -delta for pid, delta in totals.items() if delta < 0})
+    
+    lot_pools = {pid: [dict(lot) for lot in lots] for pid, lots in lots_by_product.items()}
+    mouvements = []
+    for line in lines:
+        stock, mouvement = stocks.get(line["produit_id"]), line.get("mouvement")
+        if stock is None or mouvement is None:
+            continue
+        if line["delta"] < 0:
+            mouvement.lots = _take_lots(lot_pools.get(line["produit_id"], []), -line["delta"]) or None
+        if not mouvement.produit_nom:
+            mouvement.produit_nom = stock.get("produit_nom")
+        mouvements.append(mouvement.dict())
+    if mouvements:
+        await db.mouvements_stock.insert_many(mouvements)
+    await refresh_stock_alerts(list(totals))
+    
+    results = {}
+    for pid, delta in totals.items():
+        stock_before = round_stock_quantity(stocks[pid].get("quantite_actuelle") or 0)
+        results[pid] = {
+            "stock_before": stock_before,
+            "stock_after": round_stock_quantity(max(0, stock_before + delta)),
+            "lots": lots_by_product.get(pid, [])
+        }
+    return results
+
+async def set_stock_level(produit_id: str, quantite: float, mouvement: Optional["MouvementStock"] = None,
+                          extra_fields: Optional[dict] = None, record_if_missing: bool = False,
+                          refresh_alerts: bool = True) -> Optional[dict]:
+    """Fixer le niveau de stock (inventaire / ajustement) ; mêmes garanties que apply_stock_delta"""
+    quantite = round_stock_quantity(max(0, quantite))
+    before = await db.stocks.find_one_and_update(
+        {"produit_id": produit_id},
+        {"$set": {**(extra_fields or {}), "quantite_actuelle": quantite, "derniere_maj": datetime.utcnow()}},
+        projection={"_id": 0, "quantite_actuelle": 1, "produit_nom": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    await _record_stock_movement(mouvement, before, record_if_missing)
+    if before is None:
+        return None
+    if refresh_alerts:
+        await refresh_stock_alerts([produit_id])
+    return {"stock_before": round_stock_quantity(before.get("quantite_actuelle") or 0), "stock_after": quantite}
+
+# ===== Keyset (cursor) Pagination Helpers =====
+# Les routes de liste renvoient toujours une liste JSON (compatibilité frontend) ;
+# le curseur de la page suivante est transmis dans l'en-tête X-Next-Cursor (absent = dernière page).
+DEFAULT_PAGE_LIMIT = 1000
+MAX_PAGE_LIMIT = 5000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(sort_value, last_id: str) -> str:
+    """Encoder (valeur de tri, id) du dernier élément en curseur opaque"""
+    if isinstance(sort_value, datetime):
+        payload = {"t": "date", "v": sort_value.isoformat(), "id": last_id}
+    else:
+        payload = {"t": "raw", "v": sort_value, "id": last_id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    """Décoder un curseur opaque → (valeur de tri, id)"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        value = datetime.fromisoformat(payload["v"]) if payload["t"] == "date" else payload["v"]
+        return value, payload["id"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Curseur de pagination invalide")
+
+def date_range_filter(field: str, date_from: Optional[datetime], date_to: Optional[datetime]) -> dict:
+    """Filtre Mongo sur une plage de dates (bornes optionnelles, incluses)"""
+    bounds = {}
+    if date_from:
+        bounds["$gte"] = date_from
+    if date_to:
+        bounds["$lte"] = date_to
+    return {field: bounds} if bounds else {}
+
+async def paginate(collection, query: dict, sort_field: str, descending: bool, limit: int,
+                   cursor: Optional[str], response: Response) -> List[dict]:
+    """Page keyset triée sur (sort_field, id) ; pose l'en-tête X-Next-Cursor s'il reste des éléments"""
+    limit = min(max(limit, 1), MAX_PAGE_LIMIT)
+    direction = -1 if descending else 1
+    
+    if cursor:
+        last_value, last_id = decode_cursor(cursor)
+        op = "$lt" if descending else "$gt"
+        if last_value is None:
+            # null trie en premier : en ascendant tout le reste suit, en descendant seuls les null restent
+            after_value = [{sort_field: {"$ne": None}}] if not descending else []
+        else:
+            after_value = [{sort_field: {op: last_value}}]
+            if descending:
+                # $lt ne compare pas entre types : les null / absents (triés en dernier) restent à parcourir
+                after_value.append({sort_field: None})
+        query = {"$and": [query, {"$or": after_value + [
+            {sort_field: last_value, "id": {op: last_id}}
+        ]}]}
+    
+    docs = await collection.find(query, {"_id": 0}).sort(
+        [(sort_field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(docs[-1].get(sort_field), docs[-1]["id"])
+    return docs
+
 # ===== Product Matching Helper Functions =====
 def calculate_similarity(str1: str, str2: str) -> float:
     """Calculate similarity between two strings (simple Levenshtein-like)"""
@@ -855,61 +1214,494 @@ def calculate_similarity(str1: str, str2: str) -> float:
 
 from rapidfuzz import fuzz, process
 
-async def match_product_by_name(product_name: str, min_confidence: float = 0.6) -> Optional[dict]:
-    """Match a product name from OCR with existing products using Fuzzy Logic"""
-    best_match = None
-    best_score = 0.0
-    
-    # Get all products (cache this in production)
-    products = await db.produits.find().to_list(length=None)
-    
-    if not products:
-        return None
-        
-    # Préparer la liste des noms pour RapidFuzz
-    product_names = [p["nom"] for p in products]
-    
-    # 1. Recherche du meilleur candidat
-    # score_cutoff=60 correspond à min_confidence 0.6
-    result = process.extractOne(product_name, product_names, scorer=fuzz.token_sort_ratio, score_cutoff=min_confidence*100)
-    
-    if result:
-        matched_name, score, index = result
-        normalized_score = score / 100.0
-        
-        product = products[index]
-        
-        best_match = {
+# ===== Versioned in-memory caches =====
+# Chaque cache mémoire est associé à un compteur dans `cache_versions` (_id = nom de collection),
+# incrémenté par les écritures. Tous les processus API voient ainsi l'invalidation au prochain accès.
+async def get_cache_version(name: str) -> int:
+    """Version courante d'un cache partagé"""
+    doc = await db.cache_versions.find_one({"_id": name})
+    return doc["version"] if doc else 0
+
+async def bump_cache_version(name: str):
+    """Invalider les caches mémoire construits à partir d'une collection"""
+    await db.cache_versions.update_one({"_id": name}, {"$inc": {"version": 1}}, upsert=True)
+
+class ProductNameIndex:
+    """Index mémoire des noms de produits pour le matching fuzzy OCR (reconstruit si la version change)"""
+
+    def __init__(self):
+        self.version = None
+        self.products: List[dict] = []
+        self.names: List[str] = []
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        version = await get_cache_version("produits")
+        if version == self.version:
+            return
+        async with self._lock:
+            if version == self.version:
+                return
+            products = await db.produits.find(
+                {}, {"_id": 0, "id": 1, "nom": 1, "categorie": 1, "unite": 1}
+            ).to_list(None)
+            self.products = [p for p in products if p.get("nom")]
+            self.names = [p["nom"] for p in self.products]
+            self.version = version
+
+    def _candidate(self, index: int, score: float) -> dict:
+        product = self.products[index]
+        return {
             "product_id": product["id"],
             "product_name": product["nom"],
-            "confidence": normalized_score,
+            "confidence": float(score) / 100.0,
             "category": product.get("categorie"),
             "unit": product.get("unite", "kg")
         }
-    
-    return best_match
+
+    async def match_many(self, queries: List[str], min_confidence: float = 0.6, top_k: int = 3) -> List[List[dict]]:
+        """Top-k candidats (score décroissant) pour chaque nom, en un seul appel process.cdist"""
+        await self.refresh()
+        if not self.names or not queries:
+            return [[] for _ in queries]
+        
+        cutoff = min_confidence * 100
+        scores = process.cdist(
+            [q or "" for q in queries], self.names, scorer=fuzz.token_sort_ratio, score_cutoff=cutoff
+        )
+        results = []
+        for row in scores:
+            # Tri stable : à score égal, le premier produit l'emporte (comme extractOne)
+            best = np.argsort(-row, kind="stable")[:top_k]
+            results.append([self._candidate(i, row[i]) for i in best if row[i] >= cutoff and row[i] > 0])
+        return results
+
+product_name_index = ProductNameIndex()
+
+async def match_products_by_names(product_names: List[str], min_confidence: float = 0.6, top_k: int = 3) -> List[List[dict]]:
+    """Matching OCR → produits pour toute une facture (liste de candidats par ligne)"""
+    return await product_name_index.match_many(product_names, min_confidence=min_confidence, top_k=top_k)
+
+async def match_product_by_name(product_name: str, min_confidence: float = 0.6) -> Optional[dict]:
+    """Match a product name from OCR with existing products using Fuzzy Logic"""
+    candidates = (await match_products_by_names([product_name], min_confidence=min_confidence, top_k=1))[0]
+    return candidates[0] if candidates else None
+
+# Mots vides ignorés pour le matching des libellés de caisse
+NAME_STOP_WORDS = {
+    "le", "la", "les", "l", "de", "du", "des", "d", "au", "aux", "a", "à", "et", "en",
+    "un", "une", "avec", "sur", "sans", "par", "pour", "the", "of"
+}
+# Seuil d'affichage et de catégorisation (alias, prix, dashboard)
+RECIPE_MATCH_MIN_CONFIDENCE = 0.5
+# Seuil des deux pipelines Z qui déduisent le stock : un recouvrement partiel de tokens ne suffit pas
+# (libellé identique 1.0, inclusion d'un libellé dans l'autre 0.85)
+RECIPE_DEDUCTION_MIN_CONFIDENCE = 0.8
+# Ligatures sans décomposition NFKD (sinon supprimées par le repli ASCII : "bœuf" → "buf")
+NAME_LIGATURES = str.maketrans({"œ": "oe", "Œ": "OE", "æ": "ae", "Æ": "AE"})
+
+def normalize_name(name: str) -> str:
+    """Minuscules, sans accents ni ponctuation, sans mots vides"""
+    folded = unicodedata.normalize("NFKD", str(name or "").translate(NAME_LIGATURES)).encode("ascii", "ignore").decode("ascii").lower()
+    tokens = re.sub(r"[^a-z0-9]+", " ", folded).split()
+    return " ".join(t for t in tokens if t not in NAME_STOP_WORDS)
+
+class RecipeMatcher:
+    """Matcher recettes : noms normalisés en cache, index inversé par token, scoring rapidfuzz"""
+
+    def __init__(self):
+        self.version = None
+        self.recipes: List[dict] = []
+        self.normalized: List[str] = []
+        self.exact: dict = {}
+        self.token_index: dict = {}
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        version = await get_cache_version("recettes")
+        if version == self.version:
+            return
+        async with self._lock:
+            if version == self.version:
+                return
+            recipes = [r for r in await db.recettes.find({}, {"_id": 0}).to_list(None) if r.get("nom")]
+            normalized = [normalize_name(r["nom"]) for r in recipes]
+            token_index = {}
+            for i, name in enumerate(normalized):
+                for token in set(name.split()):
+                    token_index.setdefault(token, set()).add(i)
+            self.recipes = recipes
+            self.normalized = normalized
+            self.exact = {name: i for i, name in reversed(list(enumerate(normalized))) if name}
+            self.token_index = token_index
+            self.version = version
+
+    def _score(self, query: str, candidate: str) -> float:
+        # Inclusion d'un libellé dans l'autre ("burger" / "burger maison") plafonnée à 0.85
+        return max(fuzz.token_sort_ratio(query, candidate), 0.85 * fuzz.token_set_ratio(query, candidate)) / 100.0
+
+    def _match_one(self, name: str, min_confidence: float) -> Optional[dict]:
+        query = normalize_name(name)
+        if not query:
+            return None
+        
+        best_index = self.exact.get(query)
+        best_score = 1.0 if best_index is not None else 0.0
+        if best_index is None:
+            shortlist = set()
+            for token in query.split():
+                shortlist |= self.token_index.get(token, set())
+            for i in sorted(shortlist):
+                score = self._score(query, self.normalized[i])
+                if score > best_score:
+                    best_index, best_score = i, score
+        
+        if best_index is None or best_score < min_confidence:
+            return None
+        recipe = self.recipes[best_index]
+        return {
+            "recipe_id": recipe["id"],
+            "recipe_name": recipe["nom"],
+            "confidence": best_score,
+            "ingredients": recipe.get("ingredients", []),
+            "category": recipe.get("categorie"),
+            "recipe": recipe
+        }
+
+    async def match_many(self, names: List[str], min_confidence: float = RECIPE_MATCH_MIN_CONFIDENCE) -> List[Optional[dict]]:
+        """Matcher tous les libellés d'un rapport Z en un appel (un seul chargement des recettes)"""
+        await self.refresh()
+        return [self._match_one(name, min_confidence) for name in names]
+
+recipe_matcher = RecipeMatcher()
+
+async def match_recipes_by_names(recipe_names: List[str], min_confidence: float = RECIPE_MATCH_MIN_CONFIDENCE) -> List[Optional[dict]]:
+    """Matching libellés de caisse → recettes pour tout un rapport Z"""
+    return await recipe_matcher.match_many(recipe_names, min_confidence=min_confidence)
 
 async def match_recipe_by_name(recipe_name: str, min_confidence: float = 0.6) -> Optional[dict]:
     """Match a recipe/production name from OCR with existing recipes"""
-    best_match = None
-    best_score = 0.0
-    
-    # Get all recipes
-    recipes = await db.recettes.find().to_list(length=None)
+    return (await match_recipes_by_names([recipe_name], min_confidence=min_confidence))[0]
+
+# ===== Alias libellés de caisse → recettes =====
+# Table persistée (z_name_aliases, clé = nom normalisé) alimentée au traitement des rapports Z.
+# Chaque alias garde la version du cache recettes utilisée : à la lecture, les libellés absents de la table
+# ou résolus avec d'anciennes recettes sont re-résolus (un seul matching pour tout le lot).
+async def record_z_name_aliases(names: List[str]) -> dict:
+    """Résoudre et enregistrer des libellés de caisse (un seul matching, un seul bulk_write) ; renvoie nom normalisé → alias"""
+    names_by_key = {}
+    for name in names:
+        key = normalize_name(name or "")
+        if key and key not in names_by_key:
+            names_by_key[key] = name
+    if not names_by_key:
+        return {}
+    
+    previous = {
+        alias["normalized_name"]: alias
+        for alias in await db.z_name_aliases.find({"normalized_name": {"$in": list(names_by_key)}}, {"_id": 0}).to_list(None)
+    }
+    matches = await match_recipes_by_names(list(names_by_key.values()))
+    now = datetime.utcnow()
+    aliases = {
+        key: {
+            "normalized_name": key,
+            "ocr_name": name,
+            "recipe_id": match["recipe_id"] if match else None,
+            "recipe_name": match["recipe_name"] if match else None,
+            "categorie": match["category"] if match else None,
+            "confidence": match["confidence"] if match else 0.0,
+            "recipes_version": recipe_matcher.version,
+            "updated_at": now
+        }
+        for (key, name), match in zip(names_by_key.items(), matches)
+    }
+    await db.z_name_aliases.bulk_write([
+        UpdateOne({"normalized_name": key}, {"$set": alias}, upsert=True) for key, alias in aliases.items()
+    ], ordered=False)
+    
+    # Résolution modifiée : reporter recette et catégorie sur les lignes déjà présentes dans le rollup
+    rollup_updates = []
+    for key, alias in aliases.items():
+        old = previous.get(key, {})
+        if (old.get("recipe_id"), old.get("categorie")) == (alias["recipe_id"], alias["categorie"]):
+            continue
+        fields = {"recipe_id": alias["recipe_id"]}
+        if alias["categorie"]:
+            fields["categorie"] = alias["categorie"]
+        rollup_updates.append(UpdateMany({"kind": "item", "name_key": key}, {"$set": fields}))
+    if rollup_updates:
+        await db.sales_daily.bulk_write(rollup_updates, ordered=False)
+    return aliases
+
+async def load_z_name_aliases(names: List[str]) -> dict:
+    """Alias d'une liste de libellés : nom normalisé → alias (re-résolus si absents ou périmés)"""
+    names_by_key = {}
+    for name in names:
+        key = normalize_name(name or "")
+        if key:
+            names_by_key.setdefault(key, name)
+    if not names_by_key:
+        return {}
+    aliases = await db.z_name_aliases.find({"normalized_name": {"$in": list(names_by_key)}}, {"_id": 0}).to_list(None)
+    aliases = {alias["normalized_name"]: alias for alias in aliases}
+    
+    await recipe_matcher.refresh()
+    stale = [
+        name for key, name in names_by_key.items()
+        if key not in aliases or aliases[key].get("recipes_version") != recipe_matcher.version
+    ]
+    if stale:
+        aliases.update(await record_z_name_aliases(stale))
+    return aliases
+
+# ===== Rollup des ventes journalières (sales_daily) =====
+# kind="day" : totaux du jour (CA, couverts, nb rapports) ; kind="item" : une ligne par (jour, libellé normalisé).
+# Tenu à jour par $inc à chaque création / suppression de rapport Z : les analytics lisent une plage de jours indexée.
+SALES_GRANULARITY_FORMATS = {"day": "%Y-%m-%d", "week": "%G-W%V", "month": "%Y-%m"}
+
+def sales_day(value) -> datetime:
+    """Jour (minuit UTC) d'une date de rapport Z"""
+    if isinstance(value, str):
+        value = datetime.strptime(value[:10], "%Y-%m-%d")
+    return datetime(value.year, value.month, value.day)
+
+async def record_sales_rollup(rapport: dict, sign: int = 1, collection=None):
+    """Reporter un rapport Z dans sales_daily (sign=-1 pour le retirer ; collection : cible d'une reconstruction)"""
+    day = sales_day(rapport.get("date") or datetime.utcnow())
+    produits = rapport.get("produits") or []
+    aliases = await load_z_name_aliases([p.get("nom", "") for p in produits])
+    now = datetime.utcnow()
+    
+    operations = [UpdateOne({"kind": "day", "day": day, "name_key": ""}, {
+        "$inc": {
+            "ca_total": sign * (rapport.get("ca_total") or 0),
+            "nb_couverts": sign * (rapport.get("nb_couverts") or 0),
+            "nb_rapports": sign
+        },
+        "$set": {"updated_at": now}
+    }, upsert=True)]
     
-    for recipe in recipes:
-        score = calculate_similarity(recipe_name, recipe["nom"])
-        if score > best_score and score >= min_confidence:
-            best_score = score
-            best_match = {
-                "recipe_id": recipe["id"],
-                "recipe_name": recipe["nom"],
-                "confidence": score,
-                "ingredients": recipe.get("ingredients", []),
-                "category": recipe.get("categorie")
+    items = {}
+    for produit in produits:
+        key = normalize_name(produit.get("nom") or "")
+        if not key:
+            continue
+        quantite = produit.get("quantite") or 0
+        # Le prix est stocké sous "prix_unitaire" ou "prix" selon l'origine du rapport
+        prix = produit.get("prix_unitaire", produit.get("prix")) or 0
+        row = items.setdefault(key, {"nom": produit["nom"], "quantite": 0, "ca": 0.0, "categorie": produit.get("categorie")})
+        row["quantite"] += quantite
+        row["ca"] += quantite * prix
+    
+    for key, row in items.items():
+        alias = aliases.get(key) or {}
+        operations.append(UpdateOne({"kind": "item", "day": day, "name_key": key}, {
+            "$inc": {"quantite": sign * row["quantite"], "ca": sign * row["ca"]},
+            "$set": {
+                "nom": row["nom"],
+                "recipe_id": alias.get("recipe_id"),
+                "categorie": alias.get("categorie") or row["categorie"],
+                "updated_at": now
             }
-    
-    return best_match
+        }, upsert=True))
+    
+    await (collection if collection is not None else db.sales_daily).bulk_write(operations, ordered=False)
+
+async def register_rapport_z(rapport: dict, extra_names: Optional[List[str]] = None):
+    """Après insertion d'un rapport Z : alias des libellés puis rollup journalier"""
+    await record_z_name_aliases([p.get("nom", "") for p in rapport.get("produits") or []] + (extra_names or []))
+    await record_sales_rollup(rapport)
+
+async def aggregate_sales_totals(date_from: Optional[datetime], date_to: Optional[datetime],
+                                 granularity: Optional[str] = None) -> List[dict]:
+    """Totaux CA / couverts / rapports sur une plage de jours, par jour, semaine ISO ou mois (ou global)"""
+    group_id = {"$dateToString": {"format": SALES_GRANULARITY_FORMATS[granularity], "date": "$day"}} if granularity else None
+    pipeline = [
+        {"$match": {"kind": "day", **date_range_filter("day", date_from, date_to)}},
+        {"$group": {
+            "_id": group_id,
+            "ca_total": {"$sum": "$ca_total"},
+            "nb_couverts": {"$sum": "$nb_couverts"},
+            "nb_rapports": {"$sum": "$nb_rapports"}
+        }},
+        {"$sort": {"_id": 1}}
+    ]
+    rows = await db.sales_daily.aggregate(pipeline).to_list(None)
+    return [{"period": row["_id"], **{k: row[k] for k in ("ca_total", "nb_couverts", "nb_rapports")}}
+            for row in rows if row["nb_rapports"] > 0]
+
+async def aggregate_sales_items(date_from: Optional[datetime], date_to: Optional[datetime]) -> List[dict]:
+    """Quantités et CA par libellé sur une plage de jours"""
+    pipeline = [
+        {"$match": {"kind": "item", **date_range_filter("day", date_from, date_to)}},
+        {"$sort": {"day": 1}},
+        {"$group": {
+            "_id": "$name_key",
+            "nom": {"$last": "$nom"},
+            "recipe_id": {"$last": "$recipe_id"},
+            "categorie": {"$last": "$categorie"},
+            "quantite": {"$sum": "$quantite"},
+            "ca": {"$sum": "$ca"}
+        }}
+    ]
+    rows = await db.sales_daily.aggregate(pipeline).to_list(None)
+    return [row for row in rows if row["quantite"] or row["ca"]]
+
+# ===== Nomenclature (BOM) : recette → besoins par portion =====
+# Explosion récursive recette → préparations → produits bruts, avec rendements des préparations
+# (quantite_produit_brut / quantite_preparee, sinon perte_pourcentage) et conversions du registre d'unités
+# (product_unit_factor : poids d'une pièce, taille de colis) vers l'unité du produit / de la préparation. Vecteurs {(type, id): quantité} mémoïsés par recette,
+# invalidés par cache_versions (recettes, preparations, produits). Coûts, capacité et déductions
+# de stock lisent tous ces mêmes vecteurs.
+BOM_CACHE_COLLECTIONS = ("recettes", "preparations", "produits")
+
+class BomEngine:
+    """Vecteurs de besoins par portion, calculés à la demande puis mis en cache"""
+
+    def __init__(self):
+        self.versions = None
+        self.recipes: dict = {}
+        self.preparations: dict = {}
+        self.products: dict = {}
+        self.issues: dict = {}  # recipe_id → avertissements (unités non convertibles, préparations introuvables)
+        self._vectors: dict = {}  # (recipe_id, explode_preparations) → vecteur
+        self._preparation_vectors: dict = {}  # preparation_id → besoins bruts pour 1 unite_preparee
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        versions = tuple([await get_cache_version(name) for name in BOM_CACHE_COLLECTIONS])
+        if versions == self.versions:
+            return
+        async with self._lock:
+            if versions == self.versions:
+                return
+            recipes = await db.recettes.find(
+                {}, {"_id": 0, "id": 1, "nom": 1, "portions": 1, "ingredients": 1}
+            ).to_list(None)
+            preparations = await db.preparations.find({}, {
+                "_id": 0, "id": 1, "nom": 1, "produit_id": 1, "quantite_produit_brut": 1, "unite_produit_brut": 1,
+                "quantite_preparee": 1, "unite_preparee": 1, "perte_pourcentage": 1
+            }).to_list(None)
+            products = await db.produits.find(
+                {}, {"_id": 0, "id": 1, "nom": 1, "unite": 1, "poids_piece": 1, "taille_colis": 1}
+            ).to_list(None)
+            self.recipes = {r["id"]: r for r in recipes}
+            self.preparations = {p["id"]: p for p in preparations}
+            self.products = {p["id"]: p for p in products}
+            self.issues = {}
+            self._vectors = {}
+            self._preparation_vectors = {}
+            self.versions = versions
+
+    def leaf_info(self, key: tuple) -> dict:
+        """Nom et unité d'une feuille de vecteur ("produit" ou "preparation", id)"""
+        leaf_type, leaf_id = key
+        if leaf_type == "preparation":
+            preparation = self.preparations.get(leaf_id, {})
+            return {"nom": preparation.get("nom", "Préparation inconnue"), "unite": preparation.get("unite_preparee")}
+        product = self.products.get(leaf_id, {})
+        return {"nom": product.get("nom", "Produit inconnu"), "unite": product.get("unite")}
+
+    def _convert(self, quantity: float, unit: Optional[str], target_unit: Optional[str], label: str, issues: List[str],
+                 product: Optional[dict] = None) -> float:
+        factor = product_unit_factor(unit, product) if product else unit_factor(unit, target_unit)
+        if factor is None:
+            # Unités hors référentiel : quantité reprise telle quelle (comportement historique)
+            issues.append(f"Unité '{unit}' non convertible en '{target_unit}' pour {label}")
+            return quantity
+        return quantity * factor
+
+    def _explode_preparation(self, preparation_id: str, stack: frozenset, issues: List[str]) -> Optional[dict]:
+        """Besoins bruts pour 1 unité préparée (None si la préparation ne peut pas être décomposée)"""
+        if preparation_id in self._preparation_vectors:
+            return self._preparation_vectors[preparation_id]
+        preparation = self.preparations.get(preparation_id)
+        if not preparation or preparation_id in stack:
+            return None
+        
+        # Rendement : brut consommé par unité préparée
+        quantite_preparee = preparation.get("quantite_preparee") or 0
+        if quantite_preparee > 0:
+            ratio = (preparation.get("quantite_produit_brut") or 0) / quantite_preparee
+        else:
+            rendement = 1 - (preparation.get("perte_pourcentage") or 0) / 100
+            ratio = 1 / rendement if rendement > 0 else 0
+        if ratio <= 0:
+            return None
+        
+        source_id = preparation.get("produit_id")
+        unit = preparation.get("unite_produit_brut")
+        vector = {}
+        if source_id in self.preparations and source_id not in self.products:
+            # Préparation dérivée d'une autre préparation : explosion récursive
+            sub_vector = self._explode_preparation(source_id, stack | {preparation_id}, issues)
+            if sub_vector is None:
+                return None
+            quantity = self._convert(ratio, unit, self.preparations[source_id].get("unite_preparee"), preparation["nom"], issues)
+            for key, sub_quantity in sub_vector.items():
+                vector[key] = vector.get(key, 0.0) + quantity * sub_quantity
+        elif source_id:
+            product = self.products.get(source_id, {})
+            vector[("produit", source_id)] = self._convert(ratio, unit, product.get("unite"), preparation["nom"], issues, product)
+        else:
+            return None
+        
+        self._preparation_vectors[preparation_id] = vector
+        return vector
+
+    def vector(self, recipe_id: str, explode_preparations: bool = True) -> dict:
+        """Besoins par portion d'une recette ; explode_preparations=False garde les préparations comme feuilles"""
+        cache_key = (recipe_id, explode_preparations)
+        if cache_key in self._vectors:
+            return self._vectors[cache_key]
+        recipe = self.recipes.get(recipe_id)
+        if not recipe:
+            return {}
+        
+        portions = recipe.get("portions") or 1
+        vector, issues = {}, []
+        for ingredient in recipe.get("ingredients", []):
+            ingredient_id = ingredient.get("ingredient_id") or ingredient.get("produit_id")
+            if not ingredient_id:
+                continue
+            quantity = (ingredient.get("quantite") or 0) / portions
+            unit = ingredient.get("unite")
+            
+            if ingredient.get("ingredient_type") == "preparation":
+                preparation = self.preparations.get(ingredient_id)
+                if not preparation:
+                    issues.append(f"Préparation {ingredient_id} introuvable")
+                    continue
+                quantity = self._convert(quantity, unit, preparation.get("unite_preparee"), preparation["nom"], issues)
+                sub_vector = self._explode_preparation(ingredient_id, frozenset(), issues) if explode_preparations else None
+                if sub_vector is None:
+                    if explode_preparations:
+                        issues.append(f"Préparation {preparation['nom']} non décomposable en produits bruts")
+                    vector[("preparation", ingredient_id)] = vector.get(("preparation", ingredient_id), 0.0) + quantity
+                else:
+                    for key, sub_quantity in sub_vector.items():
+                        vector[key] = vector.get(key, 0.0) + quantity * sub_quantity
+            else:
+                product = self.products.get(ingredient_id, {})
+                quantity = self._convert(quantity, unit, product.get("unite"), product.get("nom", ingredient_id), issues, product)
+                vector[("produit", ingredient_id)] = vector.get(("produit", ingredient_id), 0.0) + quantity
+        
+        self._vectors[cache_key] = vector
+        self.issues[recipe_id] = issues
+        return vector
+
+    def preparation_vector(self, preparation_id: str, issues: Optional[List[str]] = None) -> Optional[dict]:
+        """Besoins bruts pour 1 unité préparée (None si non décomposable) ; refresh() doit avoir été appelé"""
+        return self._explode_preparation(preparation_id, frozenset(), issues if issues is not None else [])
+
+    async def vectors(self, recipe_ids: Optional[List[str]] = None, explode_preparations: bool = True) -> dict:
+        """Vecteurs de plusieurs recettes (toutes si None)"""
+        await self.refresh()
+        ids = self.recipes.keys() if recipe_ids is None else recipe_ids
+        return {recipe_id: self.vector(recipe_id, explode_preparations) for recipe_id in ids if recipe_id in self.recipes}
+
+bom_engine = BomEngine()
 
 async def match_supplier_by_name(supplier_name: str, min_confidence: float = 0.6) -> Optional[dict]:
     """Match a supplier name from OCR with existing suppliers"""
@@ -1916,6 +2708,87 @@ async def create_user(user_create: UserCreate):
     await db.users.insert_one(user_obj.dict())
     return UserResponse(**user_obj.dict())
 
+# ✅ Calendrier de livraison compilé : DeliveryRules → masques de jours (bit 0 = lundi), heure limite,
+# délai et heure de livraison pré-parsés. Calculé à l'enregistrement du fournisseur (compilé à la volée
+# pour les anciens documents) ; calculate_delivery_date et le calendrier 14 jours n'ont plus qu'à lire des bits.
+DELIVERY_CALENDAR_VERSION = 1
+DAY_NAMES_FR = ['lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche']
+ALL_DAYS_MASK = 0x7F
+
+def _weekday_mask(day_names: List[str]) -> int:
+    mask = 0
+    for name in day_names:
+        name = (name or "").strip().lower()
+        if name in DAY_NAMES_FR:
+            mask |= 1 << DAY_NAMES_FR.index(name)
+    return mask
+
+# Heure de livraison saisie librement : "12:00", "11h", "12h30", "9"
+DELIVERY_TIME_PATTERN = re.compile(r"^\s*(\d{1,2})\s*(?:[:hH.]\s*(\d{2})?)?\s*$")
+
+def parse_delivery_time(value: Optional[str]) -> tuple:
+    """(heure, minute) d'une heure de livraison ; 12:00 si la valeur est illisible"""
+    match = DELIVERY_TIME_PATTERN.match(value or "")
+    if match:
+        hour, minute = int(match.group(1)), int(match.group(2) or 0)
+        if hour < 24 and minute < 60:
+            return hour, minute
+    return 12, 0
+
+def compile_delivery_calendar(rules) -> dict:
+    """Compiler les règles de livraison d'un fournisseur (DeliveryRules, dict ou None)"""
+    if isinstance(rules, dict):
+        rules = DeliveryRules(**rules)
+    if not rules:
+        return {"version": DELIVERY_CALENDAR_VERSION, "has_rules": False, "order_mask": ALL_DAYS_MASK, "deadline_hour": 24,
+                "delivery_mask": 0, "delay_days": 2, "delivery_hour": None, "delivery_minute": None, "saturday_to_monday": False}
+    hour, minute = parse_delivery_time(rules.delivery_time)
+    return {
+        "version": DELIVERY_CALENDAR_VERSION,
+        "has_rules": True,
+        # Sans jours de commande : commande possible tous les jours
+        "order_mask": _weekday_mask(rules.order_days) if rules.order_days else ALL_DAYS_MASK,
+        "deadline_hour": rules.order_deadline_hour if rules.order_deadline_hour is not None else 11,
+        # 0 : pas de jours de livraison fixes, livraison après delay_days
+        "delivery_mask": _weekday_mask(rules.delivery_days) if rules.delivery_days else 0,
+        "delay_days": rules.delivery_delay_days or 1,
+        "delivery_hour": hour,
+        "delivery_minute": minute,
+        "saturday_to_monday": bool(rules.special_rules and 'samedi' in rules.special_rules.lower())
+    }
+
+def supplier_delivery_calendar(supplier) -> dict:
+    """Calendrier compilé d'un fournisseur (Fournisseur ou document), recompilé s'il manque ou est périmé"""
+    if isinstance(supplier, dict):
+        calendar, rules = supplier.get("delivery_calendar"), supplier.get("delivery_rules")
+    else:
+        calendar, rules = supplier.delivery_calendar, supplier.delivery_rules
+    if calendar and calendar.get("version") == DELIVERY_CALENDAR_VERSION:
+        return calendar
+    return compile_delivery_calendar(rules)
+
+def next_weekday_offset(mask: int, weekday: int) -> Optional[int]:
+    """Nombre de jours (1 à 7) jusqu'au prochain jour du masque après weekday, None si le masque est vide"""
+    if not mask:
+        return None
+    rotated = ((mask >> weekday) | (mask << (7 - weekday))) & ALL_DAYS_MASK  # bit k = weekday + k
+    later = rotated >> 1  # bit k = weekday + k + 1
+    return (later & -later).bit_length() if later else 7
+
+def calendar_delivery_date(calendar: dict, base_date: datetime) -> datetime:
+    """Livraison pour une commande passée à base_date (dans les délais)"""
+    if not calendar["has_rules"]:
+        return base_date + timedelta(days=2)
+    if calendar["delivery_mask"]:
+        # Livraison à des jours spécifiques (ex: Royaume des Mers → Mar/Sam)
+        estimated_date = base_date + timedelta(days=next_weekday_offset(calendar["delivery_mask"], base_date.weekday()))
+    else:
+        # Livraison après un délai fixe (ex: METRO → lendemain, samedi → lundi)
+        estimated_date = base_date + timedelta(days=calendar["delay_days"])
+        if calendar["saturday_to_monday"] and estimated_date.weekday() == 5:
+            estimated_date += timedelta(days=2)
+    return estimated_date.replace(hour=calendar["delivery_hour"], minute=calendar["delivery_minute"], second=0)
+
 def calculate_delivery_date(supplier: Fournisseur, order_date: datetime = None) -> dict:
     """
     Calcule la date de livraison estimée selon les règles du fournisseur
@@ -1935,83 +2808,34 @@ def calculate_delivery_date(supplier: Fournisseur, order_date: datetime = None)
     """
     if order_date is None:
         order_date = datetime.now()
+    calendar = supplier_delivery_calendar(supplier)
     
     # Si pas de règles définies, utiliser le délai par défaut
-    if not supplier.delivery_rules:
-        estimated = order_date + timedelta(days=2)
+    if not calendar["has_rules"]:
         return {
-            'estimated_date': estimated,
+            'estimated_date': calendar_delivery_date(calendar, order_date),
             'can_order_today': True,
             'next_order_date': order_date,
             'explanation': 'Livraison estimée sous 2 jours (règles par défaut)'
         }
     
-    rules = supplier.delivery_rules
-    day_names_fr = ['lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche']
-    current_day_name = day_names_fr[order_date.weekday()].lower()
-    current_hour = order_date.hour
-    
-    # Vérifier si on peut commander aujourd'hui
-    can_order_today = False
-    if rules.order_days:
-        order_days_lower = [d.lower() for d in rules.order_days]
-        if current_day_name in order_days_lower and current_hour < rules.order_deadline_hour:
-            can_order_today = True
-    else:
-        # Si pas de jours spécifiés, on peut commander tous les jours avant deadline
-        can_order_today = current_hour < rules.order_deadline_hour
+    deadline_hour = calendar["deadline_hour"]
+    can_order_today = bool(calendar["order_mask"] >> order_date.weekday() & 1) and order_date.hour < deadline_hour
     
-    # Trouver la prochaine date de commande possible
+    # Prochaine date de commande possible (9h le prochain jour de commande)
     next_order_date = order_date
     if not can_order_today:
-        # Chercher le prochain jour de commande
-        for i in range(1, 8):
-            test_date = order_date + timedelta(days=i)
-            test_day_name = day_names_fr[test_date.weekday()].lower()
-            if rules.order_days:
-                order_days_lower = [d.lower() for d in rules.order_days]
-                if test_day_name in order_days_lower:
-                    next_order_date = test_date.replace(hour=9, minute=0, second=0)
-                    break
-            else:
-                next_order_date = test_date.replace(hour=9, minute=0, second=0)
-                break
+        offset = next_weekday_offset(calendar["order_mask"], order_date.weekday())
+        if offset:
+            next_order_date = (order_date + timedelta(days=offset)).replace(hour=9, minute=0, second=0)
     
-    # Calculer la date de livraison
-    if rules.delivery_days:
-        # Livraison à des jours spécifiques (ex: Royaume des Mers → Mar/Sam)
-        delivery_days_lower = [d.lower() for d in rules.delivery_days]
-        base_date = next_order_date if not can_order_today else order_date
-        
-        # Chercher le prochain jour de livraison
-        for i in range(1, 15):  # Chercher jusqu'à 2 semaines
-            test_date = base_date + timedelta(days=i)
-            test_day_name = day_names_fr[test_date.weekday()].lower()
-            if test_day_name in delivery_days_lower:
-                estimated_date = test_date.replace(hour=int(rules.delivery_time.split(':')[0]), 
-                                                   minute=int(rules.delivery_time.split(':')[1]), 
-                                                   second=0)
-                break
-    else:
-        # Livraison après un délai fixe (ex: METRO → lendemain)
-        delay = rules.delivery_delay_days or 1
-        base_date = next_order_date if not can_order_today else order_date
-        estimated_date = base_date + timedelta(days=delay)
-        
-        # Gérer les règles spéciales (ex: METRO samedi → +1 jour)
-        if rules.special_rules and 'samedi' in rules.special_rules.lower():
-            if day_names_fr[estimated_date.weekday()].lower() == 'samedi':
-                estimated_date += timedelta(days=2)  # Samedi → Lundi
-        
-        estimated_date = estimated_date.replace(hour=int(rules.delivery_time.split(':')[0]), 
-                                               minute=int(rules.delivery_time.split(':')[1]), 
-                                               second=0)
+    estimated_date = calendar_delivery_date(calendar, order_date if can_order_today else next_order_date)
     
     # Créer l'explication
     if can_order_today:
-        explanation = f"Commande aujourd'hui avant {rules.order_deadline_hour}h → Livraison le {estimated_date.strftime('%A %d/%m/%Y à %Hh%M')}"
+        explanation = f"Commande aujourd'hui avant {deadline_hour}h → Livraison le {estimated_date.strftime('%A %d/%m/%Y à %Hh%M')}"
     else:
-        explanation = f"Prochaine commande possible: {next_order_date.strftime('%A %d/%m/%Y')} avant {rules.order_deadline_hour}h → Livraison le {estimated_date.strftime('%A %d/%m/%Y à %Hh%M')}"
+        explanation = f"Prochaine commande possible: {next_order_date.strftime('%A %d/%m/%Y')} avant {deadline_hour}h → Livraison le {estimated_date.strftime('%A %d/%m/%Y à %Hh%M')}"
     
     return {
         'estimated_date': estimated_date,
@@ -2020,6 +2844,23 @@ def calculate_delivery_date(supplier: Fournisseur, order_date: datetime = None)
         'explanation': explanation
     }
 
+def calendar_order_slots(calendar: dict, start: datetime, days: int) -> List[dict]:
+    """Créneaux de commande (heure limite) et livraison correspondante sur les `days` prochains jours"""
+    slots = []
+    first_day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        if not calendar["order_mask"] >> day.weekday() & 1:
+            continue
+        deadline = day + timedelta(hours=calendar["deadline_hour"])
+        if deadline <= start:
+            continue
+        slots.append({
+            "commander_avant": deadline,
+            "livraison_estimee": calendar_delivery_date(calendar, max(day, start))
+        })
+    return slots
+
 @api_router.get("/admin/users", response_model=List[UserResponse])
 async def get_users():
     """Get all users (Super Admin only)"""
@@ -2130,8 +2971,22 @@ async def create_supplier_product_info(info: SupplierProductInfoCreate):
     
     info_obj = SupplierProductInfo(**info.dict())
     await db.supplier_product_info.insert_one(info_obj.dict())
+    await record_supplier_price(info_obj.supplier_id, info_obj.product_id, info_obj.price, "manual")
     return info_obj
 
+async def record_supplier_price(supplier_id: str, product_id: str, price: float, source: str):
+    """Historiser un prix fournisseur observé (base des tendances de coûts)"""
+    if not price:
+        return
+    await db.supplier_price_history.insert_one({
+        "id": str(uuid.uuid4()),
+        "supplier_id": supplier_id,
+        "product_id": product_id,
+        "price": price,
+        "source": source,  # "manual", "facture", "mercuriale"
+        "date": datetime.utcnow()
+    })
+
 @api_router.get("/supplier-product-info/{supplier_id}", response_model=List[SupplierProductInfo])
 async def get_supplier_products(supplier_id: str):
     """Get all products available from a specific supplier with pricing"""
@@ -2150,15 +3005,16 @@ async def create_product_batch(batch: ProductBatchCreate):
     batch_obj = ProductBatch(**batch.dict())
     await db.product_batches.insert_one(batch_obj.dict())
     
-    # Update stock with new batch quantity (rounded to 0.01)
-    stock = await db.stocks.find_one({"produit_id": batch.product_id})
-    if stock:
-        current = round_stock_quantity(stock.get("quantite_actuelle", 0))
-        new_quantity = round_stock_quantity(current + batch.quantity)
-        await db.stocks.update_one(
-            {"produit_id": batch.product_id},
-            {"$set": {"quantite_actuelle": new_quantity, "derniere_maj": datetime.utcnow()}}
-        )
+    # Update stock with new batch quantity (rounded to 0.01) and log the matching stock entry
+    mouvement = MouvementStock(
+        produit_id=batch.product_id,
+        produit_nom=product.get("nom"),
+        type="entree",
+        quantite=round_stock_quantity(batch.quantity),
+        fournisseur_id=batch_obj.supplier_id,
+        commentaire=f"Nouveau lot {batch_obj.batch_number or batch_obj.id}"
+    )
+    await apply_stock_delta(batch.product_id, batch.quantity, mouvement, record_if_missing=True)
     
     return batch_obj
 
@@ -2184,6 +3040,7 @@ async def resolve_price_anomaly(alert_id: str, resolution_note: str = ""):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Alert not found")
+    await refresh_price_anomaly_alerts()
     return {"message": "Alert resolved successfully"}
 
 # ✅ Version 3 - Analytics & Profitability Models
@@ -2271,33 +3128,16 @@ async def create_advanced_stock_adjustment(adjustment: StockAdjustmentRequest):
             
             adjustment_record.target_name = product["nom"]
             
-            # Update stock directly
-            stock = await db.stocks.find_one({"produit_id": adjustment.target_id})
-            if stock:
-                current = round_stock_quantity(stock["quantite_actuelle"])
-                adjusted = round_stock_quantity(adjustment.quantity_adjusted)
-                new_quantity = round_stock_quantity(max(0, current + adjusted))
-                await db.stocks.update_one(
-                    {"produit_id": adjustment.target_id},
-                    {
-                        "$set": {
-                            "quantite_actuelle": new_quantity,
-                            "derniere_maj": datetime.utcnow()
-                        }
-                    }
-                )
-                
-                # Create stock movement
-                movement_type = "entree" if adjustment.quantity_adjusted > 0 else "sortie"
-                mouvement = MouvementStock(
-                    produit_id=adjustment.target_id,
-                    produit_nom=product["nom"],
-                    type=movement_type,
-                    quantite=abs(adjustment.quantity_adjusted),
-                    commentaire=f"Ajustement avancé: {adjustment.adjustment_reason}"
-                )
-                await db.mouvements_stock.insert_one(mouvement.dict())
-            else:
+            # Update stock directly (atomic delta + stock movement)
+            movement_type = "entree" if adjustment.quantity_adjusted > 0 else "sortie"
+            mouvement = MouvementStock(
+                produit_id=adjustment.target_id,
+                produit_nom=product["nom"],
+                type=movement_type,
+                quantite=abs(adjustment.quantity_adjusted),
+                commentaire=f"Ajustement avancé: {adjustment.adjustment_reason}"
+            )
+            if await apply_stock_delta(adjustment.target_id, adjustment.quantity_adjusted, mouvement) is None:
                 raise HTTPException(status_code=404, detail="Stock non trouvé pour ce produit")
                 
         elif adjustment.adjustment_type == "prepared_dish":
@@ -2318,41 +3158,27 @@ async def create_advanced_stock_adjustment(adjustment: StockAdjustmentRequest):
                 qty_per_portion = ingredient["quantite"] / recipe_portions
                 total_deduction = round_stock_quantity(qty_per_portion * portions_adjusted)
                 
-                # Update stock
-                stock = await db.stocks.find_one({"produit_id": ingredient["produit_id"]})
-                if stock:
-                    current_stock = round_stock_quantity(stock["quantite_actuelle"])
-                    new_stock = round_stock_quantity(max(0, current_stock - total_deduction))
-                    
-                    await db.stocks.update_one(
-                        {"produit_id": ingredient["produit_id"]},
-                        {
-                            "$set": {
-                                "quantite_actuelle": new_stock,
-                                "derniere_maj": datetime.utcnow()
-                            }
-                        }
-                    )
-                    
-                    # Create stock movement
-                    mouvement = MouvementStock(
-                        produit_id=ingredient["produit_id"],
-                        produit_nom=ingredient.get("produit_nom", "Ingrédient"),
-                        type="sortie",
-                        quantite=total_deduction,
-                        commentaire=f"Déduction plat préparé: {recipe['nom']} (x{portions_adjusted}) - {adjustment.adjustment_reason}"
-                    )
-                    await db.mouvements_stock.insert_one(mouvement.dict())
-                    
+                # Update stock (atomic delta + stock movement)
+                mouvement = MouvementStock(
+                    produit_id=ingredient["produit_id"],
+                    produit_nom=ingredient.get("produit_nom", "Ingrédient"),
+                    type="sortie",
+                    quantite=total_deduction,
+                    commentaire=f"Déduction plat préparé: {recipe['nom']} (x{portions_adjusted}) - {adjustment.adjustment_reason}"
+                )
+                applied = await apply_stock_delta(ingredient["produit_id"], -total_deduction, mouvement, refresh_alerts=False)
+                if applied:
                     ingredient_deductions.append({
                         "product_id": ingredient["produit_id"],
                         "product_name": ingredient.get("produit_nom", "Ingrédient"),
                         "quantity_deducted": total_deduction,
-                        "previous_stock": current_stock,
-                        "new_stock": new_stock
+                        "previous_stock": applied["stock_before"],
+                        "new_stock": applied["stock_after"],
+                        "lots": applied["lots"]
                     })
             
             adjustment_record.ingredient_deductions = ingredient_deductions
+            await refresh_stock_alerts([d["product_id"] for d in ingredient_deductions])
         else:
             raise HTTPException(status_code=400, detail="Type d'ajustement invalide")
         
@@ -2367,11 +3193,26 @@ async def create_advanced_stock_adjustment(adjustment: StockAdjustmentRequest):
         raise HTTPException(status_code=500, detail=f"Erreur lors de l'ajustement: {str(e)}")
 
 @api_router.get("/stock/adjustments-history", response_model=List[AdvancedStockAdjustment])
-async def get_stock_adjustments_history():
-    """Get history of all stock adjustments"""
+async def get_stock_adjustments_history(
+    response: Response,
+    adjustment_type: Optional[str] = None,
+    target_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None
+):
+    """Get history of stock adjustments (cursor-paginated, newest first)"""
     try:
-        adjustments = await db.advanced_stock_adjustments.find().sort("created_at", -1).to_list(1000)
-        return [AdvancedStockAdjustment(**adj) for adj in adjustments]
+        query = date_range_filter("created_at", date_from, date_to)
+        if adjustment_type:
+            query["adjustment_type"] = adjustment_type
+        if target_id:
+            query["target_id"] = target_id
+        
+        return await paginate(db.advanced_stock_adjustments, query, "created_at", True, limit, cursor, response)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erreur lors de la récupération: {str(e)}")
 
@@ -2436,37 +3277,67 @@ async def get_product_batch_info(product_id: str):
         raise HTTPException(status_code=500, detail=f"Erreur lors de la récupération des lots: {str(e)}")
 
 @api_router.get("/stock/batch-summary", response_model=List[BatchStockInfo])
-async def get_batch_summary():
-    """Get batch summary for all products with batches"""
+async def get_batch_summary(skip: int = 0, limit: int = 50):
+    """Get batch summary for all products with batches (one aggregation, paginated by product name)"""
     try:
-        # Get all products with batches
+        now = datetime.utcnow()
+        critical_threshold = now + timedelta(days=7)
+        has_expiry = {"$eq": [{"$type": "$expiry_date"}, "date"]}
+        is_expired = {"$and": [has_expiry, {"$lt": ["$expiry_date", now]}]}
+        is_critical = {"$and": [
+            has_expiry,
+            {"$gte": ["$expiry_date", now]},
+            {"$lt": ["$expiry_date", critical_threshold]}
+        ]}
+        
+        # Index (product_id, is_consumed, expiry_date) → tri des lots par DLC sans scan
         pipeline = [
-            {"$lookup": {
-                "from": "product_batches",
-                "localField": "id",
-                "foreignField": "product_id",
-                "as": "batches"
+            {"$match": {"is_consumed": False}},
+            {"$sort": {"product_id": 1, "expiry_date": 1}},
+            {"$group": {
+                "_id": "$product_id",
+                "batches": {"$push": {
+                    "id": "$id",
+                    "quantity": "$quantity",
+                    "received_date": "$received_date",
+                    "expiry_date": "$expiry_date",
+                    "batch_number": "$batch_number",
+                    "supplier_id": "$supplier_id",
+                    "status": {"$switch": {
+                        "branches": [
+                            {"case": is_expired, "then": "expired"},
+                            {"case": is_critical, "then": "critical"}
+                        ],
+                        "default": "good"
+                    }}
+                }},
+                "critical_batches": {"$sum": {"$cond": [is_critical, 1, 0]}},
+                "expired_batches": {"$sum": {"$cond": [is_expired, 1, 0]}}
             }},
-            {"$match": {"batches": {"$ne": []}}},
-            {"$limit": 100}
+            {"$lookup": {"from": "produits", "localField": "_id", "foreignField": "id", "as": "product"}},
+            {"$unwind": "$product"},
+            {"$lookup": {"from": "stocks", "localField": "_id", "foreignField": "produit_id", "as": "stock"}},
+            {"$sort": {"product.nom": 1, "_id": 1}},
+            {"$skip": max(skip, 0)},
+            {"$limit": min(max(limit, 1), 500)},
+            {"$project": {
+                "_id": 0,
+                "product_id": "$_id",
+                "product_name": "$product.nom",
+                "total_stock": {"$ifNull": [{"$arrayElemAt": ["$stock.quantite_actuelle", 0]}, 0]},
+                "batches": 1,
+                "critical_batches": 1,
+                "expired_batches": 1
+            }}
         ]
         
-        # Since we're using motor, we need to do this differently
-        products = await db.produits.find().to_list(1000)
-        batch_summaries = []
+        summaries = await db.product_batches.aggregate(pipeline).to_list(None)
+        for summary in summaries:
+            for batch in summary["batches"]:
+                batch["received_date"] = batch["received_date"].isoformat() if batch.get("received_date") else None
+                batch["expiry_date"] = batch["expiry_date"].isoformat() if batch.get("expiry_date") else None
         
-        for product in products:
-            # Check if product has batches
-            has_batches = await db.product_batches.count_documents({
-                "product_id": product["id"],
-                "is_consumed": False
-            })
-            
-            if has_batches > 0:
-                batch_info = await get_product_batch_info(product["id"])
-                batch_summaries.append(batch_info)
-        
-        return batch_summaries[:50]  # Limit to first 50 for performance
+        return [BatchStockInfo(**summary) for summary in summaries]
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erreur lors du résumé des lots: {str(e)}")
@@ -2494,18 +3365,7 @@ async def consume_batch(batch_id: str, quantity_consumed: float):
                 {"$set": {"quantity": remaining_quantity}}
             )
         
-        # Update total stock (rounded to 0.01)
-        stock = await db.stocks.find_one({"produit_id": batch["product_id"]})
-        if stock:
-            current = round_stock_quantity(stock.get("quantite_actuelle", 0))
-            consumed = round_stock_quantity(quantity_consumed)
-            new_quantity = round_stock_quantity(max(0, current - consumed))
-            await db.stocks.update_one(
-                {"produit_id": batch["product_id"]},
-                {"$set": {"quantite_actuelle": new_quantity, "derniere_maj": datetime.utcnow()}}
-            )
-        
-        # Create stock movement
+        # Update total stock (rounded to 0.01) and record the stock movement
         product = await db.produits.find_one({"id": batch["product_id"]})
         mouvement = MouvementStock(
             produit_id=batch["product_id"],
@@ -2514,7 +3374,8 @@ async def consume_batch(batch_id: str, quantity_consumed: float):
             quantite=quantity_consumed,
             commentaire=f"Consommation lot {batch.get('batch_number', batch_id[:8])}"
         )
-        await db.mouvements_stock.insert_one(mouvement.dict())
+        await apply_stock_delta(batch["product_id"], -quantity_consumed, mouvement,
+                                record_if_missing=True, consume_batches=False)
         
         return {"message": "Lot mis à jour avec succès", "remaining_quantity": max(0, remaining_quantity)}
         
@@ -2540,7 +3401,7 @@ async def parse_z_report_enhanced_endpoint(document_id: str):
             raise HTTPException(status_code=400, detail="Aucun texte extrait disponible")
         
         # Parse with enhanced function
-        structured_data = parse_z_report_enhanced(document["texte_extrait"])
+        structured_data = await ocr_cpu_executor.run(parse_z_report_enhanced, document["texte_extrait"])
         
         # Update document with structured data
         await db.documents_ocr.update_one(
@@ -2573,11 +3434,30 @@ async def validate_z_report_endpoint(document_id: str, apply_deductions: bool =
         if not document:
             raise HTTPException(status_code=404, detail="Document non trouvé")
         
-        # Parse with enhanced function
-        structured_data = parse_z_report_enhanced(document["texte_extrait"])
+        # Reuse the parse and recipe matches of a previous validation, unless recipes changed since
+        recipes_version = await get_cache_version("recettes")
+        plan = document.get("z_deduction_plan")
+        if plan and plan.get("recipes_version") == recipes_version:
+            structured_data = StructuredZReportData(**plan["structured_data"])
+            recipe_matches = plan["recipe_matches"]
+        else:
+            # Parse with enhanced function
+            structured_data = await ocr_cpu_executor.run(parse_z_report_enhanced, document["texte_extrait"])
+            recipe_matches = [
+                {"recipe_id": match["recipe_id"], "recipe_name": match["recipe_name"]} if match else None
+                for match in await match_recipes_by_names(
+                    [item["name"] for item in z_report_items(structured_data)], min_confidence=RECIPE_DEDUCTION_MIN_CONFIDENCE
+                )
+            ]
+            await db.documents_ocr.update_one({"id": document_id}, {"$set": {"z_deduction_plan": {
+                "structured_data": structured_data.dict(),
+                "recipe_matches": recipe_matches,
+                "recipes_version": recipes_version,
+                "computed_at": datetime.utcnow()
+            }}})
         
-        # Calculate deductions
-        validation_result = await calculate_stock_deductions(structured_data)
+        # Stock levels, warnings and can_validate always come from the current stock
+        validation_result = await calculate_stock_deductions(structured_data, recipe_matches)
         
         response = {
             "document_id": document_id,
@@ -2594,6 +3474,8 @@ async def validate_z_report_endpoint(document_id: str, apply_deductions: bool =
             
             # Create RapportZ entry if deductions were applied successfully
             if deduction_result.get("success"):
+                # The plan is consumed: a later validation recomputes it
+                await db.documents_ocr.update_one({"id": document_id}, {"$unset": {"z_deduction_plan": ""}})
                 rapport_z = RapportZ(
                     date=datetime.utcnow(),
                     ca_total=structured_data.grand_total_sales or 0,
@@ -2609,6 +3491,7 @@ async def validate_z_report_endpoint(document_id: str, apply_deductions: bool =
                     ]
                 )
                 await db.rapports_z.insert_one(rapport_z.dict())
+                await register_rapport_z(rapport_z.dict())
                 response["rapport_z_created"] = True
         
         return response
@@ -2630,7 +3513,7 @@ async def get_z_report_preview(document_id: str):
             raise HTTPException(status_code=400, detail="Le document doit être un rapport Z")
         
         # Parse with enhanced function
-        structured_data = parse_z_report_enhanced(document["texte_extrait"])
+        structured_data = await ocr_cpu_executor.run(parse_z_report_enhanced, document["texte_extrait"])
         
         # Calculate potential deductions
         validation_result = await calculate_stock_deductions(structured_data)
@@ -2650,39 +3533,97 @@ async def get_z_report_preview(document_id: str):
 
 # ✅ Version 3 - Analytics & Profitability API Endpoints
 
+# ✅ Recipe costing engine - chargements groupés + calcul vectorisé (NumPy)
+async def load_costing_context() -> dict:
+    """Charger en un nombre fixe de requêtes les données nécessaires au calcul des coûts recettes"""
+    recipes = await db.recettes.find().to_list(None)
+    products = await db.produits.find(
+        {}, {"_id": 0, "id": 1, "nom": 1, "categorie": 1, "reference_price": 1}
+    ).to_list(None)
+    preferred_infos = await db.supplier_product_info.find(
+        {"is_preferred": True}, {"_id": 0, "product_id": 1, "price": 1}
+    ).to_list(None)
+    bom_vectors = await bom_engine.vectors()
+
+    # Prix unitaire: prix fournisseur préféré, sinon prix de référence du produit
+    unit_prices = {p["id"]: p.get("reference_price") or 0 for p in products}
+    # Comme find_one: le premier fournisseur préféré trouvé l'emporte
+    seen_preferred = set()
+    for info in preferred_infos:
+        product_id = info.get("product_id")
+        if product_id in unit_prices and product_id not in seen_preferred:
+            unit_prices[product_id] = info.get("price") or 0
+            seen_preferred.add(product_id)
+
+    return {
+        "recipes": recipes,
+        "products": {p["id"]: p for p in products},
+        "unit_prices": unit_prices,
+        "bom": bom_vectors
+    }
+
+def compute_recipe_costs(recipes: List[dict], unit_prices: dict, bom_vectors: dict) -> dict:
+    """Coût matière par portion pour toutes les recettes, calculé en un seul passage NumPy.
+
+    Les quantités viennent des vecteurs BOM (préparations décomposées en produits bruts,
+    unités converties dans l'unité du produit).
+    """
+    product_ids = list(unit_prices.keys())
+    product_index = {pid: i for i, pid in enumerate(product_ids)}
+    price_vector = np.array([unit_prices[pid] for pid in product_ids], dtype=float)
+
+    recipe_idx, product_idx, quantities = [], [], []
+    for r_i, recipe in enumerate(recipes):
+        for (leaf_type, ingredient_id), quantity in bom_vectors.get(recipe["id"], {}).items():
+            if leaf_type == "produit" and ingredient_id in product_index:
+                recipe_idx.append(r_i)
+                product_idx.append(product_index[ingredient_id])
+                quantities.append(quantity)
+
+    if recipe_idx:
+        line_costs = np.array(quantities, dtype=float) * price_vector[np.array(product_idx, dtype=int)]
+        costs = np.bincount(np.array(recipe_idx, dtype=int), weights=line_costs, minlength=len(recipes))
+    else:
+        costs = np.zeros(len(recipes))
+
+    return {recipe["id"]: float(costs[i]) for i, recipe in enumerate(recipes)}
+
+async def load_sold_quantities_by_name() -> dict:
+    """Quantités vendues par libellé (minuscule) sur tout l'historique, lues dans le rollup sales_daily"""
+    pipeline = [
+        {"$match": {"kind": "item"}},
+        {"$group": {
+            "_id": {"$toLower": {"$ifNull": ["$nom", ""]}},
+            "quantite": {"$sum": "$quantite"}
+        }}
+    ]
+    rows = await db.sales_daily.aggregate(pipeline).to_list(None)
+    return {row["_id"]: row["quantite"] for row in rows if row["_id"]}
+
+def portions_sold_for_recipe(recipe_name: str, sold_by_name: dict) -> int:
+    """Somme des ventes dont le libellé contient le nom de la recette"""
+    needle = recipe_name.lower()
+    return sum(quantity for name, quantity in sold_by_name.items() if needle in name)
+
 @api_router.get("/analytics/profitability", response_model=List[RecipeProfitability])
 async def get_recipe_profitability():
     """Calculate profitability for all recipes"""
-    recipes = await db.recettes.find().to_list(1000)
+    context = await load_costing_context()
+    recipes = context["recipes"]
+    costs = compute_recipe_costs(recipes, context["unit_prices"], context["bom"])
+    sold_by_name = await load_sold_quantities_by_name()
     profitability_data = []
     
     for recipe in recipes:
-        # Calculate ingredient cost
-        ingredient_cost = 0.0
-        for ingredient in recipe.get("ingredients", []):
-            # Get product price from supplier info or reference price
-            product = await db.produits.find_one({"id": ingredient["produit_id"]})
-            if product:
-                # Try to get best supplier price, fallback to reference price
-                supplier_info = await db.supplier_product_info.find_one({
-                    "product_id": ingredient["produit_id"],
-                    "is_preferred": True
-                })
-                unit_price = supplier_info["price"] if supplier_info else product.get("reference_price", 0)
-                ingredient_cost += (ingredient["quantite"] / recipe["portions"]) * unit_price
+        ingredient_cost = costs[recipe["id"]]
         
         # Calculate profitability
         selling_price = recipe.get("prix_vente", 0) or 0
         profit_margin = selling_price - ingredient_cost
         profit_percentage = (profit_margin / selling_price * 100) if selling_price > 0 else 0
         
-        # Get sales data from Rapports Z (simplified for now)
-        portions_sold = 0
-        rapports = await db.rapports_z.find().to_list(1000)
-        for rapport in rapports:
-            for produit in rapport.get("produits", []):
-                if recipe["nom"].lower() in produit.get("nom", "").lower():
-                    portions_sold += produit.get("quantite", 0)
+        # Sales data from Rapports Z (agrégées une seule fois par libellé)
+        portions_sold = portions_sold_for_recipe(recipe["nom"], sold_by_name)
         
         total_revenue = portions_sold * selling_price
         total_profit = portions_sold * profit_margin
@@ -2703,13 +3644,22 @@ async def get_recipe_profitability():
     profitability_data.sort(key=lambda x: x.profit_percentage, reverse=True)
     return profitability_data
 
+SALES_PERIOD_DAYS = {"daily": 1, "weekly": 7, "monthly": 30}
+
 @api_router.get("/analytics/sales-performance", response_model=SalesPerformance)
 async def get_sales_performance(period: str = "monthly"):
-    """Get sales performance analysis"""
-    # Get all Rapports Z
-    rapports = await db.rapports_z.find().to_list(1000)
-    
-    if not rapports:
+    """Get sales performance analysis for the current period (vs the previous one)"""
+    if period not in SALES_PERIOD_DAYS:
+        raise HTTPException(status_code=400, detail="Période invalide (daily, weekly, monthly)")
+    
+    # Current window ends today; growth is measured against the window just before it
+    days = SALES_PERIOD_DAYS[period]
+    today = sales_day(datetime.utcnow())
+    start = today - timedelta(days=days - 1)
+    current = await aggregate_sales_totals(start, today)
+    previous = await aggregate_sales_totals(start - timedelta(days=days), start - timedelta(days=1))
+    
+    if not current:
         return SalesPerformance(
             period=period,
             total_sales=0,
@@ -2720,35 +3670,29 @@ async def get_sales_performance(period: str = "monthly"):
         )
     
     # Calculate totals
-    total_sales = sum(rapport.get("ca_total", 0) for rapport in rapports)
-    total_orders = len(rapports)
+    total_sales = current[0]["ca_total"]
+    total_orders = current[0]["nb_rapports"]
     average_order_value = total_sales / total_orders if total_orders > 0 else 0
+    previous_sales = previous[0]["ca_total"] if previous else 0
+    growth_percentage = ((total_sales - previous_sales) / previous_sales * 100) if previous_sales > 0 else None
     
     # Calculate top recipes
     recipe_sales = {}
     category_sales = {"Bar": 0, "Entrées": 0, "Plats": 0, "Desserts": 0}
     
-    for rapport in rapports:
-        for produit in rapport.get("produits", []):
-            recipe_name = produit.get("nom", "")
-            quantity = produit.get("quantite", 0)
-            price = produit.get("prix", 0)
-            
-            if recipe_name not in recipe_sales:
-                recipe_sales[recipe_name] = {"quantity": 0, "revenue": 0}
-            
-            recipe_sales[recipe_name]["quantity"] += quantity
-            recipe_sales[recipe_name]["revenue"] += quantity * price
-            
-            # Categorize (simplified logic)
-            if any(word in recipe_name.lower() for word in ["vin", "bière", "cocktail", "apéritif"]):
-                category_sales["Bar"] += quantity * price
-            elif any(word in recipe_name.lower() for word in ["entrée", "salade", "soup"]):
-                category_sales["Entrées"] += quantity * price
-            elif any(word in recipe_name.lower() for word in ["dessert", "glace", "tarte", "gâteau"]):
-                category_sales["Desserts"] += quantity * price
-            else:
-                category_sales["Plats"] += quantity * price
+    for row in await aggregate_sales_items(start, today):
+        recipe_name = row["nom"]
+        recipe_sales[recipe_name] = {"quantity": row["quantite"], "revenue": row["ca"]}
+        
+        # Categorize (simplified logic)
+        if any(word in recipe_name.lower() for word in ["vin", "bière", "cocktail", "apéritif"]):
+            category_sales["Bar"] += row["ca"]
+        elif any(word in recipe_name.lower() for word in ["entrée", "salade", "soup"]):
+            category_sales["Entrées"] += row["ca"]
+        elif any(word in recipe_name.lower() for word in ["dessert", "glace", "tarte", "gâteau"]):
+            category_sales["Desserts"] += row["ca"]
+        else:
+            category_sales["Plats"] += row["ca"]
     
     # Get top 5 recipes
     top_recipes = sorted(
@@ -2763,12 +3707,165 @@ async def get_sales_performance(period: str = "monthly"):
         total_orders=total_orders,
         average_order_value=average_order_value,
         top_recipes=top_recipes,
-        sales_by_category=category_sales
+        sales_by_category=category_sales,
+        growth_percentage=growth_percentage
+    )
+
+@api_router.get("/analytics/sales-daily", response_model=List[dict])
+async def get_sales_rollup(
+    granularity: str = "day",
+    date_debut: Optional[datetime] = None,
+    date_fin: Optional[datetime] = None
+):
+    """Sales totals per day, ISO week or month, read from the sales_daily rollup"""
+    if granularity not in SALES_GRANULARITY_FORMATS:
+        raise HTTPException(status_code=400, detail="Granularité invalide (day, week, month)")
+    return await aggregate_sales_totals(
+        sales_day(date_debut) if date_debut else None,
+        sales_day(date_fin) if date_fin else None,
+        granularity
     )
 
+# ✅ Alert center matérialisé - collection `alerts` tenue à jour par les écritures de stock
+# Une alerte = {key, type, product_id, data, updated_at} ; `key` est déterministe (upsert idempotent)
+ALERT_EXPIRY_WINDOW_DAYS = 7
+ALERT_UNUSED_STOCK_DAYS = 30
+ALERT_SWEEP_INTERVAL_SECONDS = int(os.environ.get('ALERT_SWEEP_INTERVAL_SECONDS', '3600'))
+STOCK_ALERT_TYPES = ["expiring_product", "low_stock", "unused_stock"]
+
+async def refresh_stock_alerts(product_ids: Optional[List[str]] = None):
+    """Recalculer les alertes stock (DLC, stock bas, stock dormant) pour les produits donnés (tous si None)"""
+    now = datetime.utcnow()
+    product_ids = [pid for pid in product_ids if pid] if product_ids is not None else None
+    if product_ids is not None and not product_ids:
+        return
+
+    stock_scope = {"produit_id": {"$in": product_ids}} if product_ids is not None else {}
+    batch_scope = {"product_id": {"$in": product_ids}} if product_ids is not None else {}
+    alert_scope = {"product_id": {"$in": product_ids}} if product_ids is not None else {}
+
+    stocks = await db.stocks.find(stock_scope).to_list(None)
+    batches = await db.product_batches.find({
+        **batch_scope,
+        "expiry_date": {"$lte": now + timedelta(days=ALERT_EXPIRY_WINDOW_DAYS), "$ne": None},
+        "is_consumed": False
+    }).to_list(None)
+
+    involved_ids = {s["produit_id"] for s in stocks} | {b["product_id"] for b in batches}
+    products = await db.produits.find(
+        {"id": {"$in": list(involved_ids)}}, {"_id": 0, "id": 1, "nom": 1}
+    ).to_list(None)
+    product_names = {p["id"]: p["nom"] for p in products}
+
+    moved_rows = await db.mouvements_stock.aggregate([
+        {"$match": {**stock_scope, "date": {"$gte": now - timedelta(days=ALERT_UNUSED_STOCK_DAYS)}}},
+        {"$group": {"_id": "$produit_id"}}
+    ]).to_list(None)
+    moved_product_ids = {row["_id"] for row in moved_rows}
+
+    desired = {}
+    for batch in batches:
+        if batch["product_id"] not in product_names:
+            continue
+        key = f"expiring_product:{batch['id']}"
+        desired[key] = {
+            "key": key,
+            "type": "expiring_product",
+            "product_id": batch["product_id"],
+            "sort_date": batch["expiry_date"],
+            "data": {
+                "product_name": product_names[batch["product_id"]],
+                "batch_id": batch["id"],
+                "quantity": batch["quantity"],
+                "expiry_date": batch["expiry_date"]
+            }
+        }
+
+    for stock in stocks:
+        product_name = product_names.get(stock["produit_id"], "Produit inconnu")
+        if stock["quantite_actuelle"] <= stock["quantite_min"] and stock["quantite_min"] > 0:
+            key = f"low_stock:{stock['produit_id']}"
+            desired[key] = {
+                "key": key,
+                "type": "low_stock",
+                "product_id": stock["produit_id"],
+                "sort_date": stock["derniere_maj"],
+                "data": {
+                    "product_name": product_name,
+                    "current_quantity": stock["quantite_actuelle"],
+                    "minimum_quantity": stock["quantite_min"],
+                    "shortage": stock["quantite_min"] - stock["quantite_actuelle"]
+                }
+            }
+        if stock["produit_id"] not in moved_product_ids and stock["quantite_actuelle"] > 0:
+            key = f"unused_stock:{stock['produit_id']}"
+            desired[key] = {
+                "key": key,
+                "type": "unused_stock",
+                "product_id": stock["produit_id"],
+                "sort_date": stock["derniere_maj"],
+                "data": {
+                    "product_name": product_name,
+                    "quantity": stock["quantite_actuelle"],
+                    "last_update": stock["derniere_maj"]
+                }
+            }
+
+    await db.alerts.delete_many({
+        **alert_scope,
+        "type": {"$in": STOCK_ALERT_TYPES},
+        "key": {"$nin": list(desired.keys())}
+    })
+    if desired:
+        await db.alerts.bulk_write(
+            [ReplaceOne({"key": key}, {**doc, "updated_at": now}, upsert=True) for key, doc in desired.items()],
+            ordered=False
+        )
+
+async def refresh_price_anomaly_alerts():
+    """Recopier les anomalies de prix non résolues dans la collection alerts"""
+    now = datetime.utcnow()
+    anomalies = await db.price_anomaly_alerts.find({"is_resolved": False}).to_list(None)
+    desired_keys = [f"price_anomaly:{a['id']}" for a in anomalies]
+
+    await db.alerts.delete_many({"type": "price_anomaly", "key": {"$nin": desired_keys}})
+    if anomalies:
+        await db.alerts.bulk_write([
+            ReplaceOne({"key": key}, {
+                "key": key,
+                "type": "price_anomaly",
+                "product_id": anomaly["product_id"],
+                "sort_date": anomaly["alert_date"],
+                "data": {
+                    "product_name": anomaly["product_name"],
+                    "supplier_name": anomaly["supplier_name"],
+                    "reference_price": anomaly["reference_price"],
+                    "actual_price": anomaly["actual_price"],
+                    "difference_percentage": anomaly["difference_percentage"],
+                    "alert_date": anomaly["alert_date"]
+                },
+                "updated_at": now
+            }, upsert=True)
+            for key, anomaly in zip(desired_keys, anomalies)
+        ], ordered=False)
+
+async def sweep_alerts():
+    """Balayage complet (DLC et stock dormant dépendent du temps qui passe)"""
+    await refresh_stock_alerts()
+    await refresh_price_anomaly_alerts()
+
+async def run_alert_sweeper():
+    """Tâche de fond : balayage périodique des alertes"""
+    while True:
+        try:
+            await sweep_alerts()
+        except Exception as e:
+            print(f"⚠️ Erreur balayage alertes: {str(e)}")
+        await asyncio.sleep(ALERT_SWEEP_INTERVAL_SECONDS)
+
 @api_router.get("/analytics/alerts", response_model=AlertCenter)
 async def get_alert_center():
-    """Get all alerts for management dashboard"""
+    """Get all alerts for management dashboard (reads the materialized alerts collection)"""
     alerts = AlertCenter(
         expiring_products=[],
         price_anomalies=[],
@@ -2777,68 +3874,27 @@ async def get_alert_center():
         total_alerts=0
     )
     
-    # Get expiring products (next 7 days)
-    from datetime import datetime, timedelta
-    expiry_threshold = datetime.utcnow() + timedelta(days=7)
-    
-    expiring_batches = await db.product_batches.find({
-        "expiry_date": {"$lte": expiry_threshold, "$ne": None},
-        "is_consumed": False
-    }).to_list(1000)
-    
-    for batch in expiring_batches:
-        product = await db.produits.find_one({"id": batch["product_id"]})
-        if product:
-            days_to_expiry = (batch["expiry_date"] - datetime.utcnow()).days
+    now = datetime.utcnow()
+    async for alert in db.alerts.find({}, {"_id": 0}).sort([("type", 1), ("sort_date", 1)]):
+        data = alert["data"]
+        if alert["type"] == "expiring_product":
+            # Les jours restants sont calculés à la lecture, le document ne vieillit pas
+            days_to_expiry = (data["expiry_date"] - now).days
             alerts.expiring_products.append({
-                "product_name": product["nom"],
-                "batch_id": batch["id"],
-                "quantity": batch["quantity"],
-                "expiry_date": batch["expiry_date"].isoformat(),
+                **data,
+                "expiry_date": data["expiry_date"].isoformat(),
                 "days_to_expiry": days_to_expiry,
                 "urgency": "critical" if days_to_expiry <= 2 else "warning"
             })
-    
-    # Get price anomalies
-    price_anomalies = await db.price_anomaly_alerts.find({"is_resolved": False}).to_list(1000)
-    for anomaly in price_anomalies:
-        alerts.price_anomalies.append({
-            "product_name": anomaly["product_name"],
-            "supplier_name": anomaly["supplier_name"],
-            "reference_price": anomaly["reference_price"],
-            "actual_price": anomaly["actual_price"],
-            "difference_percentage": anomaly["difference_percentage"],
-            "alert_date": anomaly["alert_date"].isoformat()
-        })
-    
-    # Get low stock items
-    stocks = await db.stocks.find().to_list(1000)
-    for stock in stocks:
-        if stock["quantite_actuelle"] <= stock["quantite_min"] and stock["quantite_min"] > 0:
-            product = await db.produits.find_one({"id": stock["produit_id"]})
-            alerts.low_stock_items.append({
-                "product_name": product["nom"] if product else "Produit inconnu",
-                "current_quantity": stock["quantite_actuelle"],
-                "minimum_quantity": stock["quantite_min"],
-                "shortage": stock["quantite_min"] - stock["quantite_actuelle"]
-            })
-    
-    # Get unused stock (no movements in last 30 days)
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    recent_movements = await db.mouvements_stock.find({
-        "date": {"$gte": thirty_days_ago}
-    }).to_list(1000)
-    
-    moved_product_ids = set(mov["produit_id"] for mov in recent_movements)
-    
-    for stock in stocks:
-        if stock["produit_id"] not in moved_product_ids and stock["quantite_actuelle"] > 0:
-            product = await db.produits.find_one({"id": stock["produit_id"]})
+        elif alert["type"] == "price_anomaly":
+            alerts.price_anomalies.append({**data, "alert_date": data["alert_date"].isoformat()})
+        elif alert["type"] == "low_stock":
+            alerts.low_stock_items.append(data)
+        elif alert["type"] == "unused_stock":
             alerts.unused_stock.append({
-                "product_name": product["nom"] if product else "Produit inconnu",
-                "quantity": stock["quantite_actuelle"],
-                "last_update": stock["derniere_maj"].isoformat(),
-                "days_unused": (datetime.utcnow() - stock["derniere_maj"]).days
+                **data,
+                "last_update": data["last_update"].isoformat(),
+                "days_unused": (now - data["last_update"]).days
             })
     
     alerts.total_alerts = (len(alerts.expiring_products) + len(alerts.price_anomalies) + 
@@ -2846,63 +3902,150 @@ async def get_alert_center():
     
     return alerts
 
+@api_router.post("/analytics/alerts/refresh")
+async def refresh_alert_center():
+    """Forcer un balayage complet des alertes"""
+    await sweep_alerts()
+    return {"message": "Alertes recalculées", "total_alerts": await db.alerts.count_documents({})}
+
+# Mots-clés identifiant une sortie de stock comme perte (commentaire du mouvement)
+WASTE_COMMENT_PATTERN = "perte|casse|p[ée]rim|gaspill|jet[ée]|expir|dlc"
+
+async def aggregate_inventory_value_by_category() -> dict:
+    """Valorisation du stock par catégorie (stocks ⋈ produits en une agrégation)"""
+    pipeline = [
+        {"$lookup": {"from": "produits", "localField": "produit_id", "foreignField": "id", "as": "produit"}},
+        {"$unwind": "$produit"},
+        {"$group": {
+            "_id": {"$ifNull": ["$produit.categorie", "Non classé"]},
+            "value": {"$sum": {"$multiply": [
+                {"$ifNull": ["$quantite_actuelle", 0]},
+                {"$ifNull": ["$produit.reference_price", 0]}
+            ]}}
+        }}
+    ]
+    rows = await db.stocks.aggregate(pipeline).to_list(None)
+    return {row["_id"]: row["value"] for row in rows}
+
+async def aggregate_price_trends(now: datetime) -> dict:
+    """Variation moyenne des prix fournisseurs (%) sur 30 et 90 jours, depuis supplier_price_history"""
+    def window_avg(start_days: int, end_days: int) -> dict:
+        in_window = {"$and": [
+            {"$gte": ["$date", now - timedelta(days=start_days)]},
+            {"$lt": ["$date", now - timedelta(days=end_days)]}
+        ]}
+        return {"$avg": {"$cond": [in_window, "$price", None]}}
+
+    pipeline = [
+        {"$match": {"date": {"$gte": now - timedelta(days=180)}}},
+        {"$group": {
+            "_id": "$product_id",
+            "month": window_avg(30, 0),
+            "previous_month": window_avg(60, 30),
+            "quarter": window_avg(90, 0),
+            "previous_quarter": window_avg(180, 90)
+        }}
+    ]
+    rows = await db.supplier_price_history.aggregate(pipeline).to_list(None)
+
+    def mean_change(current_key: str, previous_key: str) -> Optional[float]:
+        changes = [
+            (row[current_key] / row[previous_key] - 1) * 100
+            for row in rows
+            if row.get(current_key) and row.get(previous_key)
+        ]
+        return round(float(np.mean(changes)), 1) if changes else None
+
+    return {
+        "monthly_change": mean_change("month", "previous_month"),
+        "quarterly_change": mean_change("quarter", "previous_quarter"),
+        "products_tracked": len(rows)
+    }
+
+async def aggregate_waste(since: datetime) -> dict:
+    """Valeur des sorties de stock et part identifiée comme perte, par produit"""
+    pipeline = [
+        {"$match": {"type": "sortie", "date": {"$gte": since}}},
+        {"$lookup": {"from": "produits", "localField": "produit_id", "foreignField": "id", "as": "produit"}},
+        {"$unwind": {"path": "$produit", "preserveNullAndEmptyArrays": True}},
+        {"$group": {
+            "_id": {
+                "nom": {"$ifNull": ["$produit.nom", "$produit_nom"]},
+                "is_waste": {"$regexMatch": {
+                    "input": {"$ifNull": ["$commentaire", ""]},
+                    "regex": WASTE_COMMENT_PATTERN,
+                    "options": "i"
+                }}
+            },
+            "value": {"$sum": {"$multiply": [
+                {"$ifNull": ["$quantite", 0]},
+                {"$ifNull": ["$produit.reference_price", 0]}
+            ]}}
+        }}
+    ]
+    rows = await db.mouvements_stock.aggregate(pipeline).to_list(None)
+
+    total_out_value = sum(row["value"] for row in rows)
+    waste_rows = sorted((row for row in rows if row["_id"]["is_waste"]), key=lambda r: r["value"], reverse=True)
+    waste_value = sum(row["value"] for row in waste_rows)
+
+    return {
+        "waste_value": waste_value,
+        "total_out_value": total_out_value,
+        "main_sources": [row["_id"]["nom"] for row in waste_rows[:3] if row["_id"]["nom"]]
+    }
+
 @api_router.get("/analytics/cost-analysis", response_model=CostAnalysis)
 async def get_cost_analysis():
     """Get comprehensive cost analysis"""
-    # Calculate total inventory value
-    stocks = await db.stocks.find().to_list(1000)
-    total_inventory_value = 0.0
-    
-    for stock in stocks:
-        product = await db.produits.find_one({"id": stock["produit_id"]})
-        if product:
-            unit_price = product.get("reference_price", 0)
-            total_inventory_value += stock["quantite_actuelle"] * unit_price
-    
-    # Calculate average cost per recipe
-    recipes = await db.recettes.find().to_list(1000)
-    total_recipe_cost = 0.0
-    recipe_count = 0
-    
-    expensive_ingredients = []
-    
-    for recipe in recipes:
-        recipe_cost = 0.0
-        for ingredient in recipe.get("ingredients", []):
-            product = await db.produits.find_one({"id": ingredient["produit_id"]})
-            if product:
-                unit_price = product.get("reference_price", 0)
-                ingredient_cost = (ingredient["quantite"] / recipe["portions"]) * unit_price
-                recipe_cost += ingredient_cost
-                
-                expensive_ingredients.append({
-                    "name": product["nom"],
-                    "unit_price": unit_price,
-                    "category": product.get("categorie", "Non classé")
-                })
-        
-        total_recipe_cost += recipe_cost
-        recipe_count += 1
-    
-    avg_cost_per_recipe = total_recipe_cost / recipe_count if recipe_count > 0 else 0
-    
-    # Get most expensive ingredients (top 10)
+    now = datetime.utcnow()
+
+    # Inventory valuation (one $lookup aggregation)
+    inventory_by_category = await aggregate_inventory_value_by_category()
+    total_inventory_value = sum(inventory_by_category.values())
+    
+    # Average cost per recipe (shared batched costing engine)
+    context = await load_costing_context()
+    recipes = context["recipes"]
+    costs = compute_recipe_costs(recipes, context["unit_prices"], context["bom"])
+    avg_cost_per_recipe = sum(costs.values()) / len(costs) if costs else 0
+    
+    # Most expensive ingredients used in recipes (top 10, one entry per product)
+    used_product_ids = {
+        ingredient.get("ingredient_id") or ingredient.get("produit_id")
+        for recipe in recipes
+        for ingredient in recipe.get("ingredients", [])
+    }
+    expensive_ingredients = [
+        {
+            "name": product.get("nom"),
+            "unit_price": product.get("reference_price", 0) or 0,
+            "category": product.get("categorie", "Non classé")
+        }
+        for product_id, product in context["products"].items()
+        if product_id in used_product_ids
+    ]
     expensive_ingredients.sort(key=lambda x: x["unit_price"], reverse=True)
     most_expensive = expensive_ingredients[:10]
     
-    # Simple cost trends (mock data for now)
+    # Cost trends from supplier price history
+    price_trends = await aggregate_price_trends(now)
+    sorted_categories = sorted(inventory_by_category.items(), key=lambda item: item[1], reverse=True)
     cost_trends = {
-        "monthly_change": 2.5,  # +2.5% this month
-        "quarterly_change": 7.8,  # +7.8% this quarter
-        "highest_cost_category": "Viandes et Poissons",
-        "lowest_cost_category": "Épices et Assaisonnements"
+        "monthly_change": price_trends["monthly_change"],
+        "quarterly_change": price_trends["quarterly_change"],
+        "products_tracked": price_trends["products_tracked"],
+        "highest_cost_category": sorted_categories[0][0] if sorted_categories else None,
+        "lowest_cost_category": sorted_categories[-1][0] if sorted_categories else None
     }
     
-    # Simple waste analysis
+    # Waste analysis from the last 30 days of stock movements
+    waste = await aggregate_waste(now - timedelta(days=30))
     waste_analysis = {
-        "estimated_waste_percentage": 8.5,
-        "estimated_waste_value": total_inventory_value * 0.085,
-        "main_waste_sources": ["Produits périssables", "Surproduction", "Erreurs de préparation"]
+        "period_days": 30,
+        "estimated_waste_percentage": round(waste["waste_value"] / waste["total_out_value"] * 100, 1) if waste["total_out_value"] > 0 else 0,
+        "estimated_waste_value": round(waste["waste_value"], 2),
+        "main_waste_sources": waste["main_sources"]
     }
     
     return CostAnalysis(
@@ -2913,6 +4056,160 @@ async def get_cost_analysis():
         waste_analysis=waste_analysis
     )
 
+# ===== OCR Executors (hors boucle asyncio) =====
+# - Processus : travail CPU (Tesseract, cv2, pdfplumber, parsers regex)
+# - Threads : appels réseau bloquants (Google Vision)
+# Chaque pool est borné : au-delà de workers + OCR_MAX_QUEUE_DEPTH tâches en attente → 503.
+OCR_PROCESS_WORKERS = int(os.environ.get('OCR_PROCESS_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+OCR_THREAD_WORKERS = int(os.environ.get('OCR_THREAD_WORKERS', '4'))
+OCR_TASK_TIMEOUT_SECONDS = float(os.environ.get('OCR_TASK_TIMEOUT_SECONDS', '180'))
+OCR_MAX_QUEUE_DEPTH = int(os.environ.get('OCR_MAX_QUEUE_DEPTH', '16'))
+
+class BoundedExecutor:
+    """Pool d'exécution borné (nombre de workers, profondeur de file, timeout par tâche)"""
+
+    def __init__(self, name: str, kind: str, max_workers: int, max_queue_depth: int, timeout: float):
+        self.name = name
+        self.kind = kind  # "process" ou "thread"
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.timeout = timeout
+        self.pending = 0
+        self._executor = None
+
+    def _get_executor(self):
+        # Création paresseuse : les processus ne sont lancés qu'au premier upload
+        if self._executor is None:
+            if self.kind == "process":
+                # spawn : les workers ne héritent pas des threads du client Mongo ni de la boucle asyncio
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """Exécuter func(*args) dans le pool ; 503 si la file est pleine, 504 si le timeout est dépassé"""
+        if self.pending >= self.max_workers + self.max_queue_depth:
+            raise HTTPException(status_code=503, detail="File de traitement OCR saturée, réessayez dans quelques instants")
+        
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._get_executor(), functools.partial(func, *args, **kwargs))
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            # Le worker termine la tâche en arrière-plan, mais la requête n'attend plus
+            raise HTTPException(status_code=504, detail=f"Délai de traitement OCR dépassé ({self.timeout:.0f}s) pour {func.__name__}")
+        finally:
+            self.pending -= 1
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "max_workers": self.max_workers, "pending": self.pending,
+                "max_queue_depth": self.max_queue_depth, "timeout_seconds": self.timeout}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+ocr_cpu_executor = BoundedExecutor("ocr-cpu", "process", OCR_PROCESS_WORKERS, OCR_MAX_QUEUE_DEPTH, OCR_TASK_TIMEOUT_SECONDS)
+ocr_io_executor = BoundedExecutor("ocr-io", "thread", OCR_THREAD_WORKERS, OCR_MAX_QUEUE_DEPTH, OCR_TASK_TIMEOUT_SECONDS)
+
+@api_router.get("/admin/ocr-executors")
+async def get_ocr_executor_stats():
+    """État des pools OCR (tâches en cours / en attente)"""
+    return {"cpu": ocr_cpu_executor.stats(), "io": ocr_io_executor.stats()}
+
+# ===== Content-addressed blob store (GridFS) =====
+# Les fichiers uploadés sont stockés une seule fois, nommés par leur SHA-256.
+# Les documents OCR ne portent qu'une référence (blob_sha256) ; le contenu est chargé à la demande.
+ocr_blob_bucket = AsyncIOMotorGridFSBucket(db, bucket_name="ocr_blobs")
+
+async def store_blob(content: bytes, content_type: str) -> str:
+    """Stocker un fichier (idempotent) et retourner son SHA-256"""
+    sha256 = hashlib.sha256(content).hexdigest()
+    existing = await db.ocr_blobs.files.find_one({"filename": sha256}, {"_id": 1})
+    if not existing:
+        await ocr_blob_bucket.upload_from_stream(
+            sha256, content, metadata={"content_type": content_type, "size": len(content)}
+        )
+    return sha256
+
+async def load_blob(sha256: str) -> Optional[bytes]:
+    """Charger le contenu d'un blob, None s'il n'existe pas"""
+    try:
+        stream = await ocr_blob_bucket.open_download_stream_by_name(sha256)
+        return await stream.read()
+    except NoFile:
+        return None
+
+async def delete_blob_if_unreferenced(sha256: Optional[str]):
+    """Supprimer un blob lorsque plus aucun document OCR ni job OCR en cours ne le référence"""
+    if not sha256 or await db.documents_ocr.count_documents({"blob_sha256": sha256}, limit=1):
+        return
+    if await db.ocr_jobs.count_documents({"blob_sha256": sha256, "status": {"$in": ["queued", "running"]}}, limit=1):
+        return
+    async for grid_file in db.ocr_blobs.files.find({"filename": sha256}, {"_id": 1}):
+        await ocr_blob_bucket.delete(grid_file["_id"])
+
+async def get_document_data_uri(document: dict) -> Optional[str]:
+    """Data URI du fichier source d'un document (blob store, ou base64 legacy)"""
+    if document.get("image_base64"):
+        return document["image_base64"]
+    if not document.get("blob_sha256"):
+        return None
+    content = await load_blob(document["blob_sha256"])
+    if content is None:
+        return None
+    content_type = document.get("content_type") or ("application/pdf" if document.get("file_type") == "pdf" else "image/jpeg")
+    return f"data:{content_type};base64,{base64.b64encode(content).decode('utf-8')}"
+
+@api_router.get("/ocr/document/{document_id}/file")
+async def get_document_file(document_id: str):
+    """Télécharger le fichier source d'un document OCR"""
+    document = await db.documents_ocr.find_one(
+        {"id": document_id}, {"_id": 0, "blob_sha256": 1, "content_type": 1, "file_type": 1, "image_base64": 1}
+    )
+    if not document:
+        raise HTTPException(status_code=404, detail="Document non trouvé")
+    
+    if document.get("blob_sha256"):
+        content = await load_blob(document["blob_sha256"])
+        content_type = document.get("content_type") or "application/octet-stream"
+    elif document.get("image_base64"):
+        header, _, encoded = document["image_base64"].partition(",")
+        content = base64.b64decode(encoded)
+        content_type = header[5:].split(";")[0] or "application/octet-stream"
+    else:
+        content = None
+    
+    if content is None:
+        raise HTTPException(status_code=404, detail="Fichier source non disponible")
+    return StreamingResponse(io.BytesIO(content), media_type=content_type)
+
+@api_router.post("/admin/migrate-ocr-blobs")
+async def migrate_ocr_documents_to_blobs():
+    """Déplacer les fichiers base64 inline des anciens documents OCR vers le blob store"""
+    migrated = 0
+    errors = []
+    async for document in db.documents_ocr.find(
+        {"image_base64": {"$nin": [None, ""]}}, {"_id": 0, "id": 1, "image_base64": 1}
+    ):
+        try:
+            header, _, encoded = document["image_base64"].partition(",")
+            content_type = header[5:].split(";")[0] if header.startswith("data:") else "image/jpeg"
+            sha256 = await store_blob(base64.b64decode(encoded or header), content_type)
+            await db.documents_ocr.update_one(
+                {"id": document["id"]},
+                {"$set": {"blob_sha256": sha256, "content_type": content_type, "image_base64": None}}
+            )
+            migrated += 1
+        except Exception as e:
+            errors.append(f"{document['id']}: {str(e)}")
+    return {"migrated": migrated, "errors": errors}
+
 # Configuration OCR
 pytesseract.pytesseract.tesseract_cmd = '/usr/bin/tesseract'
 
@@ -3199,29 +4496,34 @@ def parse_z_report_enhanced(texte_ocr: str) -> StructuredZReportData:
         return StructuredZReportData()
 
 async def enrich_z_report_prices(donnees_parsees: dict) -> dict:
-    """Enrichir les prix manquants à partir des recettes en base"""
+    """Enrichir les prix manquants à partir des recettes en base (un seul matching pour tout le rapport)"""
     try:
-        # Parcourir les catégories d'items
-        for category, items in donnees_parsees.get("items_by_category", {}).items():
-            for item in items:
-                # Si le prix unitaire est manquant, essayer de le trouver dans les recettes
-                if item.get("unit_price") is None:
-                    item_name = item.get("name", "").lower()
-                    
-                    # Chercher une recette correspondante
-                    recipe = await db.recettes.find_one({
-                        "$or": [
-                            {"nom": {"$regex": item_name, "$options": "i"}},
-                            {"nom": {"$regex": item_name.replace(" ", ".*"), "$options": "i"}}
-                        ]
-                    })
-                    
-                    if recipe and recipe.get("prix_vente"):
-                        item["unit_price"] = recipe["prix_vente"]
-                        # Calculer le prix total si on a la quantité
-                        if item.get("quantity_sold"):
-                            item["total_price"] = item["unit_price"] * item["quantity_sold"]
+        # Lignes sans prix unitaire, toutes catégories confondues
+        missing = [
+            item
+            for items in donnees_parsees.get("items_by_category", {}).values()
+            for item in items
+            if item.get("unit_price") is None
+        ]
         
+        enriched_count = 0
+        if missing:
+            # Index recettes en cache (noms normalisés + fuzzy) : plus de $regex par ligne
+            matches = await match_recipes_by_names([item.get("name", "") for item in missing])
+            for item, match in zip(missing, matches):
+                if match and match["recipe"].get("prix_vente"):
+                    item["unit_price"] = match["recipe"]["prix_vente"]
+                    # Calculer le prix total si on a la quantité
+                    if item.get("quantity_sold"):
+                        item["total_price"] = item["unit_price"] * item["quantity_sold"]
+                    enriched_count += 1
+        
+        # Marqueur : l'enrichissement n'est pas rejoué à chaque lecture du document
+        donnees_parsees["price_enrichment"] = {
+            "recipes_version": recipe_matcher.version,
+            "enriched_items": enriched_count,
+            "date": datetime.utcnow().isoformat()
+        }
         return donnees_parsees
         
     except Exception as e:
@@ -3275,8 +4577,16 @@ def categorize_menu_item(item_name: str) -> str:
     # Default to "Plats" (main dishes)
     return "Plats"
 
-async def calculate_stock_deductions(structured_report: StructuredZReportData) -> ZReportValidationResult:
-    """Calculate proposed stock deductions based on sold items and recipe ingredients"""
+def z_report_items(structured_report: StructuredZReportData) -> List[dict]:
+    """Sold items of a structured Z report, all categories in report order"""
+    return [item for items in structured_report.items_by_category.values() for item in items]
+
+async def calculate_stock_deductions(structured_report: StructuredZReportData,
+                                     recipe_matches: Optional[List[Optional[dict]]] = None) -> ZReportValidationResult:
+    """Calculate proposed stock deductions based on sold items and recipe ingredients
+    
+    recipe_matches: matches already computed for the report items ({"recipe_id", "recipe_name"} or None per item)
+    """
     result = ZReportValidationResult(
         can_validate=True,
         proposed_deductions=[],
@@ -3286,71 +4596,83 @@ async def calculate_stock_deductions(structured_report: StructuredZReportData) -
     )
     
     try:
-        # Get all recipes for matching
-        recipes = await db.recettes.find().to_list(1000)
-        recipe_dict = {recipe["nom"].lower(): recipe for recipe in recipes}
-        
         # Process each sold item
-        all_items = []
-        for category, items in structured_report.items_by_category.items():
-            all_items.extend(items)
+        all_items = z_report_items(structured_report)
+        
+        # Match the whole report against recipes in one batch
+        if recipe_matches is None:
+            recipe_matches = await match_recipes_by_names(
+                [item["name"] for item in all_items], min_confidence=RECIPE_DEDUCTION_MIN_CONFIDENCE
+            )
+        
+        # Per-portion requirements from the BOM engine (units converted to each product's unit)
+        bom_vectors = await bom_engine.vectors(
+            [match["recipe_id"] for match in recipe_matches if match], explode_preparations=False
+        )
         
-        for item in all_items:
-            item_name = item["name"].lower()
+        # Current stock of every ingredient in one query; deductions are then simulated in memory
+        # line after line, so an ingredient shared by several dishes is checked against its running level
+        product_ids = {
+            leaf_id for vector in bom_vectors.values() for leaf_type, leaf_id in vector if leaf_type == "produit"
+        }
+        stock_levels = {
+            stock["produit_id"]: stock.get("quantite_actuelle", 0)
+            for stock in await db.stocks.find(
+                {"produit_id": {"$in": list(product_ids)}}, {"_id": 0, "produit_id": 1, "quantite_actuelle": 1}
+            ).to_list(None)
+        }
+        product_totals = {}
+        
+        for item, recipe_match in zip(all_items, recipe_matches):
             quantity_sold = item["quantity_sold"]
             
-            # Try to find matching recipe
-            matching_recipe = None
-            best_match_ratio = 0
-            
-            for recipe_name, recipe in recipe_dict.items():
-                # Direct match
-                if item_name == recipe_name:
-                    matching_recipe = recipe
-                    break
-                # Partial match (simple fuzzy matching)
-                elif item_name in recipe_name or recipe_name in item_name:
-                    # Calculate simple match ratio
-                    match_ratio = len(set(item_name.split()) & set(recipe_name.split())) / max(len(item_name.split()), len(recipe_name.split()))
-                    if match_ratio > best_match_ratio and match_ratio > 0.3:
-                        best_match_ratio = match_ratio
-                        matching_recipe = recipe
-            
-            if matching_recipe:
+            if recipe_match:
                 # Calculate ingredient deductions
                 ingredient_deductions = []
                 warnings = []
-                recipe_portions = matching_recipe.get("portions", 1)
                 
-                for ingredient in matching_recipe.get("ingredients", []):
-                    # Get current stock
-                    stock = await db.stocks.find_one({"produit_id": ingredient["produit_id"]})
-                    if stock:
-                        # Calculate required quantity per sold portion
-                        qty_per_portion = ingredient["quantite"] / recipe_portions
+                # Stocked preparations are not part of this product-stock proposal
+                for (leaf_type, product_id), qty_per_portion in bom_vectors.get(recipe_match["recipe_id"], {}).items():
+                    if leaf_type != "produit":
+                        continue
+                    leaf = bom_engine.leaf_info((leaf_type, product_id))
+                    product_name = leaf["nom"]
+                    if product_id in stock_levels:
+                        # Calculate required quantity for the sold portions
                         total_deduction = qty_per_portion * quantity_sold
                         
-                        current_stock = stock["quantite_actuelle"]
+                        current_stock = stock_levels[product_id]
                         new_stock = current_stock - total_deduction
+                        stock_levels[product_id] = max(0, new_stock)
                         
                         ingredient_deductions.append({
-                            "product_id": ingredient["produit_id"],
-                            "product_name": ingredient.get("produit_nom", "Produit inconnu"),
+                            "product_id": product_id,
+                            "product_name": product_name,
                             "current_stock": current_stock,
                             "deduction": total_deduction,
                             "new_stock": max(0, new_stock),
-                            "unit": ingredient.get("unite", "")
+                            "unit": leaf["unite"] or ""
                         })
                         
+                        totals = product_totals.setdefault(product_id, {
+                            "product_id": product_id,
+                            "product_name": product_name,
+                            "current_stock": current_stock,
+                            "deduction": 0.0,
+                            "unit": leaf["unite"] or ""
+                        })
+                        totals["deduction"] += total_deduction
+                        totals["new_stock"] = max(0, new_stock)
+                        
                         # Check for insufficient stock
                         if new_stock < 0:
-                            warnings.append(f"Stock insuffisant pour {ingredient.get('produit_nom', 'Produit')}: {current_stock} disponible, {total_deduction:.2f} requis")
+                            warnings.append(f"Stock insuffisant pour {product_name}: {current_stock} disponible, {total_deduction:.2f} requis")
                             result.can_validate = False
                     else:
-                        warnings.append(f"Stock non trouvé pour {ingredient.get('produit_nom', 'Produit')}")
+                        warnings.append(f"Stock non trouvé pour {product_name}")
                 
                 proposal = StockDeductionProposal(
-                    recipe_name=matching_recipe["nom"],
+                    recipe_name=recipe_match["recipe_name"],
                     quantity_sold=quantity_sold,
                     ingredient_deductions=ingredient_deductions,
                     warnings=warnings
@@ -3360,6 +4682,7 @@ async def calculate_stock_deductions(structured_report: StructuredZReportData) -
             else:
                 result.warnings.append(f"Aucune recette trouvée pour '{item['name']}'")
         
+        result.product_totals = list(product_totals.values())
         if not result.proposed_deductions:
             result.warnings.append("Aucune déduction de stock possible - aucune recette correspondante trouvée")
         
@@ -3375,36 +4698,34 @@ async def apply_stock_deductions(validation_result: ZReportValidationResult) ->
     if not validation_result.can_validate:
         return {"success": False, "message": "Validation impossible - vérifiez les alertes"}
     
-    applied_deductions = 0
     errors = []
     
     try:
-        for proposal in validation_result.proposed_deductions:
-            for deduction in proposal.ingredient_deductions:
-                # Update stock
-                result = await db.stocks.update_one(
-                    {"produit_id": deduction["product_id"]},
-                    {
-                        "$set": {
-                            "quantite_actuelle": deduction["new_stock"],
-                            "derniere_maj": datetime.utcnow()
-                        }
-                    }
+        # One stock line per ingredient and sold dish; the ledger aggregates them per product and applies
+        # the deltas to the current levels (not to the levels seen at validation) in bulk
+        lines = [
+            {
+                "produit_id": deduction["product_id"],
+                "delta": -deduction["deduction"],
+                "mouvement": MouvementStock(
+                    produit_id=deduction["product_id"],
+                    produit_nom=deduction["product_name"],
+                    type="sortie",
+                    quantite=round_stock_quantity(deduction["deduction"]),
+                    commentaire=f"Déduction automatique - vente {proposal.recipe_name} (x{proposal.quantity_sold})"
                 )
-                
-                if result.modified_count > 0:
-                    # Create stock movement record
-                    mouvement = MouvementStock(
-                        produit_id=deduction["product_id"],
-                        produit_nom=deduction["product_name"],
-                        type="sortie",
-                        quantite=deduction["deduction"],
-                        commentaire=f"Déduction automatique - vente {proposal.recipe_name} (x{proposal.quantity_sold})"
-                    )
-                    await db.mouvements_stock.insert_one(mouvement.dict())
-                    applied_deductions += 1
-                else:
-                    errors.append(f"Impossible de mettre à jour le stock pour {deduction['product_name']}")
+            }
+            for proposal in validation_result.proposed_deductions
+            for deduction in proposal.ingredient_deductions
+        ]
+        applied = await apply_stock_deltas(lines)
+        
+        applied_deductions = 0
+        for line in lines:
+            if line["produit_id"] in applied:
+                applied_deductions += 1
+            else:
+                errors.append(f"Impossible de mettre à jour le stock pour {line['mouvement'].produit_nom}")
         
         return {
             "success": True,
@@ -3627,6 +4948,15 @@ def is_noise_line(line: str) -> bool:
     
     return False
 
+# Poids / volumes implicites dans les libellés, par ordre de priorité (kilos, grammes, volumes).
+# Le jeton d'unité est résolu par le registre (K → kg, GR → g, CL → cL) ; la conversion dans
+# l'unité de stock du produit se fait à l'intégration (product_unit_factor).
+IMPLICIT_QUANTITY_PATTERNS = [
+    re.compile(r'\b(\d+[\.,]?\d*)\s*(K|KG|Kg|kg)\b'),  # 10K, 5KG, 2.5Kg
+    re.compile(r'\b(\d+)\s*(G|g|GR|gr)\b'),  # 250g, 500GR
+    re.compile(r'\b(\d+[\.,]?\d*)\s*(L|l|CL|cl|cL|ML|ml|mL)\b'),  # 1L, 75CL, 500ml
+]
+
 def extract_implicit_quantity(nom: str, current_qty: float) -> tuple:
     """
     Analyse le nom du produit pour extraire poids/quantité implicite.
@@ -3637,38 +4967,21 @@ def extract_implicit_quantity(nom: str, current_qty: float) -> tuple:
     final_unit = "pièce" # Par défaut
     clean_name = nom
     
-    # 1. Détection KILOS (ex: 10K, 5KG, 2.5Kg)
-    # Regex: Nombre + (K ou KG) entouré de limites de mots ou fin de ligne
-    match_kg = re.search(r'\b(\d+[\.,]?\d*)\s*(?:K|KG|Kg|kg)\b', clean_name)
-    if match_kg:
-        try:
-            weight = float(match_kg.group(1).replace(',', '.'))
-            # On multiplie la quantité colis par le poids
-            final_qty = current_qty * weight
-            final_unit = "kg"
-            # On retire l'info du nom pour nettoyer
-            clean_name = clean_name.replace(match_kg.group(0), "").strip()
-            # Nettoyage extra (ex: "Moule  pac" -> "Moule pac")
-            clean_name = re.sub(r'\s+', ' ', clean_name)
-            return final_qty, final_unit, clean_name
-        except: pass
-
-    # 2. Détection GRAMMES (ex: 250g, 500GR)
-    match_g = re.search(r'\b(\d+)\s*(?:G|g|GR|gr)\b', clean_name)
-    if match_g:
+    # 1. Poids / volume (quantité colis × contenance, unité standardisée par le registre)
+    for pattern in IMPLICIT_QUANTITY_PATTERNS:
+        match = pattern.search(clean_name)
+        if not match:
+            continue
         try:
-            weight = float(match_g.group(1))
-            # On convertit en KG pour le stock ? Ou on laisse en G ?
-            # Pour la cuisine, souvent on préfère les KG. 250g = 0.25kg
-            # Mais gardons "g" pour la précision si c'est des petites quantités
-            final_qty = current_qty * weight
-            final_unit = "g"
-            clean_name = clean_name.replace(match_g.group(0), "").strip()
-            clean_name = re.sub(r'\s+', ' ', clean_name)
-            return final_qty, final_unit, clean_name
-        except: pass
+            final_qty = current_qty * float(match.group(1).replace(',', '.'))
+        except ValueError:
+            continue
+        final_unit = normalize_unit(match.group(2))
+        # On retire l'info du nom pour nettoyer (ex: "Moule  pac" -> "Moule pac")
+        clean_name = re.sub(r'\s+', ' ', clean_name.replace(match.group(0), "").strip())
+        return final_qty, final_unit, clean_name
 
-    # 3. Détection MULTIPLICATEUR (ex: X12, x 6, *8)
+    # 2. Détection MULTIPLICATEUR (ex: X12, x 6, *8)
     match_x = re.search(r'[\s\*](?:X|x)\s*(\d+)\b', clean_name)
     if match_x:
         try:
@@ -4699,7 +6012,7 @@ async def create_fournisseur(fournisseur: FournisseurCreate):
         raise HTTPException(status_code=400, detail=f"Catégorie invalide. Catégories disponibles: {', '.join(CATEGORIES_FOURNISSEURS)}")
     
     fournisseur_dict = fournisseur.dict()
-    fournisseur_obj = Fournisseur(**fournisseur_dict)
+    fournisseur_obj = Fournisseur(**fournisseur_dict, delivery_calendar=compile_delivery_calendar(fournisseur.delivery_rules))
     await db.fournisseurs.insert_one(fournisseur_obj.dict())
     
     # Créer automatiquement les produits de coûts (delivery & extra costs)
@@ -4723,7 +6036,7 @@ async def get_fournisseur(fournisseur_id: str):
 async def update_fournisseur(fournisseur_id: str, fournisseur: FournisseurCreate):
     result = await db.fournisseurs.update_one(
         {"id": fournisseur_id},
-        {"$set": fournisseur.dict()}
+        {"$set": {**fournisseur.dict(), "delivery_calendar": compile_delivery_calendar(fournisseur.delivery_rules)}}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Fournisseur non trouvé")
@@ -4754,6 +6067,7 @@ async def create_supplier_cost_products(supplier_id: str, supplier_name: str):
             fournisseur_nom=supplier_name
         )
         await db.produits.insert_one(delivery_product.dict())
+        await bump_cache_version("produits")
         
         # Créer le produit "Frais supplémentaires"
         extra_product = Produit(
@@ -4767,6 +6081,7 @@ async def create_supplier_cost_products(supplier_id: str, supplier_name: str):
             fournisseur_nom=supplier_name
         )
         await db.produits.insert_one(extra_product.dict())
+        await bump_cache_version("produits")
         
         # Créer la configuration des coûts
         cost_config = SupplierCostConfig(
@@ -4873,16 +6188,23 @@ async def create_order(order_data: OrderCreate):
     return order
 
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders(status: Optional[str] = None, supplier_id: Optional[str] = None):
-    """Récupérer les commandes avec filtres optionnels"""
-    query = {}
+async def get_orders(
+    response: Response,
+    status: Optional[str] = None,
+    supplier_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None
+):
+    """Récupérer les commandes avec filtres optionnels (pagination par curseur)"""
+    query = date_range_filter("order_date", date_from, date_to)
     if status:
         query["status"] = status
     if supplier_id:
         query["supplier_id"] = supplier_id
     
-    orders = await db.orders.find(query).sort("order_date", -1).to_list(1000)
-    return [Order(**order) for order in orders]
+    return await paginate(db.orders, query, "order_date", True, limit, cursor, response)
 
 @api_router.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: str):
@@ -4895,7 +6217,7 @@ async def get_order(order_id: str):
 @api_router.put("/orders/{order_id}/status")
 async def update_order_status(order_id: str, status: str, actual_delivery_date: Optional[str] = None):
     """Mettre à jour le statut d'une commande"""
-    valid_statuses = ["pending", "confirmed", "in_transit", "delivered", "cancelled"]
+    valid_statuses = ["draft", "pending", "confirmed", "in_transit", "delivered", "cancelled"]
     if status not in valid_statuses:
         raise HTTPException(status_code=400, detail=f"Statut invalide. Utilisez: {', '.join(valid_statuses)}")
     
@@ -4927,6 +6249,34 @@ async def clear_orders_history():
     }
 
 
+@api_router.get("/suppliers/delivery-calendar")
+async def get_suppliers_delivery_calendar(days: int = Query(14, ge=1, le=60)):
+    """Prochaine commande et créneaux commande → livraison de tous les fournisseurs sur les prochains jours"""
+    now = datetime.now()
+    suppliers = await db.fournisseurs.find(
+        {}, {"_id": 0, "id": 1, "nom": 1, "couleur": 1, "logo": 1, "delivery_rules": 1, "delivery_calendar": 1}
+    ).to_list(None)
+    
+    calendars = []
+    for supplier in sorted(suppliers, key=lambda s: s.get("nom", "")):
+        calendar = supplier_delivery_calendar(supplier)
+        next_order = calculate_delivery_date(Fournisseur(**{**supplier, "delivery_calendar": calendar}), now)
+        calendars.append({
+            "supplier_id": supplier["id"],
+            "supplier_name": supplier.get("nom"),
+            "couleur": supplier.get("couleur"),
+            "logo": supplier.get("logo"),
+            "can_order_today": next_order["can_order_today"],
+            "next_order_date": next_order["next_order_date"].isoformat(),
+            "estimated_delivery_date": next_order["estimated_date"].isoformat(),
+            "explanation": next_order["explanation"],
+            "creneaux": [
+                {key: value.isoformat() for key, value in slot.items()}
+                for slot in calendar_order_slots(calendar, now, days)
+            ]
+        })
+    return {"date_reference": now.isoformat(), "jours": days, "fournisseurs": calendars}
+
 @api_router.get("/suppliers/{supplier_id}/delivery-estimate")
 async def get_delivery_estimate(supplier_id: str):
     """Calculer la date de livraison estimée pour un fournisseur"""
@@ -4946,6 +6296,393 @@ async def get_delivery_estimate(supplier_id: str):
         "explanation": delivery_info['explanation']
     }
 
+# ✅ Planification des besoins matière (MRP)
+# Demande en portions (saisie, ou couverts prévus × mix de ventes historique de sales_daily) → vecteurs BOM
+# (préparations gardées comme feuilles et nettées contre stock_preparations, le reste décomposé en produits
+# bruts) → net du stock, du stock minimum et des commandes ouvertes livrées dans la période → quantités à
+# commander par fournisseur (minimum de commande, date de livraison estimée). Nombre fixe de requêtes,
+# indépendant de la taille du catalogue.
+OPEN_ORDER_STATUSES = ["pending", "confirmed", "in_transit"]
+
+class MrpRequest(BaseModel):
+    date_debut: Optional[datetime] = None  # Début de la période couverte (défaut : maintenant)
+    horizon_jours: int = 7
+    portions: Optional[dict] = None  # recipe_id → portions prévues sur toute la période
+    couverts_par_service: Optional[float] = None  # À défaut de portions : couverts × mix historique
+    services_par_jour: int = 2
+    historique_jours: int = 28  # Fenêtre de ventes utilisée pour le mix
+    inclure_stock_min: bool = True  # Reconstituer aussi quantite_min
+
+async def forecast_recipe_portions(request: MrpRequest) -> tuple:
+    """Portions prévues par recette sur l'horizon (saisies, ou couverts × portions vendues par couvert).
+    
+    Retourne (portions par recette, avertissements sur les ventes de l'historique ignorées).
+    """
+    if request.portions:
+        return {recipe_id: float(quantity) for recipe_id, quantity in request.portions.items() if quantity and quantity > 0}, []
+    if not request.couverts_par_service:
+        raise HTTPException(status_code=400, detail="Indiquer des portions par recette ou des couverts par service")
+    
+    today = sales_day(datetime.utcnow())
+    history_start, history_end = today - timedelta(days=request.historique_jours), today - timedelta(days=1)
+    totals = await aggregate_sales_totals(history_start, history_end)
+    history_covers = totals[0]["nb_couverts"] if totals else 0
+    if not history_covers:
+        raise HTTPException(status_code=400, detail="Aucun couvert dans l'historique des ventes pour établir le mix")
+    
+    expected_covers = request.couverts_par_service * request.services_par_jour * request.horizon_jours
+    portions, unresolved = {}, []
+    for row in await aggregate_sales_items(history_start, history_end):
+        if row["quantite"] <= 0:
+            continue
+        if not row.get("recipe_id"):
+            unresolved.append(row)
+            continue
+        portions[row["recipe_id"]] = portions.get(row["recipe_id"], 0.0) + row["quantite"] / history_covers * expected_covers
+    
+    if not portions:
+        raise HTTPException(status_code=400, detail=(
+            "Aucune vente de l'historique n'est rattachée à une recette : "
+            f"{len(unresolved)} libellés de caisse sans recette (voir /admin/rebuild-z-aliases)"
+        ))
+    warnings = []
+    if unresolved:
+        unresolved.sort(key=lambda row: row["quantite"], reverse=True)
+        names = ", ".join(row["nom"] for row in unresolved[:10]) + ("…" if len(unresolved) > 10 else "")
+        warnings.append(
+            f"{len(unresolved)} libellés vendus sans recette ignorés dans le mix "
+            f"({sum(row['quantite'] for row in unresolved):g} portions) : {names}"
+        )
+    return portions, warnings
+
+def select_supplier_info(candidates: List[dict], product: dict) -> Optional[dict]:
+    """Fournisseur retenu pour un produit : préféré, sinon principal, sinon première relation connue"""
+    main_supplier_id = product.get("main_supplier_id") or product.get("fournisseur_id")
+    preferred = next((info for info in candidates if info.get("is_preferred")), None)
+    main = next((info for info in candidates if info["supplier_id"] == main_supplier_id), None)
+    if preferred or main:
+        return preferred or main
+    if main_supplier_id:
+        return {"supplier_id": main_supplier_id}
+    return candidates[0] if candidates else None
+
+async def load_open_order_quantities(product_ids: List[str], delivered_before: Optional[datetime] = None) -> dict:
+    """Quantités en commande ouverte par produit (unité du produit), livrées avant delivered_before si fourni"""
+    await bom_engine.refresh()
+    query = {"status": {"$in": OPEN_ORDER_STATUSES}, "items.product_id": {"$in": product_ids}}
+    if delivered_before:
+        query["$or"] = [{"estimated_delivery_date": None}, {"estimated_delivery_date": {"$lte": delivered_before}}]
+    wanted = set(product_ids)
+    on_order = {}
+    for order in await db.orders.find(query, {"_id": 0, "items": 1}).to_list(None):
+        for item in order.get("items", []):
+            product_id = item.get("product_id")
+            if product_id in wanted:
+                factor = product_unit_factor(item.get("unit"), bom_engine.products.get(product_id, {})) or 1.0
+                on_order[product_id] = on_order.get(product_id, 0.0) + (item.get("quantity") or 0) * factor
+    return on_order
+
+async def compute_mrp(request: MrpRequest) -> dict:
+    """Besoins nets à commander par fournisseur pour la demande prévue"""
+    if request.horizon_jours < 1:
+        raise HTTPException(status_code=400, detail="L'horizon doit être d'au moins 1 jour")
+    start = request.date_debut or datetime.now()
+    if start.tzinfo is not None:
+        # calculate_delivery_date travaille en heure locale naïve : même référence pour les comparaisons
+        start = start.astimezone().replace(tzinfo=None)
+    end = start + timedelta(days=request.horizon_jours)
+    demand, warnings = await forecast_recipe_portions(request)
+    vectors = await bom_engine.vectors(list(demand.keys()), explode_preparations=False)
+    warnings += [f"Recette {recipe_id} introuvable" for recipe_id in demand if recipe_id not in vectors]
+    
+    # Besoins bruts de la période (produits et préparations)
+    gross = {}
+    for recipe_id, vector in vectors.items():
+        for key, quantity in vector.items():
+            gross[key] = gross.get(key, 0.0) + quantity * demand[recipe_id]
+        warnings.extend(bom_engine.issues.get(recipe_id, []))
+    
+    # Préparations : net du stock préparé, le reste est décomposé en produits bruts
+    preparation_ids = [leaf_id for leaf_type, leaf_id in gross if leaf_type == "preparation"]
+    prepared = {}
+    for stock in await db.stock_preparations.find(
+        {"preparation_id": {"$in": preparation_ids}, "statut": {"$ne": "expire"}},
+        {"_id": 0, "preparation_id": 1, "quantite_actuelle": 1}
+    ).to_list(None):
+        prepared[stock["preparation_id"]] = prepared.get(stock["preparation_id"], 0.0) + (stock.get("quantite_actuelle") or 0)
+    
+    product_gross = {leaf_id: quantity for (leaf_type, leaf_id), quantity in gross.items() if leaf_type == "produit"}
+    preparations = []
+    for preparation_id in preparation_ids:
+        required = gross[("preparation", preparation_id)]
+        to_prepare = max(required - prepared.get(preparation_id, 0.0), 0.0)
+        info = bom_engine.leaf_info(("preparation", preparation_id))
+        preparations.append({
+            "preparation_id": preparation_id,
+            "preparation_nom": info["nom"],
+            "unite": info["unite"],
+            "besoin_brut": round(required, 3),
+            "stock_prepare": round(prepared.get(preparation_id, 0.0), 3),
+            "a_preparer": round(to_prepare, 3)
+        })
+        if to_prepare <= 0:
+            continue
+        sub_vector = bom_engine.preparation_vector(preparation_id, warnings)
+        if sub_vector is None:
+            warnings.append(f"Préparation {info['nom']} non décomposable en produits bruts")
+            continue
+        for (_, product_id), quantity in sub_vector.items():
+            product_gross[product_id] = product_gross.get(product_id, 0.0) + quantity * to_prepare
+    
+    # Stock, commandes ouvertes livrées avant la fin de la période, relations fournisseurs (requêtes groupées)
+    product_ids = list(product_gross.keys())
+    stocks = {
+        stock["produit_id"]: stock
+        for stock in await db.stocks.find(
+            {"produit_id": {"$in": product_ids}}, {"_id": 0, "produit_id": 1, "quantite_actuelle": 1, "quantite_min": 1}
+        ).to_list(None)
+    }
+    on_order = await load_open_order_quantities(product_ids, end)
+    
+    infos_by_product = {}
+    for info in await db.supplier_product_info.find(
+        {"product_id": {"$in": product_ids}},
+        {"_id": 0, "product_id": 1, "supplier_id": 1, "price": 1, "is_preferred": 1, "min_order_quantity": 1}
+    ).to_list(None):
+        infos_by_product.setdefault(info["product_id"], []).append(info)
+    products = {
+        product["id"]: product
+        for product in await db.produits.find(
+            {"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "main_supplier_id": 1, "fournisseur_id": 1, "reference_price": 1}
+        ).to_list(None)
+    }
+    
+    # Net par produit
+    lines = []
+    for product_id, required in product_gross.items():
+        stock = stocks.get(product_id, {})
+        available = stock.get("quantite_actuelle") or 0
+        safety = (stock.get("quantite_min") or 0) if request.inclure_stock_min else 0
+        net = required + safety - available - on_order.get(product_id, 0.0)
+        if net <= 1e-9:
+            continue
+        product = products.get(product_id, {})
+        info = select_supplier_info(infos_by_product.get(product_id, []), product) or {}
+        min_order = info.get("min_order_quantity") or 0
+        quantity = max(net, min_order)
+        unit_price = info["price"] if info.get("price") is not None else product.get("reference_price") or 0
+        leaf = bom_engine.leaf_info(("produit", product_id))
+        lines.append((info.get("supplier_id"), {
+            "produit_id": product_id,
+            "produit_nom": leaf["nom"],
+            "unite": leaf["unite"],
+            "besoin_brut": round(required, 3),
+            "stock_actuel": round(available, 3),
+            "stock_min": round(safety, 3),
+            "en_commande": round(on_order.get(product_id, 0.0), 3),
+            "besoin_net": round(net, 3),
+            "minimum_commande": min_order or None,
+            "quantite_a_commander": round(quantity, 3),
+            "prix_unitaire": unit_price,
+            "total": round(quantity * unit_price, 2)
+        }))
+    
+    # Regroupement par fournisseur avec date de livraison estimée
+    suppliers = {
+        supplier["id"]: supplier
+        for supplier in await db.fournisseurs.find(
+            {"id": {"$in": list({supplier_id for supplier_id, _ in lines if supplier_id})}}, {"_id": 0}
+        ).to_list(None)
+    }
+    lines_by_supplier = {}
+    for supplier_id, line in lines:
+        lines_by_supplier.setdefault(supplier_id if supplier_id in suppliers else None, []).append(line)
+    
+    groups = []
+    for supplier_id, supplier_lines in lines_by_supplier.items():
+        supplier = suppliers.get(supplier_id)
+        delivery = calculate_delivery_date(Fournisseur(**supplier)) if supplier else None
+        groups.append({
+            "supplier_id": supplier_id,
+            "supplier_name": supplier["nom"] if supplier else "Sans fournisseur",
+            "lignes": sorted(supplier_lines, key=lambda line: line["produit_nom"]),
+            "total_estime": round(sum(line["total"] for line in supplier_lines), 2),
+            "date_commande": delivery["next_order_date"] if delivery else None,
+            "commander_aujourd_hui": delivery["can_order_today"] if delivery else None,
+            "date_livraison_estimee": delivery["estimated_date"] if delivery else None,
+            "livre_avant_debut": delivery["estimated_date"] <= start if delivery else None,
+            "explication_livraison": delivery["explanation"] if delivery else None
+        })
+    groups.sort(key=lambda group: (group["supplier_id"] is None, group["supplier_name"]))
+    
+    return {
+        "periode": {"debut": start, "fin": end, "horizon_jours": request.horizon_jours},
+        "demande": [
+            {"recette_id": recipe_id, "recette_nom": bom_engine.recipes[recipe_id]["nom"], "portions": round(demand[recipe_id], 2)}
+            for recipe_id in vectors
+        ],
+        "preparations": preparations,
+        "fournisseurs": groups,
+        "total_estime": round(sum(group["total_estime"] for group in groups), 2),
+        "avertissements": list(dict.fromkeys(warnings))
+    }
+
+@api_router.post("/orders/mrp")
+async def plan_material_requirements(request: MrpRequest):
+    """Quantités à commander par fournisseur pour couvrir la demande prévue (portions ou couverts)"""
+    return await compute_mrp(request)
+
+# ✅ Propositions de commandes : brouillons par fournisseur, à confirmer par le gérant
+# Stocks sous quantite_min (une agrégation avec produit et relations fournisseurs) réapprovisionnés
+# jusqu'à quantite_max (sinon quantite_min), fusionnés avec les manques projetés du MRP si une
+# prévision est fournie. Une commande "draft" par fournisseur, datée selon ses DeliveryRules : le brouillon
+# automatique existant du fournisseur est mis à jour (upsert), jamais doublé par une nouvelle génération.
+ORDER_PROPOSAL_SOURCE = "proposition_auto"
+
+class OrderProposalRequest(BaseModel):
+    prevision: Optional[MrpRequest] = None  # Ajoute les manques projetés sur la période
+    remplacer_brouillons: bool = True  # Supprime les brouillons automatiques des fournisseurs sans besoin
+
+async def load_low_stock_needs() -> List[dict]:
+    """Produits sous leur stock minimum avec la quantité à commander pour revenir au niveau cible"""
+    pipeline = [
+        {"$match": {"$expr": {"$lte": [{"$ifNull": ["$quantite_actuelle", 0]}, {"$ifNull": ["$quantite_min", 0]}]}}},
+        {"$lookup": {"from": "produits", "localField": "produit_id", "foreignField": "id", "as": "produit"}},
+        {"$lookup": {"from": "supplier_product_info", "localField": "produit_id", "foreignField": "product_id", "as": "relations"}},
+        {"$project": {
+            "_id": 0, "produit_id": 1, "quantite_actuelle": 1, "quantite_min": 1, "quantite_max": 1, "relations": 1,
+            "produit": {"$arrayElemAt": ["$produit", 0]}
+        }}
+    ]
+    rows = await db.stocks.aggregate(pipeline).to_list(None)
+    on_order = await load_open_order_quantities([row["produit_id"] for row in rows])
+    
+    needs = []
+    for row in rows:
+        product = row.get("produit") or {}
+        target = row.get("quantite_max") or row.get("quantite_min") or 0
+        quantity = target - (row.get("quantite_actuelle") or 0) - on_order.get(row["produit_id"], 0.0)
+        if quantity <= 1e-9 or not product:
+            continue
+        info = select_supplier_info(row.get("relations") or [], product) or {}
+        unit_price = info["price"] if info.get("price") is not None else product.get("reference_price") or 0
+        needs.append({
+            "supplier_id": info.get("supplier_id"),
+            "produit_id": row["produit_id"],
+            "produit_nom": product.get("nom", "Produit inconnu"),
+            "unite": product.get("unite"),
+            "quantite": max(quantity, info.get("min_order_quantity") or 0),
+            "prix_unitaire": unit_price
+        })
+    return needs
+
+async def generate_order_proposals(request: OrderProposalRequest) -> dict:
+    """Construire et enregistrer les brouillons de commande par fournisseur"""
+    needs = {need["produit_id"]: need for need in await load_low_stock_needs()}
+    warnings = []
+    if request.prevision:
+        mrp = await compute_mrp(request.prevision)
+        warnings = mrp["avertissements"]
+        for group in mrp["fournisseurs"]:
+            for line in group["lignes"]:
+                current = needs.get(line["produit_id"])
+                # Même produit en stock bas et en manque projeté : la plus grande quantité l'emporte
+                if current and current["quantite"] >= line["quantite_a_commander"]:
+                    continue
+                needs[line["produit_id"]] = {
+                    "supplier_id": group["supplier_id"],
+                    "produit_id": line["produit_id"],
+                    "produit_nom": line["produit_nom"],
+                    "unite": line["unite"],
+                    "quantite": line["quantite_a_commander"],
+                    "prix_unitaire": line["prix_unitaire"]
+                }
+    
+    suppliers = {
+        supplier["id"]: supplier
+        for supplier in await db.fournisseurs.find(
+            {"id": {"$in": list({need["supplier_id"] for need in needs.values() if need["supplier_id"]})}}, {"_id": 0}
+        ).to_list(None)
+    }
+    lines_by_supplier, unassigned = {}, []
+    for need in sorted(needs.values(), key=lambda need: need["produit_nom"]):
+        if need["supplier_id"] in suppliers:
+            lines_by_supplier.setdefault(need["supplier_id"], []).append(need)
+        else:
+            unassigned.append({**need, "quantite": round(need["quantite"], 3)})
+    
+    orders = []
+    for supplier_id, supplier_lines in lines_by_supplier.items():
+        supplier = suppliers[supplier_id]
+        delivery = calculate_delivery_date(Fournisseur(**supplier))
+        items = [
+            OrderItem(
+                product_id=line["produit_id"],
+                product_name=line["produit_nom"],
+                quantity=round(line["quantite"], 3),
+                unit=line["unite"] or "unité",
+                unit_price=line["prix_unitaire"],
+                total_price=round(round(line["quantite"], 3) * line["prix_unitaire"], 2)
+            )
+            for line in supplier_lines
+        ]
+        orders.append(Order(
+            order_number=f"CMD-{datetime.now().strftime('%Y%m%d')}-{str(uuid.uuid4())[:6].upper()}",
+            supplier_id=supplier_id,
+            supplier_name=supplier["nom"],
+            items=items,
+            total_amount=round(sum(item.total_price for item in items), 2),
+            order_date=delivery["next_order_date"],
+            estimated_delivery_date=delivery["estimated_date"],
+            status="draft",
+            notes=f"Proposition automatique - {delivery['explanation']}",
+            source=ORDER_PROPOSAL_SOURCE
+        ))
+    
+    # Un brouillon automatique par fournisseur : mis à jour s'il existe (même id, même numéro), créé sinon
+    draft_filter = {"status": "draft", "source": ORDER_PROPOSAL_SOURCE}
+    replaced = 0
+    if orders:
+        result = await db.orders.bulk_write([
+            UpdateOne({**draft_filter, "supplier_id": order.supplier_id}, {
+                "$set": order.dict(exclude={"id", "order_number", "created_at"}),
+                "$setOnInsert": {"id": order.id, "order_number": order.order_number, "created_at": order.created_at}
+            }, upsert=True)
+            for order in orders
+        ], ordered=False)
+        replaced = result.matched_count
+        orders = [
+            Order(**order)
+            for order in await db.orders.find(
+                {**draft_filter, "supplier_id": {"$in": list(lines_by_supplier)}}, {"_id": 0}
+            ).sort("supplier_name", 1).to_list(None)
+        ]
+    if request.remplacer_brouillons:
+        result = await db.orders.delete_many({**draft_filter, "supplier_id": {"$nin": list(lines_by_supplier)}})
+        replaced += result.deleted_count
+    
+    return {
+        "commandes": orders,
+        "sans_fournisseur": unassigned,
+        "total_estime": round(sum(order.total_amount for order in orders), 2),
+        "brouillons_remplaces": replaced,
+        "avertissements": warnings
+    }
+
+@api_router.post("/orders/proposals")
+async def create_order_proposals(request: OrderProposalRequest):
+    """Générer les brouillons de commande (stocks bas + manques projetés) par fournisseur"""
+    return await generate_order_proposals(request)
+
+@api_router.post("/orders/proposals/confirm")
+async def confirm_order_proposals(order_ids: List[str]):
+    """Confirmer des brouillons : ils passent au statut pending"""
+    result = await db.orders.update_many(
+        {"id": {"$in": order_ids}, "status": "draft"},
+        {"$set": {"status": "pending", "updated_at": datetime.utcnow()}}
+    )
+    return {"message": f"{result.modified_count} commande(s) confirmée(s)", "confirmed_count": result.modified_count}
+
 # Routes pour les Préparations
 @api_router.post("/preparations", response_model=Preparation)
 async def create_preparation(prep_data: PreparationCreate):
@@ -4955,13 +6692,16 @@ async def create_preparation(prep_data: PreparationCreate):
     if not produit:
         raise HTTPException(status_code=404, detail="Produit non trouvé")
     
-    # Créer la préparation
+    # Créer la préparation (unités standardisées)
+    prep_dict = prep_data.dict()
+    prep_dict.update({field: canonical_unit(prep_dict[field]) for field in PREPARATION_UNIT_FIELDS})
     preparation = Preparation(
-        **prep_data.dict(),
+        **prep_dict,
         produit_nom=produit["nom"]
     )
     
     await db.preparations.insert_one(preparation.dict())
+    await bump_cache_version("preparations")
     return preparation
 
 @api_router.get("/preparations", response_model=List[Preparation])
@@ -5004,6 +6744,7 @@ async def update_preparation(preparation_id: str, prep_data: PreparationCreate):
             raise HTTPException(status_code=400, detail="L'unité est obligatoire")
         
         update_data = prep_data.dict()
+        update_data.update({field: canonical_unit(update_data[field]) for field in PREPARATION_UNIT_FIELDS})
         update_data["produit_nom"] = produit["nom"]
         update_data["updated_at"] = datetime.utcnow()
         
@@ -5014,6 +6755,7 @@ async def update_preparation(preparation_id: str, prep_data: PreparationCreate):
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Préparation non trouvée")
+        await bump_cache_version("preparations")
         
         updated_prep = await db.preparations.find_one({"id": preparation_id})
         return Preparation(**updated_prep)
@@ -5028,6 +6770,7 @@ async def delete_preparation(preparation_id: str):
     result = await db.preparations.delete_one({"id": preparation_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Préparation non trouvée")
+    await bump_cache_version("preparations")
     return {"message": "Préparation supprimée"}
 
 @api_router.get("/preparations/dlc/alerts")
@@ -5086,6 +6829,7 @@ async def auto_generate_preparations():
         
         # Supprimer toutes les préparations existantes avant régénération
         await db.preparations.delete_many({})
+        await bump_cache_version("preparations")
         
         preparations_created = []
         
@@ -5179,6 +6923,7 @@ async def auto_generate_preparations():
                 )
                 
                 await db.preparations.insert_one(preparation.dict())
+                await bump_cache_version("preparations")
                 preparations_created.append(preparation.nom)
         
         return {
@@ -5204,6 +6949,7 @@ async def auto_generate_preparations():
 @api_router.post("/produits", response_model=Produit)
 async def create_produit(produit: ProduitCreate):
     produit_dict = produit.dict()
+    produit_dict["unite"] = canonical_unit(produit.unite)
     
     # ✅ V3 Enhancement: Set reference_price if not provided (backward compatibility)
     if not produit_dict.get("reference_price"):
@@ -5217,6 +6963,7 @@ async def create_produit(produit: ProduitCreate):
     
     produit_obj = Produit(**produit_dict)
     await db.produits.insert_one(produit_obj.dict())
+    await bump_cache_version("produits")
     
     # Créer automatiquement une entrée stock à 0
     stock_obj = Stock(produit_id=produit_obj.id, produit_nom=produit_obj.nom, quantite_actuelle=0.0)
@@ -5225,9 +6972,21 @@ async def create_produit(produit: ProduitCreate):
     return produit_obj
 
 @api_router.get("/produits", response_model=List[Produit])
-async def get_produits():
-    produits = await db.produits.find().to_list(1000)
-    return [Produit(**p) for p in produits]
+async def get_produits(
+    response: Response,
+    categorie: Optional[str] = None,
+    supplier_id: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None
+):
+    """Liste des produits triés par nom (pagination par curseur)"""
+    query = {}
+    if categorie:
+        query["categorie"] = categorie
+    if supplier_id:
+        query["$or"] = [{"main_supplier_id": supplier_id}, {"fournisseur_id": supplier_id}]
+    
+    return await paginate(db.produits, query, "nom", False, limit, cursor, response)
 
 @api_router.get("/produits/by-categories")
 async def get_produits_by_categories():
@@ -5305,6 +7064,7 @@ async def update_produit(produit_id: str, produit: ProduitCreate):
             raise HTTPException(status_code=400, detail="La catégorie est obligatoire")
         
         produit_dict = produit.dict()
+        produit_dict["unite"] = canonical_unit(produit.unite)
         
         # Récupérer le nom du fournisseur si spécifié
         if produit.fournisseur_id:
@@ -5319,6 +7079,7 @@ async def update_produit(produit_id: str, produit: ProduitCreate):
         )
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Produit non trouvé")
+        await bump_cache_version("produits")
         
         updated_produit = await db.produits.find_one({"id": produit_id})
         
@@ -5343,13 +7104,20 @@ async def delete_produit(produit_id: str):
     result = await db.produits.delete_one({"id": produit_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Produit non trouvé")
+    await bump_cache_version("produits")
     return {"message": "Produit supprimé"}
 
 # Routes pour les stocks
 @api_router.get("/stocks", response_model=List[Stock])
-async def get_stocks():
-    stocks = await db.stocks.find().to_list(1000)
-    return [Stock(**s) for s in stocks]
+async def get_stocks(
+    response: Response,
+    produit_id: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None
+):
+    """Liste des stocks triés par nom de produit (pagination par curseur)"""
+    query = {"produit_id": produit_id} if produit_id else {}
+    return await paginate(db.stocks, query, "produit_nom", False, limit, cursor, response)
 
 @api_router.get("/stocks/{produit_id}", response_model=Stock)
 async def get_stock(produit_id: str):
@@ -5390,13 +7158,27 @@ async def get_stocks_critiques():
 @api_router.put("/stocks/{produit_id}", response_model=Stock)
 async def update_stock(produit_id: str, stock_update: StockUpdate):
     update_dict = {k: v for k, v in stock_update.dict().items() if v is not None}
-    update_dict["derniere_maj"] = datetime.utcnow()
-    
-    result = await db.stocks.update_one(
-        {"produit_id": produit_id},
-        {"$set": update_dict}
-    )
-    if result.matched_count == 0:
+    quantite = update_dict.pop("quantite_actuelle", None)
+    
+    if quantite is not None:
+        # Correction d'inventaire : passe par le ledger (mouvement "ajustement" au nouveau niveau)
+        applied = await set_stock_level(
+            produit_id, quantite,
+            MouvementStock(produit_id=produit_id, type="ajustement", quantite=round_stock_quantity(max(0, quantite)),
+                           commentaire="Correction d'inventaire"),
+            extra_fields=update_dict
+        )
+        matched = applied is not None
+    else:
+        update_dict["derniere_maj"] = datetime.utcnow()
+        result = await db.stocks.update_one(
+            {"produit_id": produit_id},
+            {"$set": update_dict}
+        )
+        matched = result.matched_count > 0
+        if matched:
+            await refresh_stock_alerts([produit_id])
+    if not matched:
         raise HTTPException(status_code=404, detail="Stock non trouvé")
     
     updated_stock = await db.stocks.find_one({"produit_id": produit_id})
@@ -5411,22 +7193,31 @@ async def create_mouvement(mouvement: MouvementCreate):
     produit = await db.produits.find_one({"id": mouvement.produit_id})
     if produit:
         mouvement_dict["produit_nom"] = produit["nom"]
+        # Quantité saisie dans une autre unité : convertie dans l'unité de stock du produit
+        if mouvement.unite:
+            factor = product_unit_factor(mouvement.unite, produit)
+            if factor is None:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Unité '{mouvement.unite}' non convertible en '{produit.get('unite')}' pour {produit['nom']}"
+                )
+            mouvement_dict["quantite"] = mouvement.quantite * factor
+    quantite = mouvement_dict["quantite"]
     
     # Créer le mouvement
     # On retire les champs spécifiques au batch (dlc, lot, unite) qui ne sont pas dans MouvementStock
     mouvement_stock_dict = {k: v for k, v in mouvement_dict.items() if k not in ['dlc', 'lot', 'unite']}
     mouvement_obj = MouvementStock(**mouvement_stock_dict)
-    await db.mouvements_stock.insert_one(mouvement_obj.dict())
     
     # Gestion des Lots (Batches) pour les entrées
-    if mouvement.type == "entree" and mouvement.quantite > 0:
+    if mouvement.type == "entree" and quantite > 0:
         # Si une DLC ou un Lot est spécifié, ou pour tout suivi de traçabilité
         # On crée systématiquement un batch pour chaque entrée pour permettre le FIFO/FEFO
         
         batch_data = {
             "product_id": mouvement.produit_id,
-            "quantity": mouvement.quantite,
-            "quantity_brute": mouvement.quantite,
+            "quantity": quantite,
+            "quantity_brute": quantite,
             "expiry_date": mouvement.dlc,
             "batch_number": mouvement.lot,
             "supplier_id": mouvement.fournisseur_id,
@@ -5442,72 +7233,41 @@ async def create_mouvement(mouvement: MouvementCreate):
         batch_obj = ProductBatch(**batch_data)
         await db.product_batches.insert_one(batch_obj.dict())
 
-    # Mettre à jour le stock (arrondi à 0.01)
-    stock = await db.stocks.find_one({"produit_id": mouvement.produit_id})
-    if stock:
-        nouvelle_quantite = round_stock_quantity(stock["quantite_actuelle"])
-        quantite_mouvement = round_stock_quantity(mouvement.quantite)
-        
-        if mouvement.type == "entree":
-            nouvelle_quantite = round_stock_quantity(nouvelle_quantite + quantite_mouvement)
-        elif mouvement.type == "sortie":
-            nouvelle_quantite = round_stock_quantity(nouvelle_quantite - quantite_mouvement)
-            
-            # Gestion FIFO/FEFO pour la sortie de stock (consommation des lots)
-            # On essaie de déduire la quantité des lots existants (priorité DLC la plus proche ou plus ancien)
-            remaining_qty_to_remove = quantite_mouvement
-            
-            # Récupérer les lots disponibles triés par DLC (si existe) ou date de réception
-            batches = await db.product_batches.find({
-                "product_id": mouvement.produit_id, 
-                "is_consumed": False,
-                "quantity": {"$gt": 0}
-            }).sort([("expiry_date", 1), ("received_date", 1)]).to_list(length=100)
-            
-            for batch in batches:
-                if remaining_qty_to_remove <= 0:
-                    break
-                    
-                qty_in_batch = batch["quantity"]
-                if qty_in_batch >= remaining_qty_to_remove:
-                    # Ce lot suffit pour couvrir le reste
-                    new_batch_qty = qty_in_batch - remaining_qty_to_remove
-                    await db.product_batches.update_one(
-                        {"id": batch["id"]},
-                        {"$set": {
-                            "quantity": new_batch_qty, 
-                            "is_consumed": new_batch_qty <= 0
-                        }}
-                    )
-                    remaining_qty_to_remove = 0
-                else:
-                    # Ce lot est vidé, mais il en faut encore
-                    remaining_qty_to_remove -= qty_in_batch
-                    await db.product_batches.update_one(
-                        {"id": batch["id"]},
-                        {"$set": {
-                            "quantity": 0, 
-                            "is_consumed": True
-                        }}
-                    )
-
-        elif mouvement.type == "ajustement":
-            nouvelle_quantite = quantite_mouvement
-            # Pour l'ajustement, c'est complexe de réconcilier les lots.
-            # Idéalement il faudrait spécifier QUEL lot on ajuste.
-            # Pour l'instant, on laisse désynchronisé ou on alerte l'utilisateur.
-        
-        await db.stocks.update_one(
-            {"produit_id": mouvement.produit_id},
-            {"$set": {"quantite_actuelle": round_stock_quantity(max(0, nouvelle_quantite)), "derniere_maj": datetime.utcnow()}}
-        )
+    # Mettre à jour le stock (arrondi à 0.01) et journaliser le mouvement, même sans ligne de stock.
+    # Les sorties consomment les lots en FEFO (lots consommés renvoyés dans mouvement.lots)
+    quantite_mouvement = round_stock_quantity(quantite)
+    if mouvement.type == "ajustement":
+        # Pour l'ajustement, c'est complexe de réconcilier les lots.
+        # Idéalement il faudrait spécifier QUEL lot on ajuste.
+        # Pour l'instant, on laisse désynchronisé ou on alerte l'utilisateur.
+        await set_stock_level(mouvement.produit_id, quantite_mouvement, mouvement_obj, record_if_missing=True)
+    else:
+        delta = quantite_mouvement if mouvement.type == "entree" else -quantite_mouvement if mouvement.type == "sortie" else 0
+        await apply_stock_delta(mouvement.produit_id, delta, mouvement_obj, record_if_missing=True)
     
     return mouvement_obj
 
 @api_router.get("/mouvements", response_model=List[MouvementStock])
-async def get_mouvements():
-    mouvements = await db.mouvements_stock.find().sort("date", -1).to_list(1000)
-    return [MouvementStock(**m) for m in mouvements]
+async def get_mouvements(
+    response: Response,
+    produit_id: Optional[str] = None,
+    type: Optional[str] = None,
+    fournisseur_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None
+):
+    """Mouvements de stock, plus récents d'abord (pagination par curseur et filtres côté serveur)"""
+    query = date_range_filter("date", date_from, date_to)
+    if produit_id:
+        query["produit_id"] = produit_id
+    if type:
+        query["type"] = type
+    if fournisseur_id:
+        query["fournisseur_id"] = fournisseur_id
+    
+    return await paginate(db.mouvements_stock, query, "date", True, limit, cursor, response)
 
 # Routes pour les recettes (Productions)
 @api_router.get("/categories-production")
@@ -5560,6 +7320,7 @@ async def create_recette(recette: RecetteCreate):
     
     recette_obj = Recette(**recette_dict)
     await db.recettes.insert_one(recette_obj.dict())
+    await bump_cache_version("recettes")
     return recette_obj
 
 @api_router.get("/recettes", response_model=List[Recette])
@@ -5572,6 +7333,86 @@ async def get_recettes(categorie: Optional[str] = None):
     recettes = await db.recettes.find(query).to_list(1000)
     return [Recette(**r) for r in recettes]
 
+# ✅ Capacité de production de toute la carte en un calcul matriciel
+class ProductionCapacityRequest(BaseModel):
+    recipe_ids: Optional[List[str]] = None  # Sous-ensemble de recettes (toutes si absent)
+    stock_overrides: Optional[dict] = None  # Simulation : produit_id → quantité en stock
+    target_portions: Optional[int] = None  # Manques calculés pour cet objectif (sinon : portion suivante)
+
+async def compute_production_capacity(recipe_ids: Optional[List[str]] = None, stock_overrides: Optional[dict] = None,
+                                      target_portions: Optional[int] = None) -> List[dict]:
+    """Portions max, ingrédient limitant et manques pour chaque recette (matrice recettes × produits)"""
+    vectors = await bom_engine.vectors(recipe_ids)
+    recipe_ids = list(vectors.keys())
+    product_ids = sorted({leaf_id for vector in vectors.values() for leaf_type, leaf_id in vector if leaf_type == "produit"})
+    product_index = {pid: i for i, pid in enumerate(product_ids)}
+    
+    # Besoins par portion : une ligne par recette, une colonne par produit brut
+    requirements = np.zeros((len(recipe_ids), len(product_ids)))
+    undecomposable = np.zeros(len(recipe_ids), dtype=bool)
+    for r_i, recipe_id in enumerate(recipe_ids):
+        for (leaf_type, leaf_id), quantity in vectors[recipe_id].items():
+            if leaf_type == "produit":
+                requirements[r_i, product_index[leaf_id]] += quantity
+            else:
+                undecomposable[r_i] = True
+    
+    # Stock disponible (une requête), éventuellement surchargé pour simulation
+    stock_levels = {
+        stock["produit_id"]: stock.get("quantite_actuelle", 0) or 0
+        for stock in await db.stocks.find(
+            {"produit_id": {"$in": product_ids}}, {"_id": 0, "produit_id": 1, "quantite_actuelle": 1}
+        ).to_list(None)
+    }
+    stock_levels.update({pid: float(qty) for pid, qty in (stock_overrides or {}).items()})
+    available = np.array([stock_levels.get(pid, 0.0) for pid in product_ids], dtype=float)
+    
+    needed = requirements > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = np.where(needed, available[np.newaxis, :] / np.where(needed, requirements, 1.0), np.inf)
+    limiting = np.argmin(ratios, axis=1) if product_ids else np.zeros(len(recipe_ids), dtype=int)
+    min_ratio = ratios.min(axis=1) if product_ids else np.full(len(recipe_ids), np.inf)
+    # Sans besoin connu ou avec une préparation non décomposable : capacité 0 (comme l'endpoint unitaire)
+    portions_max = np.where(np.isfinite(min_ratio) & ~undecomposable, np.floor(min_ratio), 0).astype(int)
+    
+    targets = np.array([target_portions] * len(recipe_ids), dtype=float) if target_portions else portions_max + 1.0
+    shortfalls = np.maximum(requirements * targets[:, np.newaxis] - available[np.newaxis, :], 0)
+    
+    results = []
+    for r_i, recipe_id in enumerate(recipe_ids):
+        limiting_id = product_ids[limiting[r_i]] if product_ids and np.isfinite(min_ratio[r_i]) else None
+        results.append({
+            "recette_id": recipe_id,
+            "recette_nom": bom_engine.recipes[recipe_id]["nom"],
+            "portions_max": int(portions_max[r_i]),
+            "ingredient_limitant": {
+                "produit_id": limiting_id,
+                "produit_nom": bom_engine.leaf_info(("produit", limiting_id))["nom"]
+            } if limiting_id else None,
+            "objectif_portions": int(targets[r_i]),
+            "manques": [
+                {
+                    "produit_id": product_ids[p_i],
+                    "produit_nom": bom_engine.leaf_info(("produit", product_ids[p_i]))["nom"],
+                    "quantite_manquante": round(float(shortfalls[r_i, p_i]), 3),
+                    "unite": bom_engine.leaf_info(("produit", product_ids[p_i]))["unite"]
+                }
+                for p_i in np.nonzero(shortfalls[r_i] > 0)[0]
+            ],
+            "avertissements": bom_engine.issues.get(recipe_id, [])
+        })
+    return results
+
+@api_router.get("/recettes/production-capacity", response_model=List[dict])
+async def get_menu_production_capacity(recipe_ids: Optional[List[str]] = Query(None), target_portions: Optional[int] = None):
+    """Capacité de production de toutes les recettes (ou d'un sous-ensemble) avec le stock actuel"""
+    return await compute_production_capacity(recipe_ids, None, target_portions)
+
+@api_router.post("/recettes/production-capacity", response_model=List[dict])
+async def simulate_menu_production_capacity(request: ProductionCapacityRequest):
+    """Capacité de production avec surcharge de stock (simulation « et si »)"""
+    return await compute_production_capacity(request.recipe_ids, request.stock_overrides, request.target_portions)
+
 @api_router.get("/recettes/{recette_id}", response_model=Recette)
 async def get_recette(recette_id: str):
     recette = await db.recettes.find_one({"id": recette_id})
@@ -5606,6 +7447,7 @@ async def update_recette(recette_id: str, recette_update: RecetteUpdate):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Recette non trouvée")
+    await bump_cache_version("recettes")
     
     updated_recette = await db.recettes.find_one({"id": recette_id})
     return Recette(**updated_recette)
@@ -5615,52 +7457,56 @@ async def delete_recette(recette_id: str):
     result = await db.recettes.delete_one({"id": recette_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Recette non trouvée")
+    await bump_cache_version("recettes")
     return {"message": "Recette supprimée"}
 
 # Calculateur de production de recettes
 @api_router.get("/recettes/{recette_id}/production-capacity")
 async def get_recipe_production_capacity(recette_id: str):
-    """Calculer combien de portions peuvent être produites avec le stock actuel"""
+    """Calculer combien de portions peuvent être produites avec le stock actuel (besoins bruts via le moteur BOM)"""
     recette = await db.recettes.find_one({"id": recette_id})
     if not recette:
         raise HTTPException(status_code=404, detail="Recette non trouvée")
     
-    # Récupérer tous les stocks des ingrédients
+    # Besoins bruts par portion (préparations décomposées) et stocks en une requête
+    vector = (await bom_engine.vectors([recette_id])).get(recette_id, {})
+    stocks = {
+        stock["produit_id"]: stock.get("quantite_actuelle", 0)
+        for stock in await db.stocks.find(
+            {"produit_id": {"$in": [leaf_id for leaf_type, leaf_id in vector if leaf_type == "produit"]}},
+            {"_id": 0, "produit_id": 1, "quantite_actuelle": 1}
+        ).to_list(None)
+    }
+    
     min_portions = float('inf')
     ingredient_status = []
     
-    for ingredient in recette.get("ingredients", []):
-        stock = await db.stocks.find_one({"produit_id": ingredient["produit_id"]})
-        if stock:
+    for key, quantite_requise_par_portion in vector.items():
+        leaf = bom_engine.leaf_info(key)
+        leaf_type, leaf_id = key
+        if leaf_type == "produit" and leaf_id in stocks:
             # Calculer combien de portions possibles avec cet ingrédient
-            quantite_disponible = stock["quantite_actuelle"]
-            quantite_requise_par_portion = ingredient["quantite"] / recette["portions"]
+            quantite_disponible = stocks[leaf_id]
             
             if quantite_requise_par_portion > 0:
                 portions_possibles = int(quantite_disponible / quantite_requise_par_portion)
                 min_portions = min(min_portions, portions_possibles)
             else:
                 portions_possibles = float('inf')
-            
-            ingredient_status.append({
-                "produit_nom": ingredient.get("produit_nom", "Produit inconnu"),
-                "quantite_disponible": quantite_disponible,
-                "quantite_requise_par_portion": quantite_requise_par_portion,
-                "quantite_requise_total": quantite_requise_par_portion * 1,  # Pour 1 portion
-                "portions_possibles": portions_possibles,
-                "unite": ingredient["unite"]
-            })
         else:
-            # Ingrédient non en stock
+            # Ingrédient non en stock (ou préparation non décomposable)
+            quantite_disponible = 0
+            portions_possibles = 0
             min_portions = 0
-            ingredient_status.append({
-                "produit_nom": ingredient.get("produit_nom", "Produit inconnu"),
-                "quantite_disponible": 0,
-                "quantite_requise_par_portion": ingredient["quantite"] / recette["portions"],
-                "quantite_requise_total": ingredient["quantite"] / recette["portions"],
-                "portions_possibles": 0,
-                "unite": ingredient["unite"]
-            })
+        
+        ingredient_status.append({
+            "produit_nom": leaf["nom"],
+            "quantite_disponible": quantite_disponible,
+            "quantite_requise_par_portion": quantite_requise_par_portion,
+            "quantite_requise_total": quantite_requise_par_portion * 1,  # Pour 1 portion
+            "portions_possibles": portions_possibles,
+            "unite": leaf["unite"]
+        })
     
     if min_portions == float('inf'):
         min_portions = 0
@@ -5668,7 +7514,8 @@ async def get_recipe_production_capacity(recette_id: str):
     return {
         "recette_nom": recette["nom"],
         "portions_max": max(0, int(min_portions)),
-        "ingredients_status": ingredient_status
+        "ingredients_status": ingredient_status,
+        "avertissements": bom_engine.issues.get(recette_id, [])
     }
 
 # Routes pour l'export/import Excel
@@ -5732,6 +7579,7 @@ async def import_stocks(file: UploadFile = File(...)):
         
         imported_count = 0
         errors = []
+        imported_ids = []
         
         for index, row in df.iterrows():
             try:
@@ -5751,21 +7599,21 @@ async def import_stocks(file: UploadFile = File(...)):
                 quantite_max = row.get("Quantité Max")
                 quantite_max = float(quantite_max) if quantite_max and str(quantite_max) != 'nan' else None
                 
-                await db.stocks.update_one(
-                    {"produit_id": produit_id},
-                    {"$set": {
-                        "quantite_actuelle": quantite_actuelle,
-                        "quantite_min": quantite_min,
-                        "quantite_max": quantite_max,
-                        "derniere_maj": datetime.utcnow()
-                    }}
+                await set_stock_level(
+                    produit_id, quantite_actuelle,
+                    MouvementStock(produit_id=produit_id, produit_nom=produit.get("nom"), type="ajustement",
+                                   quantite=round_stock_quantity(max(0, quantite_actuelle)), commentaire="Import Excel des stocks"),
+                    extra_fields={"quantite_min": quantite_min, "quantite_max": quantite_max},
+                    refresh_alerts=False
                 )
+                imported_ids.append(produit_id)
                 
                 imported_count += 1
                 
             except Exception as e:
                 errors.append(f"Ligne {index + 2}: {str(e)}")
         
+        await refresh_stock_alerts(imported_ids)
         return {
             "message": f"{imported_count} lignes importées avec succès",
             "errors": errors
@@ -5880,6 +7728,7 @@ async def import_global_excel(file: UploadFile = File(...)):
                             fournisseur_nom=supplier_name if supplier_id else None
                         )
                         await db.produits.insert_one(new_prod.dict())
+                        await bump_cache_version("produits")
                         
                         # Créer stock à 0
                         stock = Stock(produit_id=new_prod.id, produit_nom=nom, quantite_actuelle=0)
@@ -5970,10 +7819,12 @@ async def import_recettes(file: UploadFile = File(...)):
                         {"nom": nom_recette},
                         {"$set": recette_data}
                     )
+                    await bump_cache_version("recettes")
                 else:
                     # Créer une nouvelle recette
                     recette_obj = Recette(**recette_data)
                     await db.recettes.insert_one(recette_obj.dict())
+                    await bump_cache_version("recettes")
                 
                 imported_count += 1
                 
@@ -6069,6 +7920,58 @@ async def get_dashboard_stats():
         "stocks_recents": stocks_recents
     }
 
+async def rebuild_sales_rollup() -> int:
+    """Recalculer sales_daily à partir de tous les rapports Z ; renvoie le nombre de rapports repris.
+    
+    Construit dans une collection temporaire renommée en sales_daily à la fin : deux reconstructions
+    simultanées (plusieurs workers au démarrage) ne cumulent jamais leurs $inc, la dernière remplace l'autre.
+    """
+    staging = db[f"sales_daily_rebuild_{uuid.uuid4().hex}"]
+    for spec in REQUIRED_INDEXES["sales_daily"]:
+        await staging.create_index(spec["keys"], name=index_name_for(spec["keys"]), unique=spec.get("unique", False))
+    try:
+        count = 0
+        async for rapport in db.rapports_z.find({}, {"_id": 0}):
+            await record_sales_rollup(rapport, collection=staging)
+            count += 1
+        await staging.rename("sales_daily", dropTarget=True)
+    except Exception:
+        await staging.drop()
+        raise
+    return count
+
+async def backfill_sales_rollup():
+    """Au démarrage : construire sales_daily s'il est vide alors que des rapports Z existent (installation existante)"""
+    if await db.sales_daily.count_documents({}, limit=1) or not await db.rapports_z.count_documents({}, limit=1):
+        return
+    count = await rebuild_sales_rollup()
+    print(f"📈 Rollup sales_daily construit à partir de {count} rapports Z")
+
+@api_router.post("/admin/rebuild-sales-daily")
+async def rebuild_sales_daily():
+    """Reconstruire le rollup sales_daily à partir de tous les rapports Z"""
+    return {"rapports": await rebuild_sales_rollup()}
+
+async def build_z_name_aliases() -> int:
+    """Résoudre tous les libellés des rapports Z existants ; renvoie le nombre de libellés"""
+    names = await db.rapports_z.distinct("produits.nom")
+    await record_z_name_aliases(names)
+    return len(names)
+
+async def backfill_z_name_aliases():
+    """Au démarrage : construire la table d'alias si elle est vide alors que des rapports Z existent"""
+    if await db.z_name_aliases.count_documents({}, limit=1) or not await db.rapports_z.count_documents({}, limit=1):
+        return
+    count = await build_z_name_aliases()
+    print(f"🔤 Table d'alias Z construite ({count} libellés)")
+
+@api_router.post("/admin/rebuild-z-aliases")
+async def rebuild_z_name_aliases():
+    """Recalculer la table d'alias (et les recettes du rollup) à partir de tous les libellés des rapports Z"""
+    count = await build_z_name_aliases()
+    unresolved = await db.z_name_aliases.count_documents({"recipe_id": None})
+    return {"aliases": count, "unresolved": unresolved}
+
 @api_router.get("/dashboard/analytics")
 async def get_dashboard_analytics():
     """
@@ -6081,58 +7984,43 @@ async def get_dashboard_analytics():
     date_fin = datetime.utcnow()
     date_debut = date_fin - timedelta(days=30)
     
-    # 1. Récupérer tous les rapports Z de la période
-    rapports_z = await db.rapports_z.find({
-        "date": {"$gte": date_debut, "$lte": date_fin}
-    }).to_list(1000)
+    # 1. Totaux de la période, lus dans le rollup journalier (indépendant de la taille de l'historique)
+    totaux = await aggregate_sales_totals(sales_day(date_debut), date_fin)
+    totaux = totaux[0] if totaux else {"ca_total": 0, "nb_couverts": 0, "nb_rapports": 0}
+    nb_rapports = totaux["nb_rapports"]
     
     # 2. Calculer le CA total et les couverts
-    ca_total = 0
-    couverts_total = 0
-    ca_midi = 0
-    ca_soir = 0
-    couverts_midi = 0
-    couverts_soir = 0
-    
-    productions_stats = {}  # {nom_production: {ventes, portions, categorie}}
-    
-    for rapport in rapports_z:
-        ca_rapport = rapport.get("ca_total", 0)
-        ca_total += ca_rapport
-        
-        # Estimer midi/soir (60/40 par défaut si pas d'info)
-        ca_midi += ca_rapport * 0.6
-        ca_soir += ca_rapport * 0.4
-        
-        couverts = rapport.get("nb_couverts", 0)
-        couverts_total += couverts
-        couverts_midi += int(couverts * 0.6)
-        couverts_soir += int(couverts * 0.4)
-        
-        # Analyser les produits vendus
-        produits = rapport.get("produits", [])
-        for produit in produits:
-            nom = produit.get("nom", "Inconnu")
-            quantite = produit.get("quantite", 0)
-            prix_unitaire = produit.get("prix_unitaire", 0)
-            ventes = quantite * prix_unitaire
-            
-            if nom not in productions_stats:
-                productions_stats[nom] = {
-                    "ventes": 0,
-                    "portions": 0,
-                    "categorie": "Autres"  # À améliorer avec matching recettes
-                }
-            
-            productions_stats[nom]["ventes"] += ventes
-            productions_stats[nom]["portions"] += quantite
+    ca_total = totaux["ca_total"]
+    couverts_total = totaux["nb_couverts"]
+    
+    # Estimer midi/soir (60/40 par défaut si pas d'info)
+    ca_midi = ca_total * 0.6
+    ca_soir = ca_total * 0.4
+    couverts_midi = int(couverts_total * 0.6)
+    couverts_soir = int(couverts_total * 0.4)
+    
+    # Produits vendus sur la période : {nom_production: {ventes, portions}}
+    productions_stats = {
+        row["nom"]: {"ventes": row["ca"], "portions": row["quantite"]}
+        for row in await aggregate_sales_items(sales_day(date_debut), date_fin)
+    }
     
     # 3. Trier et obtenir top/flop productions
+    # Catégorie via la table d'alias (une requête) ; catégorie courante lue dans le cache recettes
+    aliases = await load_z_name_aliases(list(productions_stats.keys()))
+    await recipe_matcher.refresh()
+    recipes_by_id = {r["id"]: r for r in recipe_matcher.recipes}
+    
     productions_list = []
+    noms_non_resolus = []
     for nom, stats in productions_stats.items():
-        # Essayer de matcher avec une recette pour obtenir la catégorie
-        recette = await db.recettes.find_one({"nom": {"$regex": nom, "$options": "i"}})
-        categorie = recette.get("categorie", "Autres") if recette else "Autres"
+        alias = aliases.get(normalize_name(nom))
+        recette = recipes_by_id.get(alias["recipe_id"]) if alias and alias.get("recipe_id") else None
+        if recette:
+            categorie = recette.get("categorie") or "Autres"
+        else:
+            categorie = "Autres"
+            noms_non_resolus.append(nom)
         
         productions_list.append({
             "nom": nom,
@@ -6175,7 +8063,7 @@ async def get_dashboard_analytics():
             ventes_par_categorie["autres"] += prod["ventes"]
     
     # Si aucun rapport Z, retourner des données vides
-    if len(rapports_z) == 0:
+    if nb_rapports == 0:
         return {
             "caTotal": 0,
             "caMidi": 0,
@@ -6185,6 +8073,7 @@ async def get_dashboard_analytics():
             "topProductions": [],
             "flopProductions": [],
             "ventesParCategorie": ventes_par_categorie,
+            "nomsNonResolus": [],
             "periode": {
                 "debut": date_debut.isoformat(),
                 "fin": date_fin.isoformat(),
@@ -6202,10 +8091,11 @@ async def get_dashboard_analytics():
         "topProductions": top_productions,
         "flopProductions": flop_productions,
         "ventesParCategorie": {k: round(v, 2) for k, v in ventes_par_categorie.items()},
+        "nomsNonResolus": sorted(noms_non_resolus),
         "periode": {
             "debut": date_debut.isoformat(),
             "fin": date_fin.isoformat(),
-            "nb_rapports": len(rapports_z)
+            "nb_rapports": nb_rapports
         },
         "is_real_data": True
     }
@@ -6387,10 +8277,280 @@ async def get_missing_data_alerts():
     }
 
 # Routes pour le traitement OCR
+# Version des parsers OCR : à incrémenter à chaque évolution des parse_* pour invalider le cache d'upload
+OCR_PARSER_VERSION = "2024.11-1"
+
+async def process_ocr_document(file_content: bytes, filename: str, upload_content_type: Optional[str],
+                               document_type: str, progress=None, force: bool = False, job_id: Optional[str] = None):
+    """Pipeline OCR complet (extraction, parsing, enregistrement) - partagé par l'upload direct et les jobs.
+
+    Cache d'upload (ocr_upload_cache, clé SHA-256 + type de document) :
+    - même fichier, même version de parser, documents toujours présents → résultat précédent réutilisé
+    - version de parser différente ou documents supprimés → texte OCR réutilisé, parsing relancé
+    - force=True → pipeline complet (nouvel appel OCR)
+
+    progress: callback async optionnel progress(stage, percent) pour le suivi des jobs.
+    job_id: job OCR en cours (documents enregistrés de façon idempotente, voir save_ocr_document).
+    """
+    file_type = detect_file_type(filename, upload_content_type)
+    file_sha256 = hashlib.sha256(file_content).hexdigest()
+    
+    cache = None
+    if not force:
+        cache = await db.ocr_upload_cache.find_one({"sha256": file_sha256, "document_type": document_type})
+    if cache and cache.get("parser_version") == OCR_PARSER_VERSION:
+        cached_ids = cache.get("document_ids", [])
+        if cached_ids and await db.documents_ocr.count_documents({"id": {"$in": cached_ids}}) == len(cached_ids):
+            print(f"♻️ Upload déjà traité ({file_sha256[:12]}), résultat réutilisé")
+            return {**cache["result"], "cached": True}
+    
+    if cache:
+        print(f"♻️ Texte OCR réutilisé ({file_sha256[:12]}), parsing relancé (parser {OCR_PARSER_VERSION})")
+        texte_extrait = cache["texte_extrait"]
+        content_type = cache["content_type"]
+    else:
+        texte_extrait, content_type = await extract_ocr_text(file_content, filename, upload_content_type, file_type, progress)
+    
+    if progress:
+        await progress("parsing", 40)
+    
+    result = await parse_and_store_ocr_text(
+        texte_extrait, file_content, filename, content_type, file_type, document_type, progress, job_id
+    )
+    
+    result_dict = result.dict() if isinstance(result, BaseModel) else result
+    document_ids = result_dict.get("document_ids") or ([result_dict["document_id"]] if result_dict.get("document_id") else [])
+    await db.ocr_upload_cache.update_one(
+        {"sha256": file_sha256, "document_type": document_type},
+        {"$set": {
+            "parser_version": OCR_PARSER_VERSION,
+            "texte_extrait": texte_extrait,
+            "content_type": content_type,
+            "document_ids": document_ids,
+            "result": result_dict,
+            "updated_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+    return result
+
+async def extract_ocr_text(file_content: bytes, filename: str, upload_content_type: Optional[str],
+                           file_type: str, progress=None) -> tuple:
+    """Étape OCR (Google Vision) → (texte extrait, content type du fichier stocké)"""
+    if progress:
+        await progress("extraction", 10)
+    
+    # Extraire le texte selon le type de fichier
+    if file_type == 'pdf':
+        print(f"📄 Processing PDF file: {filename}")
+        # Use Google Vision API for PDF extraction (superior accuracy)
+        texte_extrait = await ocr_io_executor.run(extract_text_from_pdf_google_vision, file_content)
+        content_type = "application/pdf"
+    else:
+        print(f"🖼️ Processing image file: {filename}")
+        texte_extrait = await ocr_io_executor.run(extract_text_from_image_google_vision, file_content)
+        content_type = upload_content_type or "image/jpeg"
+    
+    if not texte_extrait or len(texte_extrait.strip()) < 10:
+        error_msg = "Impossible d'extraire du texte du PDF. Vérifiez que le PDF contient du texte." if file_type == 'pdf' else "Impossible d'extraire du texte de l'image. Vérifiez la qualité de l'image."
+        raise HTTPException(status_code=400, detail=error_msg)
+    
+    print(f"✅ Text extracted successfully: {len(texte_extrait)} characters from {file_type}")
+    return texte_extrait, content_type
+
+async def save_ocr_document(document: DocumentOCR, job_id: Optional[str] = None, index: int = 0):
+    """Enregistrer un document OCR. Dans un job, l'id est dérivé de (job, n° de facture) : un job repris
+    par un autre worker (bail expiré, nouvelle tentative) remplace ses documents au lieu de les dupliquer."""
+    if job_id is None:
+        await db.documents_ocr.insert_one(document.dict())
+        return
+    document.id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"ocr-job:{job_id}:{index}"))
+    await db.documents_ocr.replace_one({"id": document.id}, document.dict(), upsert=True)
+
+async def parse_and_store_ocr_text(texte_extrait: str, file_content: bytes, filename: str, content_type: str,
+                                   file_type: str, document_type: str, progress=None, job_id: Optional[str] = None):
+    """Étapes parsing + enregistrement des documents OCR à partir du texte extrait"""
+    # Fichier source stocké une seule fois (partagé par toutes les factures d'un même PDF)
+    blob_sha256 = await store_blob(file_content, content_type)
+    
+    # Parser selon le type de document
+    donnees_parsees = {}
+    if document_type == "z_report":
+        # Utiliser le parser enhanced pour les rapports Z
+        z_data = await ocr_cpu_executor.run(parse_z_report_enhanced, texte_extrait)
+        donnees_parsees = z_data.dict()
+        # Enrichir les prix manquants à partir des recettes en base
+        donnees_parsees = await enrich_z_report_prices(donnees_parsees)
+        # Ajouter l'analyse catégories → familles et vérification
+        z_summary = await ocr_cpu_executor.run(analyze_z_report_categories, texte_extrait)
+        donnees_parsees["z_analysis"] = z_summary
+    elif document_type == "facture_fournisseur":
+        # Détecter s'il y a plusieurs factures dans le document
+        separated_invoices = await ocr_cpu_executor.run(detect_multiple_invoices, texte_extrait)
+        
+        # Si aucune facture valide n'est détectée, on force le mode "Unique" pour ne pas perdre le document
+        valid_invoices = [inv for inv in separated_invoices if inv['quality_score'] >= 0.4]
+        
+        if len(separated_invoices) == 1 or len(valid_invoices) == 0:
+            # Facture unique (ou fallback si découpage raté)
+            # On utilise le texte complet
+            print("⚠️ Fallback: Traitement en tant que facture unique")
+            facture_data = await ocr_cpu_executor.run(parse_facture_fournisseur, texte_extrait)
+            donnees_parsees = facture_data.dict()
+            
+            # Créer le document dans la base
+            document = DocumentOCR(
+                type_document=document_type,
+                nom_fichier=filename,
+                blob_sha256=blob_sha256,
+                content_type=content_type,
+                texte_extrait=texte_extrait,
+                donnees_parsees=donnees_parsees,
+                statut="traite",
+                date_traitement=datetime.utcnow(),
+                file_type=file_type,
+                parser_version=OCR_PARSER_VERSION
+            )
+            
+            await save_ocr_document(document, job_id)
+            
+            return DocumentUploadResponse(
+                document_id=document.id,
+                type_document=document_type,
+                texte_extrait=texte_extrait,
+                donnees_parsees=donnees_parsees,
+                message="Facture unique traitée avec succès",
+                file_type=file_type
+            )
+            
+        else:
+            # Factures multiples - traiter chaque facture séparément
+            created_documents = []
+            rejected_invoices = []
+            processing_summary = []
+            
+            for i, invoice in enumerate(separated_invoices):
+                try:
+                    # Vérifier la qualité avant traitement
+                    # TOLÉRANCE : On abaisse le seuil à 0.4 pour accepter les factures "Diamant" très blanches
+                    if invoice['quality_score'] < 0.4:
+                        rejected_invoices.append({
+                            'index': invoice['index'],
+                            'header': invoice['header'],
+                            'quality_score': invoice['quality_score'],
+                            'issues': invoice['quality_issues'],
+                            'reason': 'Qualité insuffisante pour traitement automatique'
+                        })
+                        processing_summary.append(f"❌ Facture {invoice['index']}: Rejetée (qualité {invoice['quality_score']:.1%})")
+                        print(f"⚠️ Facture {invoice['index']} rejetée - Qualité: {invoice['quality_score']:.1%}")
+                        print(f"   Issues: {', '.join(invoice['quality_issues'])}")
+                        continue
+                    
+                    # Parser chaque facture de qualité suffisante
+                    facture_data = await ocr_cpu_executor.run(parse_facture_fournisseur, invoice['text_content'])
+                    donnees_parsees = facture_data.dict()
+                    
+                    # Ajouter des métadonnées complètes
+                    donnees_parsees["separation_info"] = {
+                        "is_multi_invoice": True,
+                        "invoice_index": invoice['index'],
+                        "total_invoices": len(separated_invoices),
+                        "total_processed": len([inv for inv in separated_invoices if inv['quality_score'] >= 0.4]),
+                        "header_detected": invoice['header'],
+                        "quality_score": invoice['quality_score'],
+                        "quality_issues": invoice['quality_issues']
+                    }
+                    
+                    # Déterminer le statut selon la qualité
+                    statut = "traite" if invoice['quality_score'] >= 0.7 else "traite_avec_avertissement"
+                    
+                    # Créer un document pour chaque facture valide
+                    document = DocumentOCR(
+                        type_document=document_type,
+                        nom_fichier=f"{filename} - Facture {invoice['index']}/{len(separated_invoices)} (Q:{invoice['quality_score']:.1%})",
+                        blob_sha256=blob_sha256,  # Même image/PDF source, stockée une fois
+                        content_type=content_type,
+                        texte_extrait=invoice['text_content'],  # Texte de cette facture uniquement
+                        donnees_parsees=donnees_parsees,
+                        statut=statut,
+                        date_traitement=datetime.utcnow(),
+                        file_type=file_type,
+                        parser_version=OCR_PARSER_VERSION
+                    )
+                    
+                    await save_ocr_document(document, job_id, invoice['index'])
+                    created_documents.append(document.id)
+                    
+                    processing_summary.append(f"✅ Facture {invoice['index']}: Traitée avec succès (qualité {invoice['quality_score']:.1%})")
+                    print(f"✅ Facture {invoice['index']}/{len(separated_invoices)} créée - Qualité: {invoice['quality_score']:.1%}")
+                    
+                except Exception as e:
+                    rejected_invoices.append({
+                        'index': invoice.get('index', i+1),
+                        'header': invoice.get('header', 'En-tête non détecté'),
+                        'quality_score': invoice.get('quality_score', 0.0),
+                        'issues': [f"Erreur de traitement: {str(e)}"],
+                        'reason': f'Erreur lors du parsing: {str(e)}'
+                    })
+                    processing_summary.append(f"❌ Facture {invoice.get('index', i+1)}: Erreur de traitement")
+                    print(f"❌ Erreur lors du traitement de la facture {invoice.get('index', i+1)}: {str(e)}")
+                    continue
+            
+            # Retourner un résumé détaillé
+            return {
+                "multi_invoice": True,
+                "total_detected": len(separated_invoices),
+                "successfully_processed": len(created_documents),
+                "rejected_count": len(rejected_invoices),
+                "document_ids": created_documents,
+                "rejected_invoices": rejected_invoices,
+                "processing_summary": processing_summary,
+                "message": f"{len(created_documents)} factures traitées avec succès, {len(rejected_invoices)} rejetées sur {len(separated_invoices)} détectées",
+                "file_type": file_type,
+                "has_quality_issues": len(rejected_invoices) > 0
+            }
+    elif document_type == "mercuriale":
+        # Parser la mercuriale pour détecter les produits
+        mercuriale_data = await ocr_cpu_executor.run(parse_mercuriale_fournisseur, texte_extrait)
+        donnees_parsees = mercuriale_data
+    
+    if progress:
+        await progress("saving", 80)
+    
+    # Pour les tickets Z et les mercuriales (enregistrement d'un document unique)
+    if document_type in ("z_report", "mercuriale"):
+        document = DocumentOCR(
+            type_document=document_type,
+            nom_fichier=filename,
+            blob_sha256=blob_sha256,
+            content_type=content_type,
+            texte_extrait=texte_extrait,
+            donnees_parsees=donnees_parsees,
+            statut="traite",
+            date_traitement=datetime.utcnow(),
+            file_type=file_type,
+            parser_version=OCR_PARSER_VERSION
+        )
+        
+        await save_ocr_document(document, job_id)
+        
+        return DocumentUploadResponse(
+            document_id=document.id,
+            type_document=document_type,
+            texte_extrait=texte_extrait,
+            donnees_parsees=donnees_parsees,
+            message=f"Document {document_type} traité avec succès",
+            file_type=file_type
+        )
+
+
 @api_router.post("/ocr/upload-document")  # No response_model to allow flexible multi-invoice responses
 async def upload_and_process_document(
+    response: Response,
     file: UploadFile = File(...),
-    document_type: str = Form("z_report")  # "z_report" ou "facture_fournisseur" ou "mercuriale"
+    document_type: str = Form("z_report"),  # "z_report" ou "facture_fournisseur" ou "mercuriale"
+    async_job: bool = Form(False),  # True → 202 + job_id, traitement par les workers OCR
+    force: bool = Form(False)  # True → ignorer le cache d'upload et relancer l'OCR
 ):
     """Upload et traitement OCR d'un document (image ou PDF) - Rapport Z, facture ou mercuriale"""
     
@@ -6399,9 +8559,6 @@ async def upload_and_process_document(
     if document_type not in ["z_report", "facture_fournisseur", "mercuriale"]:
         raise HTTPException(status_code=400, detail="Type de document invalide. Utilisez 'z_report', 'facture_fournisseur' ou 'mercuriale'")
     
-    # Détecter le type de fichier
-    file_type = detect_file_type(file.filename, file.content_type)
-    
     # Vérifier le format de fichier (accepter images ET PDF)
     if file.content_type:
         if not (file.content_type.startswith('image/') or file.content_type == 'application/pdf'):
@@ -6416,192 +8573,201 @@ async def upload_and_process_document(
         # Lire le contenu du fichier
         file_content = await file.read()
         
-        # Extraire le texte selon le type de fichier
-        if file_type == 'pdf':
-            print(f"📄 Processing PDF file: {file.filename}")
-            # Use Google Vision API for PDF extraction (superior accuracy)
-            texte_extrait = extract_text_from_pdf_google_vision(file_content)
-            # Pour les PDF, on stocke le contenu comme base64 mais avec prefix PDF
-            content_base64 = base64.b64encode(file_content).decode('utf-8')
-            data_uri = f"data:application/pdf;base64,{content_base64}"
-        else:
-            print(f"🖼️ Processing image file: {file.filename}")
-            image_base64 = base64.b64encode(file_content).decode('utf-8')
-            texte_extrait = extract_text_from_image_google_vision(file_content)
-            data_uri = f"data:{file.content_type or 'image/jpeg'};base64,{image_base64}"
-        
-        if not texte_extrait or len(texte_extrait.strip()) < 10:
-            error_msg = "Impossible d'extraire du texte du PDF. Vérifiez que le PDF contient du texte." if file_type == 'pdf' else "Impossible d'extraire du texte de l'image. Vérifiez la qualité de l'image."
-            raise HTTPException(status_code=400, detail=error_msg)
-        
-        print(f"✅ Text extracted successfully: {len(texte_extrait)} characters from {file_type}")
-        
-        # Parser selon le type de document
-        donnees_parsees = {}
-        if document_type == "z_report":
-            # Utiliser le parser enhanced pour les rapports Z
-            z_data = parse_z_report_enhanced(texte_extrait)
-            donnees_parsees = z_data.dict()
-            # Enrichir les prix manquants à partir des recettes en base
-            donnees_parsees = await enrich_z_report_prices(donnees_parsees)
-            # Ajouter l'analyse catégories → familles et vérification
-            z_summary = analyze_z_report_categories(texte_extrait)
-            donnees_parsees["z_analysis"] = z_summary
-        elif document_type == "facture_fournisseur":
-            # Détecter s'il y a plusieurs factures dans le document
-            separated_invoices = detect_multiple_invoices(texte_extrait)
-            
-            # Si aucune facture valide n'est détectée, on force le mode "Unique" pour ne pas perdre le document
-            valid_invoices = [inv for inv in separated_invoices if inv['quality_score'] >= 0.4]
-            
-            if len(separated_invoices) == 1 or len(valid_invoices) == 0:
-                # Facture unique (ou fallback si découpage raté)
-                # On utilise le texte complet
-                print("⚠️ Fallback: Traitement en tant que facture unique")
-                facture_data = parse_facture_fournisseur(texte_extrait)
-                donnees_parsees = facture_data.dict()
-                
-                # Créer le document dans la base
-                document = DocumentOCR(
-                    type_document=document_type,
-                    nom_fichier=file.filename,
-                    image_base64=data_uri,
-                    texte_extrait=texte_extrait,
-                    donnees_parsees=donnees_parsees,
-                    statut="traite",
-                    date_traitement=datetime.utcnow(),
-                    file_type=file_type
-                )
-                
-                await db.documents_ocr.insert_one(document.dict())
-                
-                return DocumentUploadResponse(
-                    document_id=document.id,
-                    type_document=document_type,
-                    texte_extrait=texte_extrait,
-                    donnees_parsees=donnees_parsees,
-                    message="Facture unique traitée avec succès",
-                    file_type=file_type
-                )
-                
-            else:
-                # Factures multiples - traiter chaque facture séparément
-                created_documents = []
-                rejected_invoices = []
-                processing_summary = []
-                
-                for i, invoice in enumerate(separated_invoices):
-                    try:
-                        # Vérifier la qualité avant traitement
-                        # TOLÉRANCE : On abaisse le seuil à 0.4 pour accepter les factures "Diamant" très blanches
-                        if invoice['quality_score'] < 0.4:
-                            rejected_invoices.append({
-                                'index': invoice['index'],
-                                'header': invoice['header'],
-                                'quality_score': invoice['quality_score'],
-                                'issues': invoice['quality_issues'],
-                                'reason': 'Qualité insuffisante pour traitement automatique'
-                            })
-                            processing_summary.append(f"❌ Facture {invoice['index']}: Rejetée (qualité {invoice['quality_score']:.1%})")
-                            print(f"⚠️ Facture {invoice['index']} rejetée - Qualité: {invoice['quality_score']:.1%}")
-                            print(f"   Issues: {', '.join(invoice['quality_issues'])}")
-                            continue
-                        
-                        # Parser chaque facture de qualité suffisante
-                        facture_data = parse_facture_fournisseur(invoice['text_content'])
-                        donnees_parsees = facture_data.dict()
-                        
-                        # Ajouter des métadonnées complètes
-                        donnees_parsees["separation_info"] = {
-                            "is_multi_invoice": True,
-                            "invoice_index": invoice['index'],
-                            "total_invoices": len(separated_invoices),
-                            "total_processed": len([inv for inv in separated_invoices if inv['quality_score'] >= 0.4]),
-                            "header_detected": invoice['header'],
-                            "quality_score": invoice['quality_score'],
-                            "quality_issues": invoice['quality_issues']
-                        }
-                        
-                        # Déterminer le statut selon la qualité
-                        statut = "traite" if invoice['quality_score'] >= 0.7 else "traite_avec_avertissement"
-                        
-                        # Créer un document pour chaque facture valide
-                        document = DocumentOCR(
-                            type_document=document_type,
-                            nom_fichier=f"{file.filename} - Facture {invoice['index']}/{len(separated_invoices)} (Q:{invoice['quality_score']:.1%})",
-                            image_base64=data_uri,  # Même image/PDF source
-                            texte_extrait=invoice['text_content'],  # Texte de cette facture uniquement
-                            donnees_parsees=donnees_parsees,
-                            statut=statut,
-                            date_traitement=datetime.utcnow(),
-                            file_type=file_type
-                        )
-                        
-                        await db.documents_ocr.insert_one(document.dict())
-                        created_documents.append(document.id)
-                        
-                        processing_summary.append(f"✅ Facture {invoice['index']}: Traitée avec succès (qualité {invoice['quality_score']:.1%})")
-                        print(f"✅ Facture {invoice['index']}/{len(separated_invoices)} créée - Qualité: {invoice['quality_score']:.1%}")
-                        
-                    except Exception as e:
-                        rejected_invoices.append({
-                            'index': invoice.get('index', i+1),
-                            'header': invoice.get('header', 'En-tête non détecté'),
-                            'quality_score': invoice.get('quality_score', 0.0),
-                            'issues': [f"Erreur de traitement: {str(e)}"],
-                            'reason': f'Erreur lors du parsing: {str(e)}'
-                        })
-                        processing_summary.append(f"❌ Facture {invoice.get('index', i+1)}: Erreur de traitement")
-                        print(f"❌ Erreur lors du traitement de la facture {invoice.get('index', i+1)}: {str(e)}")
-                        continue
-                
-                # Retourner un résumé détaillé
-                return {
-                    "multi_invoice": True,
-                    "total_detected": len(separated_invoices),
-                    "successfully_processed": len(created_documents),
-                    "rejected_count": len(rejected_invoices),
-                    "document_ids": created_documents,
-                    "rejected_invoices": rejected_invoices,
-                    "processing_summary": processing_summary,
-                    "message": f"{len(created_documents)} factures traitées avec succès, {len(rejected_invoices)} rejetées sur {len(separated_invoices)} détectées",
-                    "file_type": file_type,
-                    "has_quality_issues": len(rejected_invoices) > 0
-                }
-        elif document_type == "mercuriale":
-            # Parser la mercuriale pour détecter les produits
-            mercuriale_data = parse_mercuriale_fournisseur(texte_extrait)
-            donnees_parsees = mercuriale_data
+        if async_job:
+            job = await enqueue_ocr_job(file_content, file.filename, file.content_type, document_type, force)
+            response.status_code = 202
+            return {
+                "job_id": job["id"],
+                "status": job["status"],
+                "status_url": f"/api/ocr/jobs/{job['id']}",
+                "events_url": f"/api/ocr/jobs/{job['id']}/events"
+            }
         
-        # Pour les tickets Z (traitement normal inchangé)
-        if document_type == "z_report":
-            document = DocumentOCR(
-                type_document=document_type,
-                nom_fichier=file.filename,
-                image_base64=data_uri,
-                texte_extrait=texte_extrait,
-                donnees_parsees=donnees_parsees,
-                statut="traite",
-                date_traitement=datetime.utcnow(),
-                file_type=file_type
-            )
-            
-            await db.documents_ocr.insert_one(document.dict())
-            
-            return DocumentUploadResponse(
-                document_id=document.id,
-                type_document=document_type,
-                texte_extrait=texte_extrait,
-                donnees_parsees=donnees_parsees,
-                message=f"Document {document_type} traité avec succès",
-                file_type=file_type
-            )
+        return await process_ocr_document(file_content, file.filename, file.content_type, document_type, force=force)
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erreur lors du traitement: {str(e)}")
 
+# ===== OCR Job Queue (Mongo) =====
+# Un job = un upload ; les workers (tâches du serveur API et/ou ocr_worker.py) réclament les jobs
+# de façon atomique (find_one_and_update) avec un bail renouvelé pendant le traitement.
+OCR_JOB_WORKERS = int(os.environ.get('OCR_JOB_WORKERS', '2'))
+OCR_JOB_LEASE_SECONDS = int(os.environ.get('OCR_JOB_LEASE_SECONDS', '300'))
+OCR_JOB_MAX_ATTEMPTS = int(os.environ.get('OCR_JOB_MAX_ATTEMPTS', '3'))
+OCR_JOB_POLL_SECONDS = float(os.environ.get('OCR_JOB_POLL_SECONDS', '1'))
+
+class OcrJob(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    document_type: str
+    filename: Optional[str] = None
+    content_type: Optional[str] = None
+    blob_sha256: str
+    force: bool = False
+    status: str = "queued"  # "queued", "running", "done", "failed"
+    stage: str = "queued"  # "queued", "extraction", "parsing", "saving", "done"
+    progress: int = 0
+    attempts: int = 0
+    worker_id: Optional[str] = None
+    lease_until: Optional[datetime] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+async def enqueue_ocr_job(file_content: bytes, filename: str, content_type: Optional[str], document_type: str,
+                          force: bool = False) -> dict:
+    """Stocker le fichier dans le blob store et créer un job en file d'attente"""
+    blob_sha256 = await store_blob(file_content, content_type or "application/octet-stream")
+    job = OcrJob(document_type=document_type, filename=filename, content_type=content_type,
+                 blob_sha256=blob_sha256, force=force)
+    await db.ocr_jobs.insert_one(job.dict())
+    return job.dict()
+
+async def claim_ocr_job(worker_id: str) -> Optional[dict]:
+    """Réclamer atomiquement le plus ancien job en attente (ou dont le bail a expiré)"""
+    now = datetime.utcnow()
+    return await db.ocr_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued"},
+            {"status": "running", "lease_until": {"$lt": now}}
+        ]},
+        {
+            "$set": {
+                "status": "running",
+                "worker_id": worker_id,
+                "lease_until": now + timedelta(seconds=OCR_JOB_LEASE_SECONDS),
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def run_ocr_job(job: dict, worker_id: str):
+    """Exécuter un job réclamé et enregistrer son résultat"""
+    job_filter = {"id": job["id"], "worker_id": worker_id}
+
+    async def report_progress(stage: str, percent: int):
+        await db.ocr_jobs.update_one(job_filter, {"$set": {
+            "stage": stage, "progress": percent, "updated_at": datetime.utcnow()
+        }})
+
+    async def renew_lease():
+        # Bail renouvelé pendant tout le traitement (extraction, parsing et enregistrement compris),
+        # pour qu'un job long ne soit jamais réclamé par un autre worker
+        while True:
+            await asyncio.sleep(OCR_JOB_LEASE_SECONDS / 3)
+            try:
+                await db.ocr_jobs.update_one(job_filter, {"$set": {
+                    "lease_until": datetime.utcnow() + timedelta(seconds=OCR_JOB_LEASE_SECONDS)
+                }})
+            except Exception as e:
+                print(f"⚠️ Renouvellement du bail du job OCR {job['id']} impossible: {str(e)}")
+
+    if job["attempts"] > OCR_JOB_MAX_ATTEMPTS:
+        await db.ocr_jobs.update_one(job_filter, {"$set": {
+            "status": "failed", "error": "Nombre maximal de tentatives atteint", "updated_at": datetime.utcnow()
+        }})
+        return
+
+    heartbeat = asyncio.create_task(renew_lease())
+    try:
+        file_content = await load_blob(job["blob_sha256"])
+        if file_content is None:
+            raise HTTPException(status_code=404, detail="Fichier source du job introuvable")
+        
+        result = await process_ocr_document(
+            file_content, job.get("filename"), job.get("content_type"), job["document_type"],
+            progress=report_progress, force=job.get("force", False), job_id=job["id"]
+        )
+        if isinstance(result, BaseModel):
+            result = result.dict()
+        await db.ocr_jobs.update_one(job_filter, {"$set": {
+            "status": "done", "stage": "done", "progress": 100, "result": result,
+            "lease_until": None, "updated_at": datetime.utcnow()
+        }})
+    except Exception as e:
+        if isinstance(e, HTTPException) and e.status_code < 500:
+            # Erreur métier (4xx, ex: aucun texte extrait) : inutile de réessayer
+            await db.ocr_jobs.update_one(job_filter, {"$set": {
+                "status": "failed", "error": e.detail, "lease_until": None, "updated_at": datetime.utcnow()
+            }})
+            return
+        # Erreur technique ou transitoire (5xx : file OCR saturée, délai dépassé) :
+        # remise en file tant que le nombre de tentatives le permet
+        error = e.detail if isinstance(e, HTTPException) else str(e)
+        retry = job["attempts"] < OCR_JOB_MAX_ATTEMPTS
+        await db.ocr_jobs.update_one(job_filter, {"$set": {
+            "status": "queued" if retry else "failed",
+            "error": error, "lease_until": None, "updated_at": datetime.utcnow()
+        }})
+        print(f"❌ Job OCR {job['id']} en erreur (tentative {job['attempts']}): {error}")
+    finally:
+        heartbeat.cancel()
+
+async def run_ocr_job_worker(worker_id: str):
+    """Boucle d'un worker OCR : réclame et traite les jobs en continu"""
+    print(f"🧵 Worker OCR démarré: {worker_id}")
+    while True:
+        try:
+            job = await claim_ocr_job(worker_id)
+            if job:
+                await run_ocr_job(job, worker_id)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Erreur worker OCR {worker_id}: {str(e)}")
+        await asyncio.sleep(OCR_JOB_POLL_SECONDS)
+
+def serialize_ocr_job(job: dict) -> dict:
+    """Vue publique d'un job (sans _id ni détails de bail)"""
+    return {
+        "job_id": job["id"],
+        "document_type": job["document_type"],
+        "filename": job.get("filename"),
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "attempts": job["attempts"],
+        "result": job.get("result"),
+        "error": job.get("error"),
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat()
+    }
+
+@api_router.get("/ocr/jobs/{job_id}")
+async def get_ocr_job(job_id: str):
+    """Statut et résultat d'un job OCR"""
+    job = await db.ocr_jobs.find_one({"id": job_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job OCR non trouvé")
+    return serialize_ocr_job(job)
+
+@api_router.get("/ocr/jobs/{job_id}/events")
+async def stream_ocr_job_events(job_id: str):
+    """Flux SSE de progression d'un job OCR (un événement par changement d'étape, fin sur done/failed)"""
+    if not await db.ocr_jobs.count_documents({"id": job_id}, limit=1):
+        raise HTTPException(status_code=404, detail="Job OCR non trouvé")
+
+    async def event_stream():
+        last_update = None
+        while True:
+            job = await db.ocr_jobs.find_one({"id": job_id})
+            if not job:
+                break
+            if job["updated_at"] != last_update:
+                last_update = job["updated_at"]
+                yield f"event: {job['status']}\ndata: {json.dumps(serialize_ocr_job(job), default=str)}\n\n"
+            if job["status"] in ("done", "failed"):
+                break
+            await asyncio.sleep(OCR_JOB_POLL_SECONDS)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @api_router.get("/ocr/documents")
 async def get_processed_documents(document_type: Optional[str] = None, limit: int = 50):
     """Récupérer l'historique des documents traités"""
@@ -6609,7 +8775,7 @@ async def get_processed_documents(document_type: Optional[str] = None, limit: in
     if document_type:
         query["type_document"] = document_type
     
-    documents = await db.documents_ocr.find(query).sort("date_upload", -1).limit(limit).to_list(limit)
+    documents = await db.documents_ocr.find(query, {"image_base64": 0}).sort("date_upload", -1).limit(limit).to_list(limit)
     
     # Nettoyer les documents pour la sérialisation JSON
     for doc in documents:
@@ -6624,7 +8790,7 @@ async def get_processed_documents(document_type: Optional[str] = None, limit: in
 
 @api_router.get("/ocr/document/{document_id}")
 async def get_document_by_id(document_id: str):
-    """Récupérer un document spécifique par son ID. Enrichit les prix manquants et ajoute l'analyse Z si absente."""
+    """Récupérer un document spécifique par son ID. Enrichit les prix (une seule fois) et ajoute l'analyse Z si absente."""
     document = await db.documents_ocr.find_one({"id": document_id})
     if not document:
         raise HTTPException(status_code=404, detail="Document non trouvé")
@@ -6633,26 +8799,17 @@ async def get_document_by_id(document_id: str):
     try:
         if document.get("type_document") == "z_report" and document.get("donnees_parsees"):
             parsed = document["donnees_parsees"]
-            items = parsed.get("items_by_category", {})
-            # Vérifier s'il manque des prix
-            missing_prices = False
-            for cat_items in items.values():
-                for it in cat_items:
-                    if it.get("unit_price") is None:
-                        missing_prices = True
-                        break
-                if missing_prices:
-                    break
-            if missing_prices:
-                enriched = await enrich_z_report_prices(parsed)
-                if enriched != parsed:
-                    await db.documents_ocr.update_one(
-                        {"id": document_id}, {"$set": {"donnees_parsees": enriched}}
-                    )
-                    document["donnees_parsees"] = enriched
+            # Enrichissement déjà fait à l'upload : on sert le résultat stocké.
+            # Seuls les anciens documents (sans marqueur) sont enrichis, puis persistés.
+            if "price_enrichment" not in parsed:
+                parsed = await enrich_z_report_prices(parsed)
+                await db.documents_ocr.update_one(
+                    {"id": document_id}, {"$set": {"donnees_parsees": parsed}}
+                )
+                document["donnees_parsees"] = parsed
             # Ajouter analyse si absente
             if not parsed.get("z_analysis") and document.get("texte_extrait"):
-                z_summary = analyze_z_report_categories(document["texte_extrait"])
+                z_summary = await ocr_cpu_executor.run(analyze_z_report_categories, document["texte_extrait"])
                 parsed["z_analysis"] = z_summary
                 await db.documents_ocr.update_one(
                     {"id": document_id}, {"$set": {"donnees_parsees": parsed}}
@@ -6665,14 +8822,19 @@ async def get_document_by_id(document_id: str):
     if "_id" in document:
         del document["_id"]
     
+    # Aperçu : le fichier source est chargé depuis le blob store uniquement ici
+    document["image_base64"] = await get_document_data_uri(document)
+    
     return document
 
 @api_router.delete("/ocr/document/{document_id}")
 async def delete_document(document_id: str):
     """Supprimer un document OCR"""
-    result = await db.documents_ocr.delete_one({"id": document_id})
-    if result.deleted_count == 0:
+    document = await db.documents_ocr.find_one({"id": document_id}, {"_id": 0, "blob_sha256": 1})
+    if not document:
         raise HTTPException(status_code=404, detail="Document non trouvé")
+    await db.documents_ocr.delete_one({"id": document_id})
+    await delete_blob_if_unreferenced(document.get("blob_sha256"))
     return {"message": "Document supprimé"}
 
 # ✅ Endpoints Rapports Z
@@ -6680,6 +8842,7 @@ async def delete_document(document_id: str):
 async def create_rapport_z(data: RapportZ):
     """Créer un nouveau rapport Z"""
     await db.rapports_z.insert_one(data.dict())
+    await register_rapport_z(data.dict())
     return {"status": "ok", "id": data.id}
 
 @api_router.get("/rapports_z")
@@ -6706,16 +8869,21 @@ async def get_rapport_z(rapport_id: str):
 @api_router.delete("/rapports_z/{rapport_id}")
 async def delete_rapport_z(rapport_id: str):
     """Supprimer un rapport Z"""
-    result = await db.rapports_z.delete_one({"id": rapport_id})
-    if result.deleted_count == 0:
+    rapport = await db.rapports_z.find_one_and_delete({"id": rapport_id})
+    if not rapport:
         raise HTTPException(status_code=404, detail="Rapport non trouvé")
+    await record_sales_rollup(rapport, sign=-1)
     return {"message": "Rapport supprimé"}
 
 @api_router.delete("/ocr/documents/all")
 async def delete_all_ocr_documents():
-    """Supprimer tous les documents OCR de l'historique"""
+    """Supprimer tous les documents OCR de l'historique (et leurs fichiers sources devenus orphelins)"""
     try:
+        blob_hashes = await db.documents_ocr.distinct("blob_sha256", {"blob_sha256": {"$ne": None}})
         result = await db.documents_ocr.delete_many({})
+        # Les blobs encore utilisés par un job OCR en attente ou en cours sont conservés
+        for sha256 in blob_hashes:
+            await delete_blob_if_unreferenced(sha256)
         return {
             "message": "Tous les documents OCR ont été supprimés",
             "deleted_count": result.deleted_count
@@ -6763,18 +8931,25 @@ async def archive_item(request: ArchiveRequest):
     # Supprimer l'élément original de sa collection
     collection = getattr(db, collection_name)
     await collection.delete_one({"id": request.item_id})
+    await bump_cache_version(collection_name)
     
     return {"message": f"{request.item_type.capitalize()} archivé avec succès", "archive_id": archived_item.id}
 
 @api_router.get("/archives", response_model=List[ArchivedItem])
-async def get_archives(item_type: Optional[str] = None):
-    """Obtenir la liste des éléments archivés"""
-    query = {}
+async def get_archives(
+    response: Response,
+    item_type: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None
+):
+    """Obtenir la liste des éléments archivés (pagination par curseur)"""
+    query = date_range_filter("archived_at", date_from, date_to)
     if item_type:
         query["item_type"] = item_type
     
-    archives = await db.archived_items.find(query).sort("archived_at", -1).to_list(1000)
-    return [ArchivedItem(**archive) for archive in archives]
+    return await paginate(db.archived_items, query, "archived_at", True, limit, cursor, response)
 
 @api_router.post("/restore/{archive_id}")
 async def restore_item(archive_id: str):
@@ -6803,6 +8978,7 @@ async def restore_item(archive_id: str):
     
     # Restaurer l'élément
     await collection.insert_one(archived_item.original_data)
+    await bump_cache_version(collection_name)
     
     # Supprimer l'archive
     await db.archived_items.delete_one({"id": archive_id})
@@ -7046,16 +9222,23 @@ async def create_mission(mission: MissionCreate, assigned_by_user_id: str):
         raise HTTPException(status_code=500, detail=f"Erreur lors de la création: {str(e)}")
 
 @api_router.get("/missions", response_model=List[Mission])
-async def get_missions(user_id: Optional[str] = None, status: Optional[str] = None):
-    """Récupérer les missions"""
-    query = {}
+async def get_missions(
+    response: Response,
+    user_id: Optional[str] = None,
+    status: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None
+):
+    """Récupérer les missions (pagination par curseur)"""
+    query = date_range_filter("assigned_date", date_from, date_to)
     if user_id:
         query["assigned_to_user_id"] = user_id
     if status:
         query["status"] = status
     
-    missions = await db.missions.find(query).sort("assigned_date", -1).to_list(1000)
-    return [Mission(**m) for m in missions]
+    return await paginate(db.missions, query, "assigned_date", True, limit, cursor, response)
 
 @api_router.get("/missions/by-user/{user_id}")
 async def get_missions_by_user(user_id: str):
@@ -7165,6 +9348,7 @@ async def clean_duplicates():
         for produit in produits:
             if produit["nom"] in seen_names:
                 await db.produits.delete_one({"id": produit["id"]})
+                await bump_cache_version("produits")
                 # Supprimer aussi le stock associé
                 await db.stocks.delete_one({"produit_id": produit["id"]})
                 duplicates_removed += 1
@@ -7200,6 +9384,8 @@ async def clean_duplicates():
                 seen_names_p.add(prep["nom"])
         
         collections_cleaned["preparations"] = duplicates_removed_p
+        if duplicates_removed_p:
+            await bump_cache_version("preparations")
         
         # Nettoyer les recettes
         recettes = await db.recettes.find().to_list(1000)
@@ -7209,6 +9395,7 @@ async def clean_duplicates():
         for recette in recettes:
             if recette["nom"] in seen_names_r:
                 await db.recettes.delete_one({"id": recette["id"]})
+                await bump_cache_version("recettes")
                 duplicates_removed_r += 1
             else:
                 seen_names_r.add(recette["nom"])
@@ -7239,9 +9426,12 @@ async def init_real_restaurant_data():
         print("🧹 Nettoyage des collections...")
         await db.fournisseurs.delete_many({})
         await db.produits.delete_many({})
+        await bump_cache_version("produits")
         await db.stocks.delete_many({})
         await db.preparations.delete_many({})
+        await bump_cache_version("preparations")
         await db.recettes.delete_many({})
+        await bump_cache_version("recettes")
         print("✅ Collections nettoyées")
         
         # Compteurs
@@ -7287,6 +9477,7 @@ async def init_real_restaurant_data():
                 fournisseur_nom=fournisseur_nom  # Legacy
             )
             await db.produits.insert_one(produit.dict())
+            await bump_cache_version("produits")
             produit_ids[produit_data["nom"]] = produit.id
             
             # Créer la relation fournisseur-produit
@@ -7337,6 +9528,7 @@ async def init_real_restaurant_data():
                     dlc=dlc_date
                 )
                 await db.preparations.insert_one(preparation.dict())
+                await bump_cache_version("preparations")
                 preparation_ids[prep_data["nom"]] = preparation.id
                 preparations_created += 1
         
@@ -7377,6 +9569,7 @@ async def init_real_restaurant_data():
                 ingredients=ingredients
             )
             await db.recettes.insert_one(recette.dict())
+            await bump_cache_version("recettes")
             recettes_created += 1
         
         return {
@@ -7721,6 +9914,7 @@ async def import_nouvelle_carte():
         
         # Supprimer les anciennes recettes après archivage
         await db.recettes.delete_many({})
+        await bump_cache_version("recettes")
         
         # Archiver chaque ancienne préparation
         for ancienne_preparation in anciennes_preparations:
@@ -7739,6 +9933,7 @@ async def import_nouvelle_carte():
         
         # Supprimer les anciennes préparations après archivage
         await db.preparations.delete_many({})
+        await bump_cache_version("preparations")
         
         # Nouvelles productions basées sur la carte analysée
         nouvelles_productions = [
@@ -7877,6 +10072,7 @@ async def import_nouvelle_carte():
             )
             
             await db.recettes.insert_one(recette.dict())
+            await bump_cache_version("recettes")
             created_count += 1
         
         # Créer les préparations appropriées
@@ -7939,6 +10135,7 @@ async def import_nouvelle_carte():
                 )
                 
                 await db.preparations.insert_one(preparation.dict())
+                await bump_cache_version("preparations")
                 preparation_count += 1
         
         return {
@@ -8013,6 +10210,7 @@ async def update_ingredients_from_carte():
             
             # Supprimer le produit après archivage
             await db.produits.delete_one({"id": produit["id"]})
+            await bump_cache_version("produits")
             
             # Supprimer aussi le stock associé
             await db.stocks.delete_one({"produit_id": produit["id"]})
@@ -8054,6 +10252,7 @@ async def update_ingredients_from_carte():
                 )
                 
                 await db.produits.insert_one(produit.dict())
+                await bump_cache_version("produits")
                 
                 # Créer un stock initial
                 stock = Stock(
@@ -8186,51 +10385,46 @@ async def execute_preparation(preparation_id: str, request: ExecutePreparationRe
         # 2. Calculer la quantité de produit brut nécessaire
         # Ratio: quantite_preparee est obtenue à partir de quantite_produit_brut
         ratio = quantite_preparee / quantite_produit_brut if quantite_produit_brut > 0 else 1.0
-        quantite_brut_necessaire = round_stock_quantity(request.quantite_a_produire / ratio)
+        quantite_brut_necessaire = request.quantite_a_produire / ratio
+        # Le brut est exprimé en unite_produit_brut : conversion dans l'unité de stock du produit
+        produit_brut = await db.produits.find_one(
+            {"id": produit_id}, {"_id": 0, "nom": 1, "unite": 1, "poids_piece": 1, "taille_colis": 1}
+        ) or {}
+        factor = product_unit_factor(preparation.get("unite_produit_brut"), produit_brut)
+        if factor is None:
+            warnings.append(f"Unité '{preparation.get('unite_produit_brut')}' non convertible en '{produit_brut.get('unite')}' : quantité déduite sans conversion")
+            factor = 1.0
+        quantite_brut_necessaire = round_stock_quantity(quantite_brut_necessaire * factor)
         
         print(f"   Produit brut nécessaire: {quantite_brut_necessaire} (ratio: {ratio})")
         
-        # 3. Vérifier et déduire le stock du produit brut
-        stock_produit = await db.stocks.find_one({"produit_id": produit_id})
-        if not stock_produit:
-            raise HTTPException(status_code=404, detail=f"Stock du produit brut {produit_id} non trouvé")
-        
-        stock_actuel = round_stock_quantity(stock_produit.get("quantite_actuelle", 0))
-        produit_nom = stock_produit.get("produit_nom", "Produit inconnu")
-        
-        if stock_actuel < quantite_brut_necessaire:
-            errors.append(f"Stock insuffisant: {stock_actuel} disponible, {quantite_brut_necessaire} requis")
-            raise HTTPException(status_code=400, detail=f"Stock insuffisant pour {produit_nom}")
-        
-        # Déduire le stock
-        nouveau_stock = round_stock_quantity(stock_actuel - quantite_brut_necessaire)
-        await db.stocks.update_one(
-            {"produit_id": produit_id},
-            {
-                "$set": {
-                    "quantite_actuelle": nouveau_stock,
-                    "derniere_maj": datetime.utcnow()
-                }
-            }
-        )
-        
-        # Créer mouvement de sortie pour le produit brut
+        # 3. Déduire le stock du produit brut : sortie conditionnelle (stock suffisant) et atomique
         mouvement_sortie = MouvementStock(
             produit_id=produit_id,
-            produit_nom=produit_nom,
             type="sortie",
             quantite=quantite_brut_necessaire,
             reference=f"Préparation-{preparation_id[:8]}",
             commentaire=f"Transformation en {preparation_nom}"
         )
-        await db.mouvements_stock.insert_one(mouvement_sortie.dict())
+        applied = await apply_stock_delta(produit_id, -quantite_brut_necessaire, mouvement_sortie, require_available=True)
+        if not applied:
+            stock_produit = await db.stocks.find_one({"produit_id": produit_id})
+            if not stock_produit:
+                raise HTTPException(status_code=404, detail=f"Stock du produit brut {produit_id} non trouvé")
+            produit_nom = stock_produit.get("produit_nom", "Produit inconnu")
+            raise HTTPException(status_code=400, detail=f"Stock insuffisant pour {produit_nom}")
+        
+        produit_nom = mouvement_sortie.produit_nom or "Produit inconnu"
+        stock_actuel = applied["stock_before"]
+        nouveau_stock = applied["stock_after"]
         
         produits_deduits.append({
             "produit_id": produit_id,
             "produit_nom": produit_nom,
             "quantite_deduite": quantite_brut_necessaire,
             "stock_avant": stock_actuel,
-            "stock_apres": nouveau_stock
+            "stock_apres": nouveau_stock,
+            "lots": applied["lots"]
         })
         
         print(f"   ✅ Produit déduit: {produit_nom} -{quantite_brut_necessaire}")
@@ -8356,22 +10550,46 @@ async def process_z_report_to_real_data(document_id: str):
         
         print(f"📊 Processing {len(productions_detectees)} productions from Z report")
         
-        # 4. Matcher chaque production avec les recettes existantes
-        for prod in productions_detectees:
+        # 4. Matcher toutes les productions avec les recettes existantes (un seul appel)
+        recipe_matches = await match_recipes_by_names([p.get("nom", "") for p in productions_detectees])
+        
+        # Besoins par portion (moteur BOM) : les préparations restent des feuilles, déduites du stock préparations
+        bom_vectors = await bom_engine.vectors(
+            [match["recipe_id"] for match in recipe_matches if match], explode_preparations=False
+        )
+        
+        # Stocks courants (produits et préparations) chargés en une requête chacun : les déductions sont
+        # simulées ligne à ligne en mémoire, puis appliquées en bulk (5.)
+        ingredient_ids = {"produit": set(), "preparation": set()}
+        for vector in bom_vectors.values():
+            for leaf_type, leaf_id in vector:
+                ingredient_ids[leaf_type].add(leaf_id)
+        stock_levels = {
+            stock["produit_id"]: round_stock_quantity(stock.get("quantite_actuelle", 0))
+            for stock in await db.stocks.find(
+                {"produit_id": {"$in": list(ingredient_ids["produit"])}}, {"_id": 0, "produit_id": 1, "quantite_actuelle": 1}
+            ).to_list(None)
+        }
+        preparation_levels = {
+            stock["preparation_id"]: stock.get("quantite_actuelle", 0)
+            for stock in await db.stock_preparations.find(
+                {"preparation_id": {"$in": list(ingredient_ids["preparation"])}}, {"_id": 0, "preparation_id": 1, "quantite_actuelle": 1}
+            ).to_list(None)
+        }
+        stock_lines = []
+        preparation_totals = {}
+        
+        for prod, recipe_match in zip(productions_detectees, recipe_matches):
             prod_name = prod.get("nom", "")
             quantity_sold = prod.get("quantite", 0)
             
             if not prod_name or quantity_sold <= 0:
                 continue
             
-            # Matcher avec les recettes
-            recipe_match = await match_recipe_by_name(prod_name)
-            
-            if recipe_match and recipe_match["confidence"] >= 0.5:
+            if recipe_match and recipe_match["confidence"] >= RECIPE_DEDUCTION_MIN_CONFIDENCE:
                 # Recette trouvée - calculer les déductions de stock
                 recipe_id = recipe_match["recipe_id"]
                 recipe_name = recipe_match["recipe_name"]
-                ingredients = recipe_match["ingredients"]
                 
                 production_info = {
                     "ocr_name": prod_name,
@@ -8382,17 +10600,11 @@ async def process_z_report_to_real_data(document_id: str):
                 }
                 productions_matched.append(production_info)
                 
-                # Calculer les déductions pour chaque ingrédient (PRODUITS et PRÉPARATIONS)
-                for ingredient in ingredients:
-                    # Support ancien format (produit_id) et nouveau format (ingredient_id + ingredient_type)
-                    ingredient_id = ingredient.get("ingredient_id") or ingredient.get("produit_id")
-                    ingredient_type = ingredient.get("ingredient_type", "produit")  # Par défaut "produit" pour compatibilité
-                    ingredient_nom = ingredient.get("ingredient_nom") or ingredient.get("produit_nom", "Ingrédient inconnu")
-                    quantity_per_portion = ingredient.get("quantite", 0)
-                    unit = ingredient.get("unite", "")
-                    
-                    if not ingredient_id:
-                        continue
+                # Calculer les déductions pour chaque ingrédient (PRODUITS et PRÉPARATIONS), par portion vendue
+                for (ingredient_type, ingredient_id), quantity_per_portion in bom_vectors.get(recipe_id, {}).items():
+                    leaf = bom_engine.leaf_info((ingredient_type, ingredient_id))
+                    ingredient_nom = leaf["nom"]
+                    unit = leaf["unite"] or ""
                     
                     # Quantité totale à déduire
                     total_deduction = quantity_per_portion * quantity_sold
@@ -8401,15 +10613,15 @@ async def process_z_report_to_real_data(document_id: str):
                     
                     if ingredient_type == "produit":
                         # ✅ PRODUIT BRUT - Déduire du stock produits
-                        stock = await db.stocks.find_one({"produit_id": ingredient_id})
-                        if stock:
-                            current_stock = round_stock_quantity(stock.get("quantite_actuelle", 0))
+                        if ingredient_id in stock_levels:
+                            current_stock = stock_levels[ingredient_id]
                             total_deduction = round_stock_quantity(total_deduction)
                             new_stock = round_stock_quantity(current_stock - total_deduction)
                             
                             if new_stock < 0:
                                 warnings.append(f"⚠️ Stock produit insuffisant pour {ingredient_nom}: {current_stock} {unit} disponible, {total_deduction} {unit} requis")
                                 new_stock = 0
+                            stock_levels[ingredient_id] = new_stock
                             
                             # Créer la déduction
                             deduction = {
@@ -8426,40 +10638,33 @@ async def process_z_report_to_real_data(document_id: str):
                             }
                             stock_deductions.append(deduction)
                             
-                            # Appliquer la déduction
-                            await db.stocks.update_one(
-                                {"produit_id": ingredient_id},
-                                {
-                                    "$set": {
-                                        "quantite_actuelle": new_stock,
-                                        "derniere_maj": datetime.utcnow()
-                                    }
-                                }
-                            )
-                            
-                            # Créer mouvement de stock
-                            mouvement = MouvementStock(
-                                produit_id=ingredient_id,
-                                produit_nom=ingredient_nom,
-                                type="sortie",
-                                quantite=total_deduction,
-                                reference=f"Z-Report {date_rapport} - {recipe_name}",
-                                commentaire=f"Vente: {quantity_sold} x {recipe_name}"
-                            )
-                            await db.mouvements_stock.insert_one(mouvement.dict())
+                            # Ligne de sortie + mouvement, appliqués en bulk après la boucle
+                            stock_lines.append({
+                                "produit_id": ingredient_id,
+                                "delta": -total_deduction,
+                                "deduction": deduction,
+                                "mouvement": MouvementStock(
+                                    produit_id=ingredient_id,
+                                    produit_nom=ingredient_nom,
+                                    type="sortie",
+                                    quantite=total_deduction,
+                                    reference=f"Z-Report {date_rapport} - {recipe_name}",
+                                    commentaire=f"Vente: {quantity_sold} x {recipe_name}"
+                                )
+                            })
                         else:
                             warnings.append(f"⚠️ Produit {ingredient_id} non trouvé dans les stocks")
                     
                     elif ingredient_type == "preparation":
                         # ✅ PRÉPARATION - Déduire du stock préparations
-                        stock_prep = await db.stock_preparations.find_one({"preparation_id": ingredient_id})
-                        if stock_prep:
-                            current_stock = stock_prep.get("quantite_actuelle", 0)
+                        if ingredient_id in preparation_levels:
+                            current_stock = preparation_levels[ingredient_id]
                             new_stock = current_stock - total_deduction
                             
                             if new_stock < 0:
                                 warnings.append(f"⚠️ Stock préparation insuffisant pour {ingredient_nom}: {current_stock} {unit} disponible, {total_deduction} {unit} requis")
                                 new_stock = 0
+                            preparation_levels[ingredient_id] = new_stock
                             
                             # Créer la déduction
                             deduction = {
@@ -8475,24 +10680,31 @@ async def process_z_report_to_real_data(document_id: str):
                                 "stock_after": new_stock
                             }
                             stock_deductions.append(deduction)
-                            
-                            # Appliquer la déduction
-                            await db.stock_preparations.update_one(
-                                {"preparation_id": ingredient_id},
-                                {
-                                    "$set": {
-                                        "quantite_actuelle": new_stock,
-                                        "derniere_maj": datetime.utcnow()
-                                    }
-                                }
-                            )
+                            preparation_totals[ingredient_id] = preparation_totals.get(ingredient_id, 0) + total_deduction
                             
                             # Note: Pas de mouvement_stock pour les préparations (collection différente)
                             print(f"   ✅ Préparation déduite: {ingredient_nom} -{total_deduction} {unit}")
                         else:
                             warnings.append(f"⚠️ Préparation {ingredient_id} non trouvée dans les stocks de préparations")
+            elif recipe_match:
+                # Rapprochement trop incertain pour déduire du stock : signalé avec la recette proposée
+                warnings.append(f"⚠️ Production '{prod_name}' non déduite : rapprochement incertain avec '{recipe_match['recipe_name']}' (confiance: {recipe_match['confidence']:.2f})")
             else:
-                warnings.append(f"⚠️ Production '{prod_name}' non matchée avec les recettes (confiance: {recipe_match['confidence'] if recipe_match else 0})")
+                warnings.append(f"⚠️ Production '{prod_name}' non matchée avec les recettes (confiance: 0)")
+        
+        # 5. Appliquer toutes les déductions : un bulk_write par collection + un insert_many des mouvements
+        await apply_stock_deltas(stock_lines)
+        for line in stock_lines:
+            line["deduction"]["lots"] = line["mouvement"].lots or []
+        if preparation_totals:
+            now = datetime.utcnow()
+            await db.stock_preparations.bulk_write([
+                UpdateOne({"preparation_id": preparation_id}, [{"$set": {
+                    "quantite_actuelle": _stock_level_expression(-total),
+                    "derniere_maj": now
+                }}])
+                for preparation_id, total in preparation_totals.items()
+            ], ordered=False)
         
         # 6. Créer le rapport Z réel dans la collection rapports_z
         rapport_z_data = {
@@ -8510,6 +10722,7 @@ async def process_z_report_to_real_data(document_id: str):
         
         rapport_z = RapportZ(**rapport_z_data)
         result = await db.rapports_z.insert_one(rapport_z.dict())
+        await register_rapport_z(rapport_z.dict(), [p.get("nom", "") for p in productions_detectees])
         
         # Marquer le document OCR comme traité
         await db.documents_ocr.update_one(
@@ -8566,6 +10779,7 @@ class FactureItemAnalysis(BaseModel):
     product_name: Optional[str] = None
     confidence: float = 0.0
     status: str = "new" # "matched", "new", "ambiguous"
+    candidates: List[dict] = []  # Top-k produits proposés (score décroissant)
     
     # Champs de Validation (à remplir par l'utilisateur)
     selected_product_id: Optional[str] = None # ID final validé (vide si création)
@@ -8594,6 +10808,80 @@ class ImportConfirmationRequest(BaseModel):
     items: List[FactureItemAnalysis]
     supplier_category: str = "frais" # Default category
 
+# ✅ MEMOIRE des corrections OCR par fournisseur (ocr_product_mappings)
+# Table complète d'un fournisseur chargée en une requête, indexée par nom OCR normalisé,
+# invalidée (cache_versions) quand confirm_import_facture apprend une correction.
+LEARNED_MAPPING_FUZZY_CUTOFF = 90
+
+class SupplierMappingCache:
+    """Cache mémoire des corrections apprises, par fournisseur"""
+
+    def __init__(self):
+        self.by_supplier: dict = {}  # supplier_id → {"version", "exact", "keys"}
+
+    @staticmethod
+    def version_key(supplier_id: str) -> str:
+        return f"ocr_product_mappings:{supplier_id}"
+
+    async def get(self, supplier_id: str) -> dict:
+        version = await get_cache_version(self.version_key(supplier_id))
+        cached = self.by_supplier.get(supplier_id)
+        if cached and cached["version"] == version:
+            return cached
+        
+        mappings = await db.ocr_product_mappings.find({"supplier_id": supplier_id}, {"_id": 0}).to_list(None)
+        exact = {}
+        for mapping in sorted(mappings, key=lambda m: m.get("last_used") or datetime.min):
+            # À nom normalisé identique, la correction la plus récente l'emporte
+            exact[normalize_name(mapping["ocr_raw_name"])] = mapping
+        exact.pop("", None)
+        cached = {"version": version, "exact": exact, "keys": list(exact.keys())}
+        self.by_supplier[supplier_id] = cached
+        return cached
+
+    async def lookup_many(self, supplier_id: str, ocr_names: List[str]) -> List[Optional[tuple]]:
+        """(mapping, confiance) pour chaque nom OCR : exact normalisé, sinon fuzzy sur les noms appris"""
+        table = await self.get(supplier_id)
+        results = []
+        for ocr_name in ocr_names:
+            key = normalize_name(ocr_name)
+            if key in table["exact"]:
+                results.append((table["exact"][key], 1.0))
+                continue
+            fuzzy = process.extractOne(key, table["keys"], scorer=fuzz.token_sort_ratio,
+                                       score_cutoff=LEARNED_MAPPING_FUZZY_CUTOFF) if key and table["keys"] else None
+            results.append((table["exact"][fuzzy[0]], fuzzy[1] / 100.0) if fuzzy else None)
+        return results
+
+supplier_mapping_cache = SupplierMappingCache()
+
+async def apply_learned_mappings(supplier_id: Optional[str], items: List[FactureItemAnalysis]):
+    """Appliquer les corrections apprises du fournisseur aux lignes analysées (avant le catalogue)"""
+    if not supplier_id or not items:
+        return
+    learned = await supplier_mapping_cache.lookup_many(supplier_id, [item.ocr_name for item in items])
+    
+    await product_name_index.refresh()
+    products_by_id = {p["id"]: p for p in product_name_index.products}
+    
+    for item, match in zip(items, learned):
+        if not match:
+            continue
+        mapping, confidence = match
+        mapped_product = products_by_id.get(mapping["final_product_id"])
+        if not mapped_product:
+            continue
+        item.product_id = mapped_product["id"]
+        item.product_name = mapped_product["nom"]
+        item.selected_product_id = mapped_product["id"]
+        item.confidence = confidence  # 1.0 : c'est vous qui l'avez dit
+        item.status = "matched"
+        
+        # Si on a appris une correction de quantité (ex: 1 carton -> 10kg)
+        if mapping.get("qty_multiplier") and mapping["qty_multiplier"] != 1.0:
+            item.final_qty = item.ocr_qty * mapping["qty_multiplier"]
+            item.final_unit = mapped_product.get("unite", "kg")
+
 @api_router.post("/ocr/analyze-facture/{document_id}", response_model=FactureAnalysisResult)
 async def analyze_facture_for_review(document_id: str):
     """
@@ -8636,11 +10924,13 @@ async def analyze_facture_for_review(document_id: str):
             result.is_new_supplier = True
             
         # 3. Analyser chaque produit (Matching sans création)
-        produits_facture = donnees_parsees.get("produits", [])
+        produits_facture = [p for p in donnees_parsees.get("produits", []) if p.get("nom")]
         
-        for prod_data in produits_facture:
+        # Matching de toutes les lignes en un seul appel
+        all_candidates = await match_products_by_names([p["nom"] for p in produits_facture])
+        
+        for prod_data, candidates in zip(produits_facture, all_candidates):
             ocr_name = prod_data.get("nom", "")
-            if not ocr_name: continue
             
             item_analysis = FactureItemAnalysis(
                 ocr_name=ocr_name,
@@ -8654,7 +10944,8 @@ async def analyze_facture_for_review(document_id: str):
             )
             
             # Tentative de matching
-            product_match = await match_product_by_name(ocr_name)
+            item_analysis.candidates = candidates
+            product_match = candidates[0] if candidates else None
             
             if product_match and product_match["confidence"] >= 0.6:
                 item_analysis.product_id = product_match["product_id"]
@@ -8666,6 +10957,9 @@ async def analyze_facture_for_review(document_id: str):
                 item_analysis.status = "new"
                 
             result.items.append(item_analysis)
+        
+        # Les corrections apprises pour ce fournisseur priment sur le catalogue
+        await apply_learned_mappings(result.supplier_id, result.items)
             
         return result
         
@@ -8686,8 +10980,8 @@ async def analyze_facture_with_ai_joker(document_id: str):
         if not document:
             raise HTTPException(status_code=404, detail="Document OCR non trouvé")
         
-        # 2. Récupérer l'image en base64
-        image_base64 = document.get("image_base64")
+        # 2. Récupérer l'image en base64 (chargée depuis le blob store)
+        image_base64 = await get_document_data_uri(document)
         if not image_base64:
             raise HTTPException(status_code=400, detail="Image base64 non disponible")
         
@@ -8716,8 +11010,10 @@ async def analyze_facture_with_ai_joker(document_id: str):
         else:
             result.is_new_supplier = True
         
-        # 5. Analyser chaque produit
-        for prod in gemini_result.get("produits", []):
+        # 5. Analyser chaque produit (matching de toutes les lignes en un seul appel)
+        gemini_products = gemini_result.get("produits", [])
+        all_candidates = await match_products_by_names([p.get("nom", "") for p in gemini_products])
+        for prod, candidates in zip(gemini_products, all_candidates):
             item_analysis = FactureItemAnalysis(
                 ocr_name=prod.get("nom", ""),
                 ocr_qty=prod.get("quantite", 0),
@@ -8731,7 +11027,8 @@ async def analyze_facture_with_ai_joker(document_id: str):
             )
             
             # Tentative de matching avec produits existants
-            product_match = await match_product_by_name(prod.get("nom", ""))
+            item_analysis.candidates = candidates
+            product_match = candidates[0] if candidates else None
             
             if product_match and product_match["confidence"] >= 0.7:
                 item_analysis.product_id = product_match["product_id"]
@@ -8743,6 +11040,9 @@ async def analyze_facture_with_ai_joker(document_id: str):
             
             result.items.append(item_analysis)
         
+        # Les corrections apprises pour ce fournisseur priment sur le catalogue
+        await apply_learned_mappings(result.supplier_id, result.items)
+        
         print(f"✅ Gemini Joker : {len(result.items)} produits analysés (confiance: {result.confiance_globale})")
         
         # 6. SAUVEGARDER les résultats Gemini dans le document pour persistance
@@ -8791,28 +11091,6 @@ async def confirm_import_facture(request: ImportConfirmationRequest):
     """
     Step 2 of Reconciliation: Apply validated data to system.
     Creates Products, Suppliers, Stock Movements, and BATCHES with DLC.
-            # ✅ MEMOIRE : Vérifier si on a une correction apprise pour ce produit
-            if result.supplier_id:
-                # Chercher dans la mémoire : (SupplierID + OCR Name) -> ProductID
-                learned = await db.ocr_product_mappings.find_one({
-                    "supplier_id": result.supplier_id,
-                    "ocr_raw_name": ocr_name
-                })
-                
-                if learned:
-                    # On applique ce qu'on a appris !
-                    mapped_product = await db.produits.find_one({"id": learned["final_product_id"]})
-                    if mapped_product:
-                        item_analysis.product_id = mapped_product["id"]
-                        item_analysis.product_name = mapped_product["nom"]
-                        item_analysis.selected_product_id = mapped_product["id"]
-                        item_analysis.confidence = 1.0 # Confiance absolue (c'est vous qui l'avez dit)
-                        item_analysis.status = "matched"
-                        
-                        # Si on a appris une correction de quantité (ex: 1 carton -> 10kg)
-                        if learned.get("qty_multiplier") and learned["qty_multiplier"] != 1.0:
-                            item_analysis.final_qty = item_analysis.ocr_qty * learned["qty_multiplier"]
-                            item_analysis.final_unit = mapped_product.get("unite", "kg")
     """
     try:
         # 1. Gérer le fournisseur
@@ -8838,7 +11116,19 @@ async def confirm_import_facture(request: ImportConfirmationRequest):
         import_stats = {
             "products_created": 0,
             "stock_entries": 0,
-            "batches_created": 0
+            "batches_created": 0,
+            "unit_errors": []  # Lignes rejetées : unité de la facture non convertible dans l'unité du produit
+        }
+        touched_product_ids = []
+        learned_mappings = False
+        
+        # Unités de stock des produits existants (une requête) pour convertir les quantités saisies
+        selected_ids = [item.selected_product_id for item in request.items if item.selected_product_id]
+        stock_products = {
+            product["id"]: product
+            for product in await db.produits.find(
+                {"id": {"$in": selected_ids}}, {"_id": 0, "id": 1, "unite": 1, "poids_piece": 1, "taille_colis": 1}
+            ).to_list(None)
         }
         
         # 2. Traiter chaque ligne validée
@@ -8848,6 +11138,21 @@ async def confirm_import_facture(request: ImportConfirmationRequest):
                 
             product_id = item.selected_product_id
             
+            # Produit existant : la quantité est convertie dans son unité de stock, ou la ligne est rejetée
+            stock_factor = 1.0
+            if product_id in stock_products and item.final_unit:
+                stock_factor = product_unit_factor(item.final_unit, stock_products[product_id])
+                if stock_factor is None:
+                    import_stats["unit_errors"].append({
+                        "ocr_name": item.ocr_name,
+                        "product_id": product_id,
+                        "quantity": item.final_qty,
+                        "unit": item.final_unit,
+                        "product_unit": stock_products[product_id].get("unite"),
+                        "error": f"Unité '{item.final_unit}' non convertible en '{stock_products[product_id].get('unite')}' (poids par pièce ou taille de colis manquant)"
+                    })
+                    continue
+            
             # Création produit si nécessaire (Status 'new' ou 'matched' mais user a choisi 'Créer nouveau')
             if not product_id:
                 # Détection automatique de la catégorie basée sur le nom
@@ -8857,13 +11162,14 @@ async def confirm_import_facture(request: ImportConfirmationRequest):
                 new_product = Produit(
                     nom=product_name,
                     categorie=auto_category,  # ✅ Catégorie auto-détectée !
-                    unite=item.final_unit or "kg",
+                    unite=canonical_unit(item.final_unit) or "kg",
                     reference_price=item.ocr_price,
                     main_supplier_id=supplier_id,
                     fournisseur_id=supplier_id,
                     fournisseur_nom=request.supplier_name
                 )
                 await db.produits.insert_one(new_product.dict())
+                await bump_cache_version("produits")
                 product_id = new_product.id
                 import_stats["products_created"] += 1
                 
@@ -8891,13 +11197,16 @@ async def confirm_import_facture(request: ImportConfirmationRequest):
                     {"$set": {"price": item.ocr_price, "last_updated": datetime.utcnow()}},
                     upsert=True
                 )
+            await record_supplier_price(supplier_id, product_id, item.ocr_price, "facture")
 
+            stock_qty = round_stock_quantity(item.final_qty * stock_factor)
+            
             # 3. CRÉATION DU LOT (BATCH) AVEC DLC
             # C'est ici que la magie opère grâce à la validation utilisateur
             batch_data = {
                 "product_id": product_id,
-                "quantity": item.final_qty,
-                "quantity_brute": item.final_qty,
+                "quantity": stock_qty,
+                "quantity_brute": stock_qty,
                 "expiry_date": item.dlc, # DLC validée par l'utilisateur
                 "batch_number": item.batch_number, # Lot saisi par l'utilisateur
                 "supplier_id": supplier_id,
@@ -8914,28 +11223,20 @@ async def confirm_import_facture(request: ImportConfirmationRequest):
             batch_obj = ProductBatch(**batch_data)
             await db.product_batches.insert_one(batch_obj.dict())
             import_stats["batches_created"] += 1
+            touched_product_ids.append(product_id)
             
-            # 4. Mouvement de Stock
+            # 4. Mouvement de Stock + 5. Mise à jour Quantité Totale Stock
             mouvement = MouvementStock(
                 produit_id=product_id,
                 produit_nom=item.final_name or item.product_name,
                 type="entree",
-                quantite=item.final_qty,
+                quantite=stock_qty,
                 reference=f"FACT-{request.document_id[:8]}",
                 fournisseur_id=supplier_id,
                 commentaire=f"Import Facture {request.document_id[:8]}"
             )
-            await db.mouvements_stock.insert_one(mouvement.dict())
+            await apply_stock_delta(product_id, stock_qty, mouvement, record_if_missing=True, refresh_alerts=False)
             import_stats["stock_entries"] += 1
-            
-            # 5. Mise à jour Quantité Totale Stock
-            stock = await db.stocks.find_one({"produit_id": product_id})
-            if stock:
-                new_qty = round_stock_quantity(stock["quantite_actuelle"] + item.final_qty)
-                await db.stocks.update_one(
-                    {"produit_id": product_id},
-                    {"$set": {"quantite_actuelle": new_qty, "derniere_maj": datetime.utcnow()}}
-                )
             # ✅ APPRENTISSAGE : On sauvegarde la correction pour la prochaine fois
             # Si le nom OCR est différent du nom final, on apprend !
             if item.ocr_name and product_id and supplier_id:
@@ -8955,11 +11256,17 @@ async def confirm_import_facture(request: ImportConfirmationRequest):
                             "final_product_id": product_id,
                             "final_product_name": item.final_name,
                             "qty_multiplier": qty_multiplier,
+                            "ocr_normalized_name": normalize_name(item.ocr_name),
                             "last_used": datetime.utcnow()
                         }
                     },
                     upsert=True
                 )
+                learned_mappings = True
+
+        if learned_mappings:
+            await bump_cache_version(SupplierMappingCache.version_key(supplier_id))
+        await refresh_stock_alerts(touched_product_ids)
 
         # Marquer document comme traité
         await db.documents_ocr.update_one(
@@ -9034,8 +11341,13 @@ async def process_facture_to_real_data(document_id: str):
         warnings = []
         errors = []
         
+        # Matching de toutes les lignes en un seul appel ; les produits créés pendant
+        # l'import sont réutilisés si le même libellé réapparaît plus loin dans la facture
+        all_candidates = await match_products_by_names([p.get("nom", "") for p in produits_facture], top_k=1)
+        created_products = {}
+        
         # 4. Traiter chaque produit de la facture
-        for prod_data in produits_facture:
+        for prod_data, candidates in zip(produits_facture, all_candidates):
             prod_name = prod_data.get("nom", "")
             quantity = prod_data.get("quantite", 0)
             unit_price = prod_data.get("prix_unitaire", 0)
@@ -9046,7 +11358,7 @@ async def process_facture_to_real_data(document_id: str):
                 continue
             
             # Matcher avec les produits existants
-            product_match = await match_product_by_name(prod_name)
+            product_match = created_products.get(prod_name.strip().lower()) or (candidates[0] if candidates else None)
             
             product_id = None
             product_name_final = prod_name
@@ -9099,6 +11411,7 @@ async def process_facture_to_real_data(document_id: str):
                         is_preferred=True
                     )
                     await db.supplier_product_info.insert_one(new_relation.dict())
+                await record_supplier_price(supplier_id, product_id, unit_price, "facture")
                 
             else:
                 # Produit non trouvé - créer un nouveau produit
@@ -9112,9 +11425,15 @@ async def process_facture_to_real_data(document_id: str):
                     fournisseur_nom=supplier_name  # Legacy
                 )
                 await db.produits.insert_one(new_product.dict())
+                await bump_cache_version("produits")
                 product_id = new_product.id
                 products_created += 1
                 needs_creation = True
+                created_products[prod_name.strip().lower()] = {
+                    "product_id": product_id,
+                    "product_name": prod_name,
+                    "confidence": 1.0
+                }
                 
                 # Créer le stock initial
                 new_stock = Stock(
@@ -9133,37 +11452,22 @@ async def process_facture_to_real_data(document_id: str):
                     is_preferred=True
                 )
                 await db.supplier_product_info.insert_one(new_relation.dict())
+                await record_supplier_price(supplier_id, product_id, unit_price, "facture")
                 
                 warnings.append(f"✨ Nouveau produit créé: {prod_name}")
             
-            # 5. Créer l'entrée de stock
-            stock = await db.stocks.find_one({"produit_id": product_id})
-            if stock:
-                current_stock = round_stock_quantity(stock.get("quantite_actuelle", 0))
-                quantity = round_stock_quantity(quantity)
-                new_stock_level = round_stock_quantity(current_stock + quantity)
-                
-                await db.stocks.update_one(
-                    {"produit_id": product_id},
-                    {
-                        "$set": {
-                            "quantite_actuelle": new_stock_level,
-                            "derniere_maj": datetime.utcnow()
-                        }
-                    }
-                )
-                
-                # Créer un mouvement de stock
-                mouvement = MouvementStock(
-                    produit_id=product_id,
-                    produit_nom=product_name_final,
-                    type="entree",
-                    quantite=quantity,
-                    reference=f"Facture {numero_facture}",
-                    fournisseur_id=supplier_id,
-                    commentaire=f"Livraison {supplier_name} - {facture_date}"
-                )
-                await db.mouvements_stock.insert_one(mouvement.dict())
+            # 5. Créer l'entrée de stock (delta atomique + mouvement)
+            quantity = round_stock_quantity(quantity)
+            mouvement = MouvementStock(
+                produit_id=product_id,
+                produit_nom=product_name_final,
+                type="entree",
+                quantite=quantity,
+                reference=f"Facture {numero_facture}",
+                fournisseur_id=supplier_id,
+                commentaire=f"Livraison {supplier_name} - {facture_date}"
+            )
+            if await apply_stock_delta(product_id, quantity, mouvement, refresh_alerts=False):
                 stock_entries_created += 1
             
             # Ajouter au résultat
@@ -9179,6 +11483,7 @@ async def process_facture_to_real_data(document_id: str):
                 needs_creation=needs_creation
             )
             products_matched.append(match_result)
+        await refresh_stock_alerts([pm.matched_product_id for pm in products_matched])
         
         # 6. Créer la commande fournisseur dans l'historique
         order_items = [
@@ -9294,8 +11599,13 @@ async def process_mercuriale_to_real_data(document_id: str):
         warnings = []
         errors = []
         
+        # Matching de toutes les lignes en un seul appel
+        all_candidates = await match_products_by_names(
+            [p.get("nom", "") for p in produits_mercuriale], min_confidence=0.7, top_k=1
+        )
+        
         # 4. Traiter chaque produit de la mercuriale
-        for prod_data in produits_mercuriale:
+        for prod_data, candidates in zip(produits_mercuriale, all_candidates):
             prod_name = prod_data.get("nom", "")
             new_price = prod_data.get("prix_unitaire", 0)
             unit = prod_data.get("unite", "kg")
@@ -9304,7 +11614,7 @@ async def process_mercuriale_to_real_data(document_id: str):
                 continue
             
             # Matcher avec les produits existants
-            product_match = await match_product_by_name(prod_name, min_confidence=0.7)
+            product_match = candidates[0] if candidates else None
             
             if product_match and product_match["confidence"] >= 0.7:
                 product_id = product_match["product_id"]
@@ -9364,6 +11674,7 @@ async def process_mercuriale_to_real_data(document_id: str):
                             is_preferred=False
                         )
                         await db.supplier_product_info.insert_one(new_relation.dict())
+                    await record_supplier_price(supplier_id, product_id, new_price, "mercuriale")
                     
                     prices_updated += 1
                 else:
@@ -9404,9 +11715,243 @@ async def process_mercuriale_to_real_data(document_id: str):
         raise HTTPException(status_code=500, detail=f"Erreur lors du traitement de la mercuriale: {str(e)}")
 
 
+# ===== INDEX MANAGEMENT =====
+# Index requis par collection pour les lookups chauds (find_one par id, stock par produit, lots FEFO...)
+# Chaque entrée: {"keys": [(champ, direction), ...], "unique": bool}
+# La création est idempotente : un index déjà présent avec les mêmes clés est ignoré.
+REQUIRED_INDEXES = {
+    "produits": [
+        {"keys": [("id", 1)], "unique": True},
+        {"keys": [("nom", 1), ("id", 1)]},
+    ],
+    "stocks": [
+        {"keys": [("produit_id", 1)]},
+        {"keys": [("produit_nom", 1), ("id", 1)]},
+    ],
+    "product_batches": [
+        {"keys": [("id", 1)], "unique": True},
+        {"keys": [("product_id", 1), ("is_consumed", 1), ("expiry_date", 1), ("received_date", 1)]},
+        {"keys": [("is_consumed", 1), ("expiry_date", 1)]},
+    ],
+    "mouvements_stock": [
+        {"keys": [("date", -1), ("id", -1)]},
+        {"keys": [("produit_id", 1), ("date", -1)]},
+    ],
+    "ocr_product_mappings": [
+        {"keys": [("supplier_id", 1), ("ocr_raw_name", 1)], "unique": True},
+    ],
+    "user_sessions": [
+        {"keys": [("session_id", 1)], "unique": True},
+    ],
+    "users": [
+        {"keys": [("id", 1)], "unique": True},
+        {"keys": [("username", 1)]},
+        {"keys": [("email", 1)]},
+    ],
+    "supplier_product_info": [
+        {"keys": [("product_id", 1), ("is_preferred", 1)]},
+        {"keys": [("supplier_id", 1), ("product_id", 1)]},
+    ],
+    "fournisseurs": [
+        {"keys": [("id", 1)], "unique": True},
+    ],
+    "recettes": [
+        {"keys": [("id", 1)], "unique": True},
+        {"keys": [("categorie", 1)]},
+    ],
+    "preparations": [
+        {"keys": [("id", 1)], "unique": True},
+        {"keys": [("produit_id", 1)]},
+    ],
+    "stock_preparations": [
+        {"keys": [("preparation_id", 1)]},
+    ],
+    "documents_ocr": [
+        {"keys": [("id", 1)], "unique": True},
+        {"keys": [("type_document", 1), ("date_upload", -1)]},
+        {"keys": [("blob_sha256", 1)]},
+    ],
+    "ocr_blobs.files": [
+        {"keys": [("filename", 1), ("uploadDate", 1)]},
+    ],
+    "ocr_upload_cache": [
+        {"keys": [("sha256", 1), ("document_type", 1)], "unique": True},
+    ],
+    "ocr_jobs": [
+        {"keys": [("id", 1)], "unique": True},
+        {"keys": [("status", 1), ("created_at", 1)]},
+        {"keys": [("blob_sha256", 1), ("status", 1)]},
+    ],
+    "rapports_z": [
+        {"keys": [("id", 1)], "unique": True},
+        {"keys": [("date", -1)]},
+    ],
+    "sales_daily": [
+        {"keys": [("kind", 1), ("day", 1), ("name_key", 1)], "unique": True},
+        {"keys": [("kind", 1), ("name_key", 1)]},
+    ],
+    "z_name_aliases": [
+        {"keys": [("normalized_name", 1)], "unique": True},
+        {"keys": [("recipe_id", 1)]},
+    ],
+    "orders": [
+        {"keys": [("id", 1)], "unique": True},
+        {"keys": [("order_date", -1), ("id", -1)]},
+        {"keys": [("supplier_id", 1), ("order_date", -1)]},
+        {"keys": [("status", 1), ("order_date", -1)]},
+    ],
+    "missions": [
+        {"keys": [("assigned_date", -1), ("id", -1)]},
+        {"keys": [("assigned_to_user_id", 1), ("assigned_date", -1)]},
+        {"keys": [("assigned_by_user_id", 1), ("assigned_date", -1)]},
+    ],
+    "notifications": [
+        {"keys": [("user_id", 1), ("created_at", -1)]},
+    ],
+    "price_anomaly_alerts": [
+        {"keys": [("is_resolved", 1)]},
+    ],
+    "archived_items": [
+        {"keys": [("archived_at", -1), ("id", -1)]},
+        {"keys": [("item_type", 1), ("archived_at", -1)]},
+    ],
+    "advanced_stock_adjustments": [
+        {"keys": [("created_at", -1), ("id", -1)]},
+    ],
+    "alerts": [
+        {"keys": [("key", 1)], "unique": True},
+        {"keys": [("type", 1), ("sort_date", 1)]},
+        {"keys": [("product_id", 1), ("type", 1)]},
+    ],
+    "supplier_price_history": [
+        {"keys": [("date", -1)]},
+        {"keys": [("product_id", 1), ("date", -1)]},
+    ],
+}
+
+# Mode vérification : INDEX_CHECK_MODE=strict → le démarrage échoue si un index requis manque
+# (aucune création automatique dans ce mode, pour détecter les oublis en CI / préproduction)
+INDEX_CHECK_MODE = os.environ.get('INDEX_CHECK_MODE', 'create').lower()
+
+def index_name_for(keys: List[tuple]) -> str:
+    """Nom d'index conventionnel MongoDB (ex: product_id_1_is_consumed_1)"""
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+async def get_missing_indexes() -> List[dict]:
+    """Liste les index déclarés dans REQUIRED_INDEXES absents de la base"""
+    missing = []
+    for collection_name, specs in REQUIRED_INDEXES.items():
+        existing = await db[collection_name].index_information()
+        existing_keys = {tuple(tuple(k) for k in info["key"]) for info in existing.values()}
+        for spec in specs:
+            if tuple(spec["keys"]) not in existing_keys:
+                missing.append({
+                    "collection": collection_name,
+                    "name": index_name_for(spec["keys"]),
+                    "keys": spec["keys"],
+                    "unique": spec.get("unique", False)
+                })
+    return missing
+
+async def ensure_indexes() -> dict:
+    """Créer les index manquants (idempotent). Retourne les index créés et les échecs."""
+    created = []
+    failed = []
+    for index in await get_missing_indexes():
+        try:
+            await db[index["collection"]].create_index(
+                index["keys"],
+                name=index["name"],
+                unique=index["unique"],
+                background=True
+            )
+            created.append(f"{index['collection']}.{index['name']}")
+        except Exception as e:
+            # Ex: doublons existants empêchant un index unique
+            failed.append({"index": f"{index['collection']}.{index['name']}", "error": str(e)})
+    return {"created": created, "failed": failed}
+
+async def audit_indexes() -> dict:
+    """Rapport d'index: manquants, non déclarés et jamais utilisés depuis le dernier redémarrage mongod"""
+    missing = await get_missing_indexes()
+    undeclared = []
+    unused = []
+
+    for collection_name, specs in REQUIRED_INDEXES.items():
+        declared_keys = {tuple(spec["keys"]) for spec in specs}
+        try:
+            stats = await db[collection_name].aggregate([{"$indexStats": {}}]).to_list(None)
+        except Exception:
+            stats = []
+        for stat in stats:
+            if stat["name"] == "_id_":
+                continue
+            keys = tuple((field, int(direction)) for field, direction in stat["key"].items())
+            ops = stat.get("accesses", {}).get("ops", 0)
+            entry = {
+                "collection": collection_name,
+                "name": stat["name"],
+                "ops": ops,
+                "since": stat.get("accesses", {}).get("since")
+            }
+            if keys not in declared_keys:
+                undeclared.append(entry)
+            if ops == 0:
+                unused.append(entry)
+
+    return {
+        "missing": missing,
+        "undeclared": undeclared,
+        "unused": unused,
+        "is_healthy": len(missing) == 0
+    }
+
+@api_router.get("/admin/indexes")
+async def get_index_report(strict: bool = False):
+    """Rapport des index MongoDB (Super Admin). strict=true → 500 si un index requis manque."""
+    report = await audit_indexes()
+    if strict and not report["is_healthy"]:
+        missing_names = [f"{m['collection']}.{m['name']}" for m in report["missing"]]
+        raise HTTPException(status_code=500, detail=f"Index manquants: {', '.join(missing_names)}")
+    return report
+
+@api_router.post("/admin/indexes/ensure")
+async def ensure_indexes_endpoint():
+    """Créer les index manquants à la demande (Super Admin)"""
+    return await ensure_indexes()
+
+
 # Include the router in the main app
 @app.on_event("startup")
 async def startup_db_client():
+    # Index : création idempotente, ou vérification stricte si INDEX_CHECK_MODE=strict
+    if INDEX_CHECK_MODE == "strict":
+        missing = await get_missing_indexes()
+        if missing:
+            missing_names = [f"{m['collection']}.{m['name']}" for m in missing]
+            raise RuntimeError(f"❌ Index MongoDB manquants (INDEX_CHECK_MODE=strict): {', '.join(missing_names)}")
+        print("✅ Tous les index requis sont présents.")
+    else:
+        try:
+            index_result = await ensure_indexes()
+            if index_result["created"]:
+                print(f"🗂️ Index créés: {', '.join(index_result['created'])}")
+            for failure in index_result["failed"]:
+                print(f"⚠️ Création d'index impossible {failure['index']}: {failure['error']}")
+        except Exception as e:
+            print(f"⚠️ Erreur lors de la création des index: {str(e)}")
+
+    # Alias des libellés puis rollup des ventes : rattrapage des rapports Z antérieurs (les alias d'abord,
+    # le rollup y recopie recette et catégorie)
+    try:
+        await backfill_z_name_aliases()
+    except Exception as e:
+        print(f"⚠️ Erreur lors de la construction des alias Z: {str(e)}")
+    try:
+        await backfill_sales_rollup()
+    except Exception as e:
+        print(f"⚠️ Erreur lors de la construction du rollup sales_daily: {str(e)}")
+
     try:
         # Vérifier si la base est vide (pas d'utilisateurs)
         user_count = await db.users.count_documents({})
@@ -9419,6 +11964,15 @@ async def startup_db_client():
     except Exception as e:
         print(f"⚠️ Erreur lors de l'initialisation automatique: {str(e)}")
 
+    # Balayage périodique des alertes (DLC, stock dormant)
+    app.state.background_tasks = [asyncio.create_task(run_alert_sweeper())]
+    
+    # Workers OCR intégrés (OCR_JOB_WORKERS=0 si les workers tournent via ocr_worker.py)
+    for i in range(OCR_JOB_WORKERS):
+        app.state.background_tasks.append(
+            asyncio.create_task(run_ocr_job_worker(f"api-{os.getpid()}-{i}"))
+        )
+
 app.include_router(api_router)
 
 app.add_middleware(
@@ -9427,6 +11981,7 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 # Configure logging
@@ -9438,4 +11993,8 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+    ocr_cpu_executor.shutdown()
+    ocr_io_executor.shutdown()
     client.close()
\ No newline at end of file
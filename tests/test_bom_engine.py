@@ -0,0 +1,101 @@
+import pytest
+
+from server import BomEngine
+
+
+@pytest.fixture
+def engine():
+    """Moteur BOM alimenté en mémoire (vector() ne lit pas la base)"""
+    engine = BomEngine()
+    engine.products = {
+        "boeuf": {"id": "boeuf", "nom": "Bœuf", "unite": "kg"},
+        "lait": {"id": "lait", "nom": "Lait", "unite": "L"},
+        "oeuf": {"id": "oeuf", "nom": "Œuf", "unite": "pièce", "poids_piece": 60},
+    }
+    engine.preparations = {
+        # Rendement par quantités : 1,25 kg de brut pour 1 kg préparé
+        "hache": {"id": "hache", "nom": "Bœuf haché", "produit_id": "boeuf", "quantite_produit_brut": 1.25,
+                  "unite_produit_brut": "kg", "quantite_preparee": 1, "unite_preparee": "kg"},
+        # Rendement par pourcentage de perte : 20 % → 1 / 0,8
+        "pare": {"id": "pare", "nom": "Bœuf paré", "produit_id": "boeuf", "quantite_produit_brut": 0,
+                 "unite_produit_brut": "kg", "quantite_preparee": 0, "unite_preparee": "kg", "perte_pourcentage": 20},
+        # Préparation dérivée d'une préparation : 2 kg de haché pour 1 kg de farce
+        "farce": {"id": "farce", "nom": "Farce", "produit_id": "hache", "quantite_produit_brut": 2,
+                  "unite_produit_brut": "kg", "quantite_preparee": 1, "unite_preparee": "kg"},
+        # Cycle : non décomposable
+        "cycle_a": {"id": "cycle_a", "nom": "Cycle A", "produit_id": "cycle_b", "quantite_produit_brut": 1,
+                    "unite_produit_brut": "kg", "quantite_preparee": 1, "unite_preparee": "kg"},
+        "cycle_b": {"id": "cycle_b", "nom": "Cycle B", "produit_id": "cycle_a", "quantite_produit_brut": 1,
+                    "unite_produit_brut": "kg", "quantite_preparee": 1, "unite_preparee": "kg"},
+    }
+    engine.recipes = {
+        "burger": {"id": "burger", "nom": "Burger", "portions": 4, "ingredients": [
+            {"ingredient_id": "hache", "ingredient_type": "preparation", "quantite": 800, "unite": "g"},
+            {"produit_id": "lait", "quantite": 50, "unite": "cL"},
+            {"produit_id": "oeuf", "quantite": 4, "unite": "pièce"},
+        ]},
+        "omelette": {"id": "omelette", "nom": "Omelette", "portions": 1, "ingredients": [
+            {"produit_id": "oeuf", "quantite": 120, "unite": "g"},
+        ]},
+        "pave": {"id": "pave", "nom": "Pavé", "portions": 2, "ingredients": [
+            {"ingredient_id": "pare", "ingredient_type": "preparation", "quantite": 0.4, "unite": "kg"},
+        ]},
+        "farci": {"id": "farci", "nom": "Légume farci", "portions": 1, "ingredients": [
+            {"ingredient_id": "farce", "ingredient_type": "preparation", "quantite": 100, "unite": "g"},
+        ]},
+        "boucle": {"id": "boucle", "nom": "Boucle", "portions": 1, "ingredients": [
+            {"ingredient_id": "cycle_a", "ingredient_type": "preparation", "quantite": 1, "unite": "kg"},
+        ]},
+        "botte": {"id": "botte", "nom": "Botte", "portions": 1, "ingredients": [
+            {"produit_id": "lait", "quantite": 3, "unite": "botte"},
+        ]},
+    }
+    return engine
+
+
+def test_yield_and_unit_conversion(engine):
+    # 800 g / 4 portions = 0,2 kg de haché → 0,25 kg de bœuf ; 50 cL / 4 = 0,125 L ; 1 œuf
+    assert engine.vector("burger") == pytest.approx({
+        ("produit", "boeuf"): 0.25, ("produit", "lait"): 0.125, ("produit", "oeuf"): 1.0
+    })
+    assert engine.issues["burger"] == []
+
+
+def test_preparations_kept_as_leaves(engine):
+    assert engine.vector("burger", explode_preparations=False) == pytest.approx({
+        ("preparation", "hache"): 0.2, ("produit", "lait"): 0.125, ("produit", "oeuf"): 1.0
+    })
+
+
+def test_piece_weight_conversion(engine):
+    # 120 g d'œuf à 60 g la pièce → 2 pièces
+    assert engine.vector("omelette") == pytest.approx({("produit", "oeuf"): 2.0})
+
+
+def test_loss_percentage_yield(engine):
+    # 0,2 kg paré par portion, 20 % de perte → 0,25 kg brut
+    assert engine.vector("pave") == pytest.approx({("produit", "boeuf"): 0.25})
+
+
+def test_nested_preparation(engine):
+    # 0,1 kg de farce → 0,2 kg de haché → 0,25 kg de bœuf
+    assert engine.vector("farci") == pytest.approx({("produit", "boeuf"): 0.25})
+    assert engine.preparation_vector("farce") == pytest.approx({("produit", "boeuf"): 2.5})
+
+
+def test_cyclic_preparation_is_reported(engine):
+    assert engine.vector("boucle") == {("preparation", "cycle_a"): 1.0}
+    assert engine.preparation_vector("cycle_a") is None
+    assert any("non décomposable" in issue for issue in engine.issues["boucle"])
+
+
+def test_unknown_unit_kept_with_warning(engine):
+    assert engine.vector("botte") == {("produit", "lait"): 3.0}
+    assert engine.issues["botte"]
+
+
+def test_vectors_are_memoized(engine):
+    first = engine.vector("burger")
+    engine.recipes["burger"]["portions"] = 8
+    assert engine.vector("burger") is first
+    assert engine.vector("inconnue") == {}
@@ -0,0 +1,186 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from server import (
+    DeliveryRules,
+    Fournisseur,
+    calculate_delivery_date,
+    calendar_order_slots,
+    compile_delivery_calendar,
+    next_weekday_offset,
+    parse_delivery_time,
+)
+
+
+def legacy_calculate_delivery_date(supplier: Fournisseur, order_date: datetime = None) -> dict:
+    """Implémentation jour par jour d'avant le calendrier compilé (référence de parité)"""
+    if order_date is None:
+        order_date = datetime.now()
+    
+    # Si pas de règles définies, utiliser le délai par défaut
+    if not supplier.delivery_rules:
+        estimated = order_date + timedelta(days=2)
+        return {
+            'estimated_date': estimated,
+            'can_order_today': True,
+            'next_order_date': order_date,
+            'explanation': 'Livraison estimée sous 2 jours (règles par défaut)'
+        }
+    
+    rules = supplier.delivery_rules
+    day_names_fr = ['lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche']
+    current_day_name = day_names_fr[order_date.weekday()].lower()
+    current_hour = order_date.hour
+    
+    # Vérifier si on peut commander aujourd'hui
+    can_order_today = False
+    if rules.order_days:
+        order_days_lower = [d.lower() for d in rules.order_days]
+        if current_day_name in order_days_lower and current_hour < rules.order_deadline_hour:
+            can_order_today = True
+    else:
+        # Si pas de jours spécifiés, on peut commander tous les jours avant deadline
+        can_order_today = current_hour < rules.order_deadline_hour
+    
+    # Trouver la prochaine date de commande possible
+    next_order_date = order_date
+    if not can_order_today:
+        # Chercher le prochain jour de commande
+        for i in range(1, 8):
+            test_date = order_date + timedelta(days=i)
+            test_day_name = day_names_fr[test_date.weekday()].lower()
+            if rules.order_days:
+                order_days_lower = [d.lower() for d in rules.order_days]
+                if test_day_name in order_days_lower:
+                    next_order_date = test_date.replace(hour=9, minute=0, second=0)
+                    break
+            else:
+                next_order_date = test_date.replace(hour=9, minute=0, second=0)
+                break
+    
+    # Calculer la date de livraison
+    if rules.delivery_days:
+        # Livraison à des jours spécifiques (ex: Royaume des Mers → Mar/Sam)
+        delivery_days_lower = [d.lower() for d in rules.delivery_days]
+        base_date = next_order_date if not can_order_today else order_date
+        
+        # Chercher le prochain jour de livraison
+        for i in range(1, 15):  # Chercher jusqu'à 2 semaines
+            test_date = base_date + timedelta(days=i)
+            test_day_name = day_names_fr[test_date.weekday()].lower()
+            if test_day_name in delivery_days_lower:
+                estimated_date = test_date.replace(hour=int(rules.delivery_time.split(':')[0]), 
+                                                   minute=int(rules.delivery_time.split(':')[1]), 
+                                                   second=0)
+                break
+    else:
+        # Livraison après un délai fixe (ex: METRO → lendemain)
+        delay = rules.delivery_delay_days or 1
+        base_date = next_order_date if not can_order_today else order_date
+        estimated_date = base_date + timedelta(days=delay)
+        
+        # Gérer les règles spéciales (ex: METRO samedi → +1 jour)
+        if rules.special_rules and 'samedi' in rules.special_rules.lower():
+            if day_names_fr[estimated_date.weekday()].lower() == 'samedi':
+                estimated_date += timedelta(days=2)  # Samedi → Lundi
+        
+        estimated_date = estimated_date.replace(hour=int(rules.delivery_time.split(':')[0]), 
+                                               minute=int(rules.delivery_time.split(':')[1]), 
+                                               second=0)
+    
+    # Créer l'explication
+    if can_order_today:
+        explanation = f"Commande aujourd'hui avant {rules.order_deadline_hour}h → Livraison le {estimated_date.strftime('%A %d/%m/%Y à %Hh%M')}"
+    else:
+        explanation = f"Prochaine commande possible: {next_order_date.strftime('%A %d/%m/%Y')} avant {rules.order_deadline_hour}h → Livraison le {estimated_date.strftime('%A %d/%m/%Y à %Hh%M')}"
+    
+    return {
+        'estimated_date': estimated_date,
+        'can_order_today': can_order_today,
+        'next_order_date': next_order_date,
+        'explanation': explanation
+    }
+
+
+# Formes de règles documentées dans calculate_delivery_date
+SUPPLIER_RULES = {
+    "metro": DeliveryRules(
+        order_days=["lundi", "mardi", "mercredi", "jeudi", "vendredi", "samedi"],
+        order_deadline_hour=11, delivery_delay_days=1, delivery_time="12:00",
+        special_rules="Livraison du samedi reportée au lundi"
+    ),
+    "montaner": DeliveryRules(
+        order_days=["mardi", "vendredi"], order_deadline_hour=11, delivery_delay_days=1, delivery_time="11:00"
+    ),
+    "royaume_des_mers": DeliveryRules(
+        order_deadline_hour=12, delivery_days=["mardi", "samedi"], delivery_time="11:00"
+    ),
+    "sans_regles": None,
+}
+
+# Une semaine complète (lundi 19/10/2026 → dimanche), autour des heures limites 11h et 12h
+ORDER_DATES = [
+    datetime(2026, 10, 19 + day, hour, minute, 17)
+    for day in range(7)
+    for hour, minute in [(0, 0), (8, 30), (10, 59), (11, 0), (11, 1), (11, 59), (12, 0), (12, 1), (18, 0), (23, 59)]
+]
+
+
+@pytest.mark.parametrize("name", list(SUPPLIER_RULES))
+@pytest.mark.parametrize("stored", [False, True], ids=["compile_a_la_volee", "calendrier_enregistre"])
+def test_calendar_matches_legacy_algorithm(name, stored):
+    rules = SUPPLIER_RULES[name]
+    supplier = Fournisseur(nom=name, delivery_rules=rules)
+    if stored:
+        supplier.delivery_calendar = compile_delivery_calendar(rules)
+    for order_date in ORDER_DATES:
+        assert calculate_delivery_date(supplier, order_date) == legacy_calculate_delivery_date(supplier, order_date), order_date
+
+
+def test_calendar_accepts_rules_as_stored_dict():
+    rules = SUPPLIER_RULES["montaner"]
+    assert compile_delivery_calendar(rules.dict()) == compile_delivery_calendar(rules)
+
+
+def test_compiled_masks():
+    metro = compile_delivery_calendar(SUPPLIER_RULES["metro"])
+    assert metro["order_mask"] == 0b0111111
+    assert metro["delivery_mask"] == 0
+    assert metro["saturday_to_monday"] is True
+    royaume = compile_delivery_calendar(SUPPLIER_RULES["royaume_des_mers"])
+    assert royaume["order_mask"] == 0b1111111
+    assert royaume["delivery_mask"] == (1 << 1) | (1 << 5)
+    assert (royaume["delivery_hour"], royaume["delivery_minute"]) == (11, 0)
+
+
+def test_next_weekday_offset_matches_day_walk():
+    for mask in range(1, 128):
+        for weekday in range(7):
+            expected = next(i for i in range(1, 8) if mask >> ((weekday + i) % 7) & 1)
+            assert next_weekday_offset(mask, weekday) == expected
+    assert next_weekday_offset(0, 3) is None
+
+
+def test_order_slots_skip_passed_deadline():
+    calendar = compile_delivery_calendar(SUPPLIER_RULES["montaner"])
+    # Mardi 20/10/2026 à 12h : l'heure limite du jour est passée, prochains créneaux vendredi puis mardi
+    slots = calendar_order_slots(calendar, datetime(2026, 10, 20, 12, 0), 14)
+    assert [slot["commander_avant"] for slot in slots] == [
+        datetime(2026, 10, 23, 11), datetime(2026, 10, 27, 11), datetime(2026, 10, 30, 11)
+    ]
+    assert slots[0]["livraison_estimee"] == datetime(2026, 10, 24, 11, 0)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("12:00", (12, 0)), ("11:30", (11, 30)), ("11h", (11, 0)), ("12h00", (12, 0)), ("9H30", (9, 30)),
+    (" 8 h 15 ", (8, 15)), ("7", (7, 0)),
+    ("midi", (12, 0)), ("25:00", (12, 0)), ("11:75", (12, 0)), ("", (12, 0)), (None, (12, 0)),
+])
+def test_parse_delivery_time(value, expected):
+    assert parse_delivery_time(value) == expected
+
+
+def test_free_text_delivery_time_compiles():
+    calendar = compile_delivery_calendar(DeliveryRules(order_days=["mardi"], delivery_time="11h"))
+    assert (calendar["delivery_hour"], calendar["delivery_minute"]) == (11, 0)
@@ -0,0 +1,24 @@
+import pytest
+
+from server import normalize_name
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("Crème Brûlée", "creme brulee"),
+    ("  Filet de Bœuf  ", "filet boeuf"),
+    ("Pavé de saumon, sauce à l'oseille", "pave saumon sauce oseille"),
+    ("TARTARE-DE-BOEUF (x2)", "tartare boeuf x2"),
+    ("Le Burger du Chef", "burger chef"),
+])
+def test_normalize_name(raw, expected):
+    assert normalize_name(raw) == expected
+
+
+@pytest.mark.parametrize("raw", [None, "", "   ", "!!!", "de la"])
+def test_normalize_name_empty(raw):
+    assert normalize_name(raw) == ""
+
+
+def test_normalize_name_is_idempotent():
+    once = normalize_name("Salade César & Poulet grillé")
+    assert normalize_name(once) == once
@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException, Response
+
+from server import date_range_filter, decode_cursor, encode_cursor, paginate
+
+
+@pytest.mark.parametrize("sort_value", [datetime(2026, 10, 17, 9, 30, 5, 123456), "Carottes", 42, 3.5, None])
+def test_cursor_round_trip(sort_value):
+    assert decode_cursor(encode_cursor(sort_value, "id-1")) == (sort_value, "id-1")
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor("Crème brûlée / ½", "id?&=")
+    assert all(c.isalnum() or c in "-_=" for c in cursor)
+
+
+@pytest.mark.parametrize("cursor", ["", "pas-un-curseur", "eyJ0IjogImRhdGUifQ=="])
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as exc:
+        decode_cursor(cursor)
+    assert exc.value.status_code == 400
+
+
+def test_date_range_filter():
+    start, end = datetime(2026, 10, 1), datetime(2026, 10, 31)
+    assert date_range_filter("date", start, end) == {"date": {"$gte": start, "$lte": end}}
+    assert date_range_filter("date", None, end) == {"date": {"$lte": end}}
+    assert date_range_filter("date", None, None) == {}
+
+
+class RecordingCollection:
+    """Collection factice : mémorise la requête passée à find()"""
+
+    def __init__(self):
+        self.query = None
+
+    def find(self, query, projection=None):
+        self.query = query
+        return self
+
+    def sort(self, keys):
+        return self
+
+    def limit(self, n):
+        return self
+
+    async def to_list(self, length):
+        return []
+
+
+def paginate_query(descending, cursor):
+    collection = RecordingCollection()
+    asyncio.run(paginate(collection, {"type": "sortie"}, "date", descending, 20, cursor, Response()))
+    return collection.query
+
+
+def test_descending_page_keeps_null_values():
+    query = paginate_query(True, encode_cursor(42, "id-9"))
+    assert query == {"$and": [{"type": "sortie"}, {"$or": [
+        {"date": {"$lt": 42}}, {"date": None}, {"date": 42, "id": {"$lt": "id-9"}}
+    ]}]}
+
+
+def test_ascending_page_after_values():
+    query = paginate_query(False, encode_cursor(42, "id-9"))
+    assert query == {"$and": [{"type": "sortie"}, {"$or": [
+        {"date": {"$gt": 42}}, {"date": 42, "id": {"$gt": "id-9"}}
+    ]}]}
+
+
+def test_page_after_null_value():
+    assert paginate_query(True, encode_cursor(None, "id-9")) == {"$and": [{"type": "sortie"}, {"$or": [
+        {"date": None, "id": {"$lt": "id-9"}}
+    ]}]}
+    assert paginate_query(False, encode_cursor(None, "id-9")) == {"$and": [{"type": "sortie"}, {"$or": [
+        {"date": {"$ne": None}}, {"date": None, "id": {"$gt": "id-9"}}
+    ]}]}
+
+
+def test_first_page_query_unchanged():
+    assert paginate_query(True, None) == {"type": "sortie"}
@@ -0,0 +1,87 @@
+import math
+
+import pytest
+
+from server import (
+    UNIT_ALIASES, UNIT_CODES, UNIT_CONVERSION_MATRIX, UNIT_INDEX, UNITES_STANDARDISEES,
+    canonical_unit, convertir_unite, normalize_unit, product_unit_factor, unit_factor,
+)
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("kg", "kg"), ("Kg", "kg"), ("KGS", "kg"), (" kilo ", "kg"),
+    ("gr", "g"), ("Grammes", "g"),
+    ("l", "L"), ("Litre", "L"), ("CL", "cL"), ("ml", "mL"),
+    ("pcs", "pièce"), ("Piece", "pièce"), ("u", "unité"), ("boite", "boîte"),
+    ("btl", "bouteille"), ("carton", "colis"), ("Caisses", "colis"),
+    ("botte", None), ("", None), (None, None),
+])
+def test_normalize_unit(raw, expected):
+    assert normalize_unit(raw) == expected
+
+
+def test_aliases_point_to_standard_units():
+    for alias, code in UNIT_ALIASES.items():
+        assert alias == alias.lower()
+        assert code in UNITES_STANDARDISEES
+
+
+def test_canonical_unit_keeps_unknown_labels():
+    assert canonical_unit("Kg") == "kg"
+    assert canonical_unit("botte") == "botte"
+    assert canonical_unit(None) is None
+
+
+@pytest.mark.parametrize("source, cible, expected", [
+    ("kg", "g", 1000), ("g", "kg", 0.001), ("tonne", "kg", 1000),
+    ("cL", "L", 0.01), ("L", "mL", 1000), ("Kg", "gr", 1000),
+    ("bouteille", "verre", 6), ("pièce", "unité", 1),
+    ("kg", "kg", 1), (None, "kg", 1), ("kg", None, 1),
+])
+def test_unit_factor(source, cible, expected):
+    assert unit_factor(source, cible) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("source, cible", [("kg", "L"), ("pièce", "kg"), ("colis", "pièce"), ("botte", "kg")])
+def test_unit_factor_incompatible(source, cible):
+    assert unit_factor(source, cible) is None
+
+
+def test_convertir_unite():
+    assert convertir_unite(2.5, "kg", "g") == pytest.approx(2500)
+    assert convertir_unite(75, "cl", "L") == pytest.approx(0.75)
+    with pytest.raises(ValueError):
+        convertir_unite(1, "kg", "L")
+    with pytest.raises(ValueError):
+        convertir_unite(1, "botte", "kg")
+
+
+def test_conversion_matrix():
+    for i, source in enumerate(UNIT_CODES):
+        assert UNIT_CONVERSION_MATRIX[i, i] == 1
+        for j, cible in enumerate(UNIT_CODES):
+            same_type = UNITES_STANDARDISEES[source]["type"] == UNITES_STANDARDISEES[cible]["type"]
+            assert math.isnan(UNIT_CONVERSION_MATRIX[i, j]) != same_type
+    assert UNIT_CONVERSION_MATRIX[UNIT_INDEX["kg"], UNIT_INDEX["g"]] == 1000
+
+
+@pytest.mark.parametrize("unite, produit, expected", [
+    ("g", {"unite": "kg"}, 0.001),
+    ("pièce", {"unite": "kg", "poids_piece": 150}, 0.15),
+    ("pcs", {"unite": "g", "poids_piece": 150}, 150),
+    ("kg", {"unite": "pièce", "poids_piece": 250}, 4),
+    ("colis", {"unite": "kg", "taille_colis": 12}, 12),
+    ("carton", {"unite": "pièce", "taille_colis": 24}, 24),
+])
+def test_product_unit_factor(unite, produit, expected):
+    assert product_unit_factor(unite, produit) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("unite, produit", [
+    ("pièce", {"unite": "kg"}),
+    ("colis", {"unite": "kg"}),
+    ("L", {"unite": "kg", "poids_piece": 150}),
+    ("botte", {"unite": "kg"}),
+])
+def test_product_unit_factor_missing_data(unite, produit):
+    assert product_unit_factor(unite, produit) is None